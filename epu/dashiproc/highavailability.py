@@ -14,6 +14,9 @@ log = logging.getLogger(__name__)
 
 DEFAULT_TOPIC = "highavailability"
 
+# process fields used by HA policies
+_PROCESS_FIELDS = ('upid', 'state', 'hostname')
+
 
 class DashiHAProcessControl(object):
 
@@ -55,7 +58,7 @@ class DashiHAProcessControl(object):
         for pd_name in self.process_dispatchers:
             pd_client = self._get_pd_client(pd_name)
             try:
-                procs = pd_client.describe_processes()
+                procs = list(pd_client.iter_processes(fields=_PROCESS_FIELDS))
                 all_procs[pd_name] = procs
             except timeout:
                 log.warning("%s timed out when calling describe_processes", pd_name)
@@ -3,10 +3,11 @@ import threading
 
 from dashi import bootstrap
 
-from epu.processdispatcher.core import ProcessDispatcherCore
+from epu.processdispatcher.core import ProcessDispatcherCore, HeartbeatInbox
 from epu.processdispatcher.store import get_processdispatcher_store
 from epu.processdispatcher.engines import EngineRegistry
 from epu.processdispatcher.matchmaker import PDMatchmaker
+from epu.processdispatcher.stats import MatchmakerStats
 from epu.processdispatcher.doctor import PDDoctor
 from epu.dashiproc.epumanagement import EPUManagementClient
 from epu.util import get_config_paths
@@ -15,6 +16,9 @@ import epu.dashiproc
 
 log = logging.getLogger(__name__)
 
+# number of processes requested at a time by ProcessDispatcherClient.iter_processes()
+DESCRIBE_PAGE_SIZE = 500
+
 
 class ProcessDispatcherService(object):
     """PD service interface
@@ -65,18 +69,40 @@ class ProcessDispatcherService(object):
         else:
             self.notifier = SubscriberNotifier(self.dashi)
 
+        statsd_cfg = self.CFG.get('statsd')
+        self.matchmaker_stats = MatchmakerStats(statsd_cfg=statsd_cfg)
+
         self.core = ProcessDispatcherCore(self.store,
                                           self.registry,
                                           self.eeagent_client,
-                                          self.notifier)
+                                          self.notifier,
+                                          matchmaker_stats=self.matchmaker_stats)
+
+        # heartbeats are ingested in the background, newest per EEAgent
+        heartbeat_workers = self.CFG.processdispatcher.get('heartbeat_workers')
+        self.heartbeats = HeartbeatInbox(self.core, workers=heartbeat_workers)
 
         launch_type = self.CFG.processdispatcher.get('launch_type', 'supd')
         restart_throttling_config = self.CFG.processdispatcher.get('restart_throttling_config', {})
+        dispatch_workers = self.CFG.processdispatcher.get('dispatch_workers')
+        batch_window = self.CFG.processdispatcher.get('matchmaker_batch_window')
+
+        # by default a single matchmaker handles all engines. when shards are
+        # configured, each is matched separately under its own election.
+        matchmaker_shards = self.CFG.processdispatcher.get('matchmaker_shards')
+        if matchmaker_shards is None:
+            shards = {None: None}
+        else:
+            shards = self.registry.get_matchmaker_shards(matchmaker_shards)
 
-        self.matchmaker = PDMatchmaker(self.core, self.store, self.eeagent_client,
-            self.registry, self.epum_client, self.notifier, self.topic,
-            domain_definition_id, base_domain_config, launch_type,
-            restart_throttling_config)
+        self.matchmakers = []
+        for shard, engine_ids in shards.iteritems():
+            self.matchmakers.append(PDMatchmaker(self.core, self.store,
+                self.eeagent_client, self.registry, self.epum_client,
+                self.notifier, self.topic, domain_definition_id,
+                base_domain_config, launch_type, restart_throttling_config,
+                dispatch_workers=dispatch_workers, stats=self.matchmaker_stats,
+                shard=shard, engine_ids=engine_ids, batch_window=batch_window))
 
         self.doctor = PDDoctor(self.core, self.store)
         self.ready_event = threading.Event()
@@ -101,15 +127,18 @@ class ProcessDispatcherService(object):
         self.dashi.handle(self.list_definitions)
         self.dashi.handle(self.create_process)
         self.dashi.handle(self.schedule_process)
+        self.dashi.handle(self.schedule_processes)
         self.dashi.handle(self.describe_process)
         self.dashi.handle(self.describe_processes)
         self.dashi.handle(self.restart_process)
         self.dashi.handle(self.terminate_process)
+        self.dashi.handle(self.terminate_processes)
         self.dashi.handle(self.node_state)
         self.dashi.handle(self.heartbeat, sender_kwarg='sender')
         self.dashi.handle(self.dump)
 
-        self.matchmaker.start_election()
+        for matchmaker in self.matchmakers:
+            matchmaker.start_election()
 
         self.ready_event.set()
 
@@ -124,12 +153,19 @@ class ProcessDispatcherService(object):
         self.ready_event.clear()
         self.dashi.cancel()
         self.dashi.disconnect()
+        self.heartbeats.join()
         self.store.shutdown()
 
     def _make_process_dict(self, proc):
         return dict(upid=proc.upid, state=proc.state, round=proc.round,
                     assigned=proc.assigned)
 
+    def _make_bulk_result(self, upid, result):
+        if isinstance(result, Exception):
+            return dict(upid=upid, error=str(result),
+                        error_type=result.__class__.__name__)
+        return self._make_process_dict(result)
+
     def set_system_boot(self, system_boot):
         self.core.set_system_boot(system_boot)
 
@@ -160,21 +196,41 @@ class ProcessDispatcherService(object):
                          subscribers=None, constraints=None,
                          queueing_mode=None, restart_mode=None,
                          execution_engine_id=None, node_exclusive=None,
-                         name=None):
+                         name=None, priority=None):
 
         result = self.core.schedule_process(None, upid=upid,
             definition_id=definition_id, configuration=configuration,
             subscribers=subscribers, constraints=constraints,
             queueing_mode=queueing_mode, restart_mode=restart_mode,
             node_exclusive=node_exclusive,
-            execution_engine_id=execution_engine_id, name=name)
+            execution_engine_id=execution_engine_id, name=name,
+            priority=priority)
         return self._make_process_dict(result)
 
+    def schedule_processes(self, processes):
+        results = self.core.schedule_processes(None, processes)
+        return [self._make_bulk_result(
+                    request.get('upid') if isinstance(request, dict) else None,
+                    result)
+                for request, result in zip(processes, results)]
+
     def describe_process(self, upid):
         return self.core.describe_process(None, upid)
 
-    def describe_processes(self):
-        return self.core.describe_processes()
+    def describe_processes(self, owner=None, min_state=None, max_state=None,
+                           engine=None, node_id=None, fields=None, cursor=None,
+                           limit=None):
+        # a list of all matching processes unless a page is asked for, as
+        # callers of earlier releases expect
+        if cursor is None and limit is None:
+            return self.core.describe_processes(owner=owner,
+                min_state=min_state, max_state=max_state, engine=engine,
+                node_id=node_id, fields=fields)
+
+        processes, cursor = self.core.describe_processes_page(limit,
+            cursor=cursor, owner=owner, min_state=min_state,
+            max_state=max_state, engine=engine, node_id=node_id, fields=fields)
+        return dict(processes=processes, cursor=cursor)
 
     def restart_process(self, upid):
         result = self.core.restart_process(None, upid)
@@ -184,12 +240,17 @@ class ProcessDispatcherService(object):
         result = self.core.terminate_process(None, upid)
         return self._make_process_dict(result)
 
+    def terminate_processes(self, upids):
+        results = self.core.terminate_processes(None, upids)
+        return [self._make_bulk_result(upid, result)
+                for upid, result in zip(upids, results)]
+
     def node_state(self, node_id, domain_id, state, properties=None):
         self.core.node_state(node_id, domain_id, state, properties=properties)
 
     def heartbeat(self, sender, message):
         log.debug("got heartbeat from %s: %s", sender, message)
-        self.core.ee_heartbeat(sender, message)
+        self.heartbeats.heartbeat(sender, message)
 
     def dump(self):
         return self.core.dump()
@@ -235,6 +296,12 @@ class EEAgentClient(object):
     def cleanup_process(self, eeagent, upid, round):
         return self.dashi.fire(eeagent, "cleanup", u_pid=upid, round=round)
 
+    def ack_heartbeat(self, eeagent, sequence):
+        return self.dashi.fire(eeagent, "ack_heartbeat", sequence=sequence)
+
+    def request_heartbeat(self, eeagent):
+        return self.dashi.fire(eeagent, "send_heartbeat")
+
 
 class ProcessDispatcherClient(object):
     def __init__(self, dashi, topic):
@@ -276,21 +343,53 @@ class ProcessDispatcherClient(object):
                          subscribers=None, constraints=None,
                          queueing_mode=None, restart_mode=None,
                          execution_engine_id=None, node_exclusive=None,
-                         name=None):
+                         name=None, priority=None):
         request = dict(upid=upid, definition_id=definition_id,
                        configuration=configuration,
                        subscribers=subscribers, constraints=constraints,
                        queueing_mode=queueing_mode, restart_mode=restart_mode,
                        execution_engine_id=execution_engine_id,
-                       node_exclusive=node_exclusive, name=name)
+                       node_exclusive=node_exclusive, name=name,
+                       priority=priority)
 
         return self.dashi.call(self.topic, "schedule_process", args=request)
 
+    def schedule_processes(self, processes):
+        """Schedule several processes in one call
+
+        @param processes: list of dicts of schedule_process arguments
+        @return: list of process dicts. Processes which could not be scheduled
+            have error and error_type keys instead.
+        """
+        return self.dashi.call(self.topic, "schedule_processes",
+                               processes=processes)
+
     def describe_process(self, upid):
         return self.dashi.call(self.topic, "describe_process", upid=upid)
 
-    def describe_processes(self):
-        return self.dashi.call(self.topic, "describe_processes")
+    def describe_processes(self, owner=None, min_state=None, max_state=None,
+                           engine=None, node_id=None, fields=None, cursor=None,
+                           limit=None):
+        return self.dashi.call(self.topic, "describe_processes", owner=owner,
+            min_state=min_state, max_state=max_state, engine=engine,
+            node_id=node_id, fields=fields, cursor=cursor, limit=limit)
+
+    def iter_processes(self, owner=None, min_state=None, max_state=None,
+                       engine=None, node_id=None, fields=None,
+                       page_size=DESCRIBE_PAGE_SIZE):
+        """Iterate over the processes of the PD, requesting a page at a time
+        """
+        cursor = None
+        while True:
+            page = self.describe_processes(owner=owner, min_state=min_state,
+                max_state=max_state, engine=engine, node_id=node_id,
+                fields=fields, cursor=cursor, limit=page_size)
+            for process in page['processes']:
+                yield process
+
+            cursor = page['cursor']
+            if cursor is None:
+                break
 
     def restart_process(self, upid):
         return self.dashi.call(self.topic, 'restart_process', upid=upid)
@@ -298,6 +397,9 @@ class ProcessDispatcherClient(object):
     def terminate_process(self, upid):
         return self.dashi.call(self.topic, 'terminate_process', upid=upid)
 
+    def terminate_processes(self, upids):
+        return self.dashi.call(self.topic, 'terminate_processes', upids=upids)
+
     def node_state(self, node_id, domain_id, state, properties=None):
 
         request = dict(node_id=node_id, domain_id=domain_id, state=state)
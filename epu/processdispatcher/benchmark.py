@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""Matchmaker scale benchmark
+
+Drives a PDMatchmaker against the in-memory ProcessDispatcherStore with a
+synthetic fleet of nodes and queued processes, and reports matchmaking cycle
+latency, assignment throughput and store call counts. No broker or ZooKeeper
+is needed:
+
+    python -m epu.processdispatcher.benchmark --nodes 1000 --processes 10000
+"""
+
+import sys
+import time
+import random
+import logging
+import argparse
+from collections import defaultdict
+
+from epu.states import ProcessState, ProcessDispatcherState
+from epu.processdispatcher.core import ProcessDispatcherCore
+from epu.processdispatcher.engines import EngineRegistry, domain_id_from_engine
+from epu.processdispatcher.matchmaker import PDMatchmaker
+from epu.processdispatcher.store import ProcessDispatcherStore, ProcessRecord, \
+    ResourceRecord, NodeRecord, ProcessDefinitionRecord
+
+log = logging.getLogger(__name__)
+
+
+class CountingStore(object):
+    """Wraps a store and counts calls to each of its methods
+    """
+    def __init__(self, store):
+        self.store = store
+        self.calls = defaultdict(int)
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if not callable(attr):
+            return attr
+
+        calls = self.calls
+
+        def counted(*args, **kwargs):
+            calls[name] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class BenchmarkResourceClient(object):
+    def __init__(self):
+        self.launches = 0
+
+    def launch_process(self, eeagent, upid, round, run_type, parameters):
+        self.launches += 1
+
+
+class BenchmarkEPUMClient(object):
+    def __init__(self):
+        self.reconfigures = 0
+
+    def describe_domain(self, domain_id):
+        return {}
+
+    def add_domain(self, domain_id, definition_id, config,
+                   subscriber_name=None, subscriber_op=None):
+        pass
+
+    def reconfigure_domain(self, domain_id, config):
+        self.reconfigures += 1
+
+
+class BenchmarkNotifier(object):
+    def notify_process(self, process):
+        pass
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def run_benchmark(nodes=100, resources=2, slots=4, engines=1, processes=1000,
+                  batch=None, sites=4, constrained=0.25, exclusive=0.05,
+                  exclusive_tags=10, throttled=0.05, seed=0):
+    """Run a matchmaking benchmark and return a dict of results
+
+    @param nodes: number of nodes in the fleet
+    @param resources: execution resources per node
+    @param slots: slots per resource
+    @param engines: number of engines the nodes are spread across
+    @param processes: number of processes to queue
+    @param batch: processes queued per matchmaking cycle. all at once if None
+    @param sites: number of distinct site properties advertised by resources
+    @param constrained: fraction of processes constrained to a single site
+    @param exclusive: fraction of processes with a node_exclusive tag
+    @param exclusive_tags: number of distinct node_exclusive tags
+    @param throttled: fraction of processes which are restart throttled
+    @param seed: random seed, so runs are repeatable
+    """
+    rand = random.Random(seed)
+
+    engine_ids = ["engine%d" % i for i in range(engines)]
+    engine_conf = dict((engine_id, {'slots': slots, 'replicas': resources})
+                       for engine_id in engine_ids)
+    registry = EngineRegistry.from_config(engine_conf, default=engine_ids[0])
+
+    # the fleet and queue are set up through the raw store, so only calls
+    # made by the matchmaker are counted
+    raw_store = ProcessDispatcherStore()
+    raw_store.set_initialized()
+    raw_store.set_pd_state(ProcessDispatcherState.OK)
+    store = CountingStore(raw_store)
+
+    resource_client = BenchmarkResourceClient()
+    epum_client = BenchmarkEPUMClient()
+    notifier = BenchmarkNotifier()
+    core = ProcessDispatcherCore(store, registry, resource_client, notifier)
+
+    matchmaker = PDMatchmaker(core, store, resource_client, registry,
+        epum_client, notifier, "benchmark", "benchmark_definition",
+        {'engine_conf': {}}, "supd", {'minimum_time_between_starts': 3600})
+
+    # build the fleet
+    for i in range(nodes):
+        node_id = "node%d" % i
+        engine_id = engine_ids[i % engines]
+        raw_store.add_node(NodeRecord.new(node_id, domain_id_from_engine(engine_id)))
+        for j in range(resources):
+            props = {"engine": engine_id, "site": "site%d" % (i % sites)}
+            resource = ResourceRecord.new("%s-r%d" % (node_id, j), node_id,
+                slots, properties=props)
+            raw_store.add_resource(resource)
+
+    # build the process records, to be queued in batches
+    definition = ProcessDefinitionRecord.new("benchmark_definition", "supd",
+        {"exec": "/bin/true"})
+    now = time.time()
+    records = []
+    for i in range(processes):
+        constraints = {"engine": engine_ids[i % engines]}
+        if rand.random() < constrained:
+            constraints["site"] = "site%d" % rand.randrange(sites)
+
+        node_exclusive = None
+        if rand.random() < exclusive:
+            node_exclusive = "x%d" % rand.randrange(exclusive_tags)
+
+        process = ProcessRecord.new(None, "p%d" % i, definition,
+            ProcessState.REQUESTED, constraints=constraints,
+            node_exclusive=node_exclusive)
+
+        if rand.random() < throttled:
+            process.dispatch_times = [now - 1, now]
+        records.append(process)
+
+    matchmaker.initialize()
+
+    if not batch:
+        batch = processes or 1
+
+    cycle_times = []
+    matchmake_time = 0.0
+    start = time.time()
+
+    # a cycle follows PDMatchmaker.run(). once everything is queued, stop
+    # when nothing more can be done without waiting on throttling.
+    while records or matchmaker.needs_matchmaking:
+        for process in records[:batch]:
+            raw_store.add_process(process)
+            raw_store.enqueue_process(*process.key)
+        del records[:batch]
+
+        cycle_start = time.time()
+        if matchmaker.process_set_changed:
+            matchmaker._get_queued_processes()
+        if matchmaker.resource_set_changed:
+            matchmaker._get_resource_set()
+        if matchmaker.changed_resources:
+            matchmaker._get_resources()
+        matchmaker._check_throttled_processes()
+
+        matchmake_start = time.time()
+        if matchmaker.needs_matchmaking:
+            matchmaker.matchmake()
+        matchmake_time += time.time() - matchmake_start
+
+        if not matchmaker.needs_matchmaking:
+            matchmaker.register_needs()
+        cycle_times.append(time.time() - cycle_start)
+
+    elapsed = time.time() - start
+
+    assignments = resource_client.launches
+    return dict(
+        nodes=nodes, resources=nodes * resources, slots=nodes * resources * slots,
+        processes=processes, cycles=len(cycle_times), elapsed=elapsed,
+        assignments=assignments,
+        throttled=len(matchmaker.throttled_processes),
+        queued=len(matchmaker.queued_processes),
+        assignments_per_second=assignments / matchmake_time if matchmake_time else 0.0,
+        cycle_min=min(cycle_times) if cycle_times else 0.0,
+        cycle_median=_percentile(cycle_times, 50),
+        cycle_p95=_percentile(cycle_times, 95),
+        cycle_max=max(cycle_times) if cycle_times else 0.0,
+        reconfigures=epum_client.reconfigures,
+        store_calls=dict(store.calls))
+
+
+def print_results(results, out=sys.stdout):
+    print >> out, "fleet: %(nodes)d nodes, %(resources)d resources, %(slots)d slots" % results
+    print >> out, ("processes: %(processes)d queued, %(assignments)d assigned, "
+                   "%(throttled)d throttled, %(queued)d still queued" % results)
+    print >> out, "cycles: %(cycles)d in %(elapsed).3fs" % results
+    print >> out, "cycle latency: min=%.2fms median=%.2fms p95=%.2fms max=%.2fms" % (
+        results['cycle_min'] * 1000, results['cycle_median'] * 1000,
+        results['cycle_p95'] * 1000, results['cycle_max'] * 1000)
+    print >> out, "assignments/sec: %(assignments_per_second).1f" % results
+    print >> out, "domain reconfigures: %(reconfigures)d" % results
+
+    store_calls = results['store_calls']
+    cycles = results['cycles'] or 1
+    print >> out, "store calls: %d total" % sum(store_calls.itervalues())
+    for name, count in sorted(store_calls.iteritems(), key=lambda c: -c[1]):
+        print >> out, "  %-28s %10d  (%.1f/cycle)" % (name, count, count / float(cycles))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Process Dispatcher matchmaker benchmark')
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--resources', type=int, default=2,
+        help="execution resources per node")
+    parser.add_argument('--slots', type=int, default=4,
+        help="slots per execution resource")
+    parser.add_argument('--engines', type=int, default=1)
+    parser.add_argument('--processes', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=None,
+        help="processes queued per cycle. default is all at once")
+    parser.add_argument('--sites', type=int, default=4)
+    parser.add_argument('--constrained', type=float, default=0.25,
+        help="fraction of processes constrained to a site")
+    parser.add_argument('--exclusive', type=float, default=0.05,
+        help="fraction of processes with a node_exclusive tag")
+    parser.add_argument('--exclusive-tags', type=int, default=10)
+    parser.add_argument('--throttled', type=float, default=0.05,
+        help="fraction of processes which are restart throttled")
+    parser.add_argument('--seed', type=int, default=0)
+    opts = parser.parse_args(args=args)
+
+    results = run_benchmark(nodes=opts.nodes, resources=opts.resources,
+        slots=opts.slots, engines=opts.engines, processes=opts.processes,
+        batch=opts.batch, sites=opts.sites, constrained=opts.constrained,
+        exclusive=opts.exclusive, exclusive_tags=opts.exclusive_tags,
+        throttled=opts.throttled, seed=opts.seed)
+    print_results(results)
+
+
+if __name__ == '__main__':
+    main()
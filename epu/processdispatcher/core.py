@@ -1,18 +1,27 @@
 import logging
+import threading
 
+import epu.tevent as tevent
 from epu.states import InstanceState, ProcessState, ExecutionResourceState
 from epu.exceptions import NotFoundError, WriteConflictError, BadRequestError
 from epu.processdispatcher.engines import engine_id_from_domain
 from epu.util import is_valid_identifier, parse_datetime, ceiling_datetime
 from epu.processdispatcher.store import ProcessRecord, NodeRecord, \
-    ResourceRecord, ProcessDefinitionRecord
+    ResourceRecord, ProcessDefinitionRecord, get_process_index_values, \
+    get_process_index_entries
 from epu.processdispatcher.modes import RestartMode
-from epu.processdispatcher.util import get_process_state_message
+from epu.processdispatcher.util import get_process_state_message, \
+    get_heartbeat_state, get_heartbeat_digest
 
 log = logging.getLogger(__name__)
 
 _WRITE_CONFLICT_RETRIES = 5
 
+# arguments accepted for each process by schedule_processes()
+_SCHEDULE_PROCESS_ARGS = frozenset(['upid', 'definition_id', 'configuration',
+    'subscribers', 'constraints', 'queueing_mode', 'restart_mode',
+    'execution_engine_id', 'node_exclusive', 'name', 'priority'])
+
 
 def validate_owner_upid(owner, upid):
     # so far we don't enforce owner since it isn't used for anything
@@ -53,7 +62,8 @@ class ProcessDispatcherCore(object):
 
     """
 
-    def __init__(self, store, ee_registry, eeagent_client, notifier):
+    def __init__(self, store, ee_registry, eeagent_client, notifier,
+                 matchmaker_stats=None):
         """
 
         @param store:
@@ -61,12 +71,19 @@ class ProcessDispatcherCore(object):
         @param ee_registry:
         @param eeagent_client:
         @param notifier:
+        @param matchmaker_stats: matchmaker timings to include in dump()
+        @type matchmaker_stats: MatchmakerStats
         @return:
         """
         self.store = store
         self.ee_registry = ee_registry
         self.eeagent_client = eeagent_client
         self.notifier = notifier
+        self.matchmaker_stats = matchmaker_stats
+
+        # processes are indexed by the engine they run on, including those
+        # mapped to one by their module
+        self.store.set_process_engine_resolver(self._get_definition_engine_id)
 
     def set_system_boot(self, system_boot):
         """Operation used at the end of a launch to disable system boot mode
@@ -120,13 +137,28 @@ class ProcessDispatcherCore(object):
         it thinks has already been acknowledged, it will return the current
         state of the process.
         """
+        return self._create_process(owner, upid, definition_id, name=name)
+
+    def _create_process(self, owner, upid, definition_id, name=None,
+                        definitions=None):
+        """Create a new process, optionally sharing definition lookups
+
+        @param definitions: dict of definitions already fetched, by id
+        """
         validate_owner_upid(owner, upid)
         validate_definition_id(definition_id)
 
-        # if not a real def, a NotFoundError will bubble up to caller
-        definition = self.store.get_definition(definition_id)
+        definition = None
+        if definitions is not None:
+            definition = definitions.get(definition_id)
+
         if definition is None:
-            raise NotFoundError("Couldn't find process definition %s in store" % definition_id)
+            # if not a real def, a NotFoundError will bubble up to caller
+            definition = self.store.get_definition(definition_id)
+            if definition is None:
+                raise NotFoundError("Couldn't find process definition %s in store" % definition_id)
+            if definitions is not None:
+                definitions[definition_id] = definition
 
         process = ProcessRecord.new(owner, upid, definition,
             ProcessState.UNSCHEDULED, name=name)
@@ -154,7 +186,7 @@ class ProcessDispatcherCore(object):
                          configuration=None, subscribers=None,
                          constraints=None, queueing_mode=None,
                          restart_mode=None, execution_engine_id=None,
-                         node_exclusive=None, name=None):
+                         node_exclusive=None, name=None, priority=None):
         """Schedule a process for execution
 
         @param upid: unique process identifier
@@ -167,6 +199,7 @@ class ProcessDispatcherCore(object):
         @param execution_engine_id: dispatch a process to a specific eea
         @param node_exclusive: property that will only be permitted once on a node
         @param name: a (hopefully) human recognizable name for the process
+        @param priority: integer priority. higher priority processes are matched first
         @rtype: ProcessRecord
         @return: description of process launch status
 
@@ -182,11 +215,82 @@ class ProcessDispatcherCore(object):
         it thinks has already been acknowledged, it will return the current
         state of the process.
         """
+        process = self._schedule_process(owner, upid,
+            definition_id=definition_id, configuration=configuration,
+            subscribers=subscribers, constraints=constraints,
+            queueing_mode=queueing_mode, restart_mode=restart_mode,
+            execution_engine_id=execution_engine_id,
+            node_exclusive=node_exclusive, name=name, priority=priority)
+
+        # always enqueue the process, even if it is probably already in the
+        # queue. this is harmless and provides an easy way to "nudge" matchmaking
+        # along in the face of bugs.
+        log.debug("Enqueing process %s", upid)
+        self.store.enqueue_process(owner, upid, process.round)
 
+        return process
+
+    def schedule_processes(self, owner, processes):
+        """Schedule several processes for execution
+
+        @param processes: list of dicts of schedule_process arguments. Each
+            must include a upid.
+        @return: list with, for each requested process, its ProcessRecord or
+            the error that kept it from being scheduled
+
+        Each definition is fetched once for the whole batch, and scheduled
+        processes are enqueued together. A bad request for one process does
+        not prevent the others from being scheduled. If scheduling fails
+        with any other error, the processes scheduled before it are still
+        enqueued and the error is raised.
+        """
+        definitions = {}
+        results = []
+        queued = []
+        try:
+            for request in processes:
+                try:
+                    if not isinstance(request, dict):
+                        raise BadRequestError("invalid schedule request %r" % (request,))
+                    unknown = set(request) - _SCHEDULE_PROCESS_ARGS
+                    if unknown:
+                        raise BadRequestError("invalid schedule request arguments: %s" %
+                            ", ".join(sorted(unknown)))
+
+                    kwargs = dict((str(key), value) for key, value in request.iteritems())
+                    upid = kwargs.pop('upid', None)
+                    process = self._schedule_process(owner, upid,
+                        definitions=definitions, **kwargs)
+                except (BadRequestError, NotFoundError), e:
+                    results.append(e)
+                else:
+                    results.append(process)
+                    queued.append((owner, process.upid, process.round))
+
+        finally:
+            # as with schedule_process, processes are always enqueued. those
+            # already scheduled are requested, so they must not be left out of
+            # the queue
+            if queued:
+                log.debug("Enqueing %d processes", len(queued))
+                self.store.enqueue_processes(queued)
+
+        return results
+
+    def _schedule_process(self, owner, upid, definition_id=None,
+                          configuration=None, subscribers=None,
+                          constraints=None, queueing_mode=None,
+                          restart_mode=None, execution_engine_id=None,
+                          node_exclusive=None, name=None, priority=None,
+                          definitions=None):
+        """Update a process record for scheduling, without enqueueing it
+        """
         validate_owner_upid(owner, upid)
 
         if constraints is None:
             constraints = {}
+        elif not isinstance(constraints, dict):
+            raise BadRequestError("invalid constraints %r" % (constraints,))
         if execution_engine_id:
             constraints['engine'] = execution_engine_id
 
@@ -195,6 +299,13 @@ class ProcessDispatcherCore(object):
             queueing_mode=queueing_mode, restart_mode=restart_mode,
             node_exclusive=node_exclusive, name=name)
 
+        # priority is only changed when it is specified
+        if priority is not None:
+            try:
+                process_updates['priority'] = int(priority)
+            except (TypeError, ValueError):
+                raise BadRequestError("invalid priority %r" % (priority,))
+
         process = self.store.get_process(owner, upid)
 
         for _ in range(_WRITE_CONFLICT_RETRIES):
@@ -205,8 +316,8 @@ class ProcessDispatcherCore(object):
                 # an error.
                 if not definition_id:
                     raise NotFoundError("process %s does not exist" % upid)
-                process = self.create_process(owner, upid,
-                    definition_id=definition_id, name=name)
+                process = self._create_process(owner, upid, definition_id,
+                    name=name, definitions=definitions)
                 process.update(process_updates)
                 process.state = ProcessState.REQUESTED
 
@@ -253,30 +364,129 @@ class ProcessDispatcherCore(object):
         else:
             raise BadRequestError("process %s could not be updated" % (upid,))
 
-        # always enqueue the process, even if it is probably already in the
-        # queue. this is harmless and provides an easy way to "nudge" matchmaking
-        # along in the face of bugs.
-        log.debug("Enqueing process %s", upid)
-        self.store.enqueue_process(owner, upid, process.round)
-
         return process
 
     def describe_process(self, owner, upid):
         """
         Get the state of a process in the system
-        @param owner: owner of the process
+        @param owner: owner of the process. if None, it is looked up
         @param upid: ID of process
         @return: process description, or None
         """
+        if owner is None:
+            owner = _get_process_id(self.store.get_process_owners([upid]),
+                upid)[0]
         return self.store.get_process(owner, upid)
 
-    def describe_processes(self):
+    def describe_processes(self, owner=None, min_state=None, max_state=None,
+                           engine=None, node_id=None, fields=None):
         """
         Get a list of processes in the system
+
+        Processes are looked up in the indexes of the store, so only the
+        records of processes matching the filters are read.
+
+        @param owner: only processes of this owner
+        @param min_state: only processes in this state or a later one
+        @param max_state: only processes in this state or an earlier one
+        @param engine: only processes of this engine
+        @param node_id: only processes assigned to a resource of this node
+        @param fields: fields to describe, all if None
         @return: list of process descriptions
         """
-        return [self.store.get_process(owner, upid)
-                for owner, upid in self.store.get_process_ids()]
+        if not (owner or min_state or max_state or engine or node_id):
+            return self._describe_processes(self.store.get_processes(), {},
+                fields)
+
+        index_values = self._get_index_values(min_state, max_state, engine,
+            node_id)
+        process_ids = self.store.find_process_ids(index_values, owner=owner)
+        return self._describe_processes(self.store.get_processes(process_ids),
+            index_values, fields)
+
+    def describe_processes_page(self, limit, cursor=None, owner=None,
+                                min_state=None, max_state=None, engine=None,
+                                node_id=None, fields=None):
+        """
+        Get a page of the processes in the system
+
+        Pages are in the order of the store and filtered as in
+        describe_processes(). Each page ends with a cursor, which is passed
+        back to get the next page. The store resumes from the cursor, so a
+        page only reads as far into the store as it needs to.
+
+        @param limit: maximum number of processes in the page
+        @param cursor: cursor of the previous page, None for the first one
+        @return: (process descriptions, cursor) tuple. the cursor is None
+            after the last page
+        """
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise BadRequestError("invalid limit %r" % (limit,))
+        if limit < 1:
+            raise BadRequestError("invalid limit %r" % (limit,))
+
+        if cursor is not None:
+            # the cursor is the (owner, upid) of the last process of the
+            # previous page
+            if not (isinstance(cursor, (list, tuple)) and len(cursor) == 2):
+                raise BadRequestError("invalid cursor %r" % (cursor,))
+            cursor = tuple(cursor)
+
+        index_values = self._get_index_values(min_state, max_state, engine,
+            node_id)
+
+        # one more than the page is found, to tell if there is a next page
+        process_ids = self.store.find_process_ids(index_values, owner=owner,
+            after=cursor, limit=limit + 1)
+
+        page_ids = process_ids[:limit]
+        if len(process_ids) > limit:
+            cursor = list(page_ids[-1])
+        else:
+            cursor = None
+
+        processes = self._describe_processes(
+            self.store.get_processes(page_ids), index_values, fields)
+        return processes, cursor
+
+    def _get_index_values(self, min_state, max_state, engine, node_id):
+        """Get the values processes matching filters have in each index
+        """
+        index_values = {}
+        if min_state or max_state:
+            index_values['state'] = set(state for state in
+                self.store.list_process_index_values("state")
+                if (not min_state or state >= min_state) and
+                   (not max_state or state <= max_state))
+        if engine:
+            engines = set([engine])
+            if engine == self.ee_registry.default:
+                # processes constrained to no engine run on the default one
+                engines.add(None)
+            index_values['engine'] = engines
+        if node_id:
+            node = self.store.get_node(node_id)
+            index_values['assigned'] = set(node.resources if node else ())
+        return index_values
+
+    def _describe_processes(self, processes, index_values, fields):
+        descriptions = []
+        for process in processes:
+            # records are checked again, as they may have changed since the
+            # indexes were read
+            if index_values:
+                values = get_process_index_values(process,
+                    self._get_definition_engine_id)
+                if any(get_process_index_entries(index,
+                           values[index]).isdisjoint(matching)
+                       for index, matching in index_values.iteritems()):
+                    continue
+            if fields is not None:
+                process = dict((field, process.get(field)) for field in fields)
+            descriptions.append(process)
+        return descriptions
 
     def restart_process(self, owner, upid):
         """
@@ -392,6 +602,21 @@ class ProcessDispatcherCore(object):
 
         return process
 
+    def terminate_processes(self, owner, upids):
+        """Kill several processes
+
+        @param upids: list of process IDs
+        @return: list with, for each process, its ProcessRecord or the error
+            that kept it from being terminated
+        """
+        results = []
+        for upid in upids:
+            try:
+                results.append(self.terminate_process(owner, upid))
+            except (BadRequestError, NotFoundError), e:
+                results.append(e)
+        return results
+
     def node_state(self, node_id, domain_id, state, properties=None):
         """
         Handle updates about available domain nodes.
@@ -551,6 +776,16 @@ class ProcessDispatcherCore(object):
             - node id - unique ID for the provisioned resource (VM) the EE runs on
             - timestamp - time heartbeat was generated
             - processes - list of running process IDs
+
+        EEAgents may also number their heartbeats, in a sequence field. The
+        PD acknowledges each numbered heartbeat it applies. Once a heartbeat
+        is acknowledged, the EEAgent may send delta heartbeats, which have:
+            - base - sequence number of the acknowledged heartbeat
+            - processes - only the processes which changed since the base
+            - removed - upids of the processes gone since the base
+            - digest - get_heartbeat_digest() of the full process list
+        If the PD doesn't know the base, or its view of the processes doesn't
+        match the digest, it asks the EEAgent for a full heartbeat.
         """
 
         # sender can be in the format $sysname.$eename when CFG.dashi.sysname
@@ -575,25 +810,63 @@ class ProcessDispatcherCore(object):
             resource.new_last_heartbeat_datetime(timestamp)
             resource_updated = True
 
-        assigned_procs = set()
         processes = beat['processes']
+        sequence = beat.get('sequence')
+        reported = processes
+        prune_assigned = True
+        if sequence is not None and 'base' in beat:
+            reported = self._apply_heartbeat_delta(resource, beat)
+            if reported is None:
+                log.info("Delta heartbeat from %s doesn't match the known "
+                         "state of its processes. Requesting a full heartbeat",
+                         sender)
+                self.eeagent_client.request_heartbeat(sender)
+                processes = []
+                sequence = None
+                prune_assigned = False
+            elif not (processes or beat.get('removed')):
+                # nothing changed since the acknowledged heartbeat
+                prune_assigned = False
+
+        if sequence is not None and \
+                sequence != resource.get('heartbeat_sequence'):
+            resource.heartbeat_sequence = sequence
+            resource.reported = [dict(upid=p['upid'], round=p['round'],
+                state=p['state']) for p in reported]
+            resource_updated = True
+
+        # EEAgents only know processes by upid. look up their owners.
+        owners = self.store.get_process_owners(
+            procstate['upid'] for procstate in processes)
+
+        # read all of the processes the beat and the resource refer to at
+        # once. processes changed below are dropped, to be read again.
+        process_ids = set(_get_process_id(owners, procstate['upid'])
+                          for procstate in processes)
+        if prune_assigned:
+            process_ids.update((owner, upid)
+                for owner, upid, _ in resource.assigned)
+        known_processes = dict.fromkeys(process_ids)
+        for process in self.store.get_processes(process_ids):
+            known_processes[(process.owner, process.upid)] = process
+
+        assigned_procs = set()
         node_exclusives_to_remove = []
         for procstate in processes:
             upid = procstate['upid']
             round = int(procstate['round'])
-            state = procstate['state']
+            state = get_heartbeat_state(procstate)
 
-            # TODO hack to handle how states are formatted in EEAgent heartbeat
-            if isinstance(state, (list, tuple)):
-                state = "-".join(str(s) for s in state)
-
-            # TODO owner?
-            process = self.store.get_process(None, upid)
+            process_id = _get_process_id(owners, upid)
+            if process_id in known_processes:
+                process = known_processes[process_id]
+            else:
+                process = self.store.get_process(*process_id)
             if not process:
                 log.warn("EE reports process %s that is unknown!", upid)
 
                 if state < ProcessState.TERMINATED:
-                    assigned_procs.add((None, upid, round))
+                    assigned_procs.add(process_id + (round,))
                 else:
                     self.eeagent_client.cleanup_process(sender, upid, round)
 
@@ -615,6 +888,8 @@ class ProcessDispatcherCore(object):
 
                 continue
 
+            known_processes.pop(process_id, None)
+
             if process.state == ProcessState.PENDING and \
                state == ProcessState.RUNNING:
 
@@ -651,18 +926,33 @@ class ProcessDispatcherCore(object):
                 # with the dead process
                 self.eeagent_client.cleanup_process(sender, upid, round)
 
-        new_assigned = []
-        for owner, upid, round in resource.assigned:
-            key = (owner, upid, round)
-            process = self.store.get_process(owner, upid)
-
-            if key in assigned_procs:
-                new_assigned.append(key)
-            # prune process assignments once the process has terminated or
-            # moved onto the next round
-            elif (process and process.round == round
-                 and process.state < ProcessState.TERMINATED):
-                new_assigned.append(key)
+        if sequence is not None and 'base' in beat:
+            # a delta heartbeat only has the unknown processes which changed.
+            # the others the EE still runs keep their assignments too.
+            for procstate in reported:
+                process_id = _get_process_id(owners, procstate['upid'])
+                if (known_processes.get(process_id, True) is None and
+                        get_heartbeat_state(procstate) < ProcessState.TERMINATED):
+                    assigned_procs.add(process_id + (int(procstate['round']),))
+
+        if prune_assigned:
+            new_assigned = []
+            for owner, upid, round in resource.assigned:
+                key = (owner, upid, round)
+                if (owner, upid) in known_processes:
+                    process = known_processes[(owner, upid)]
+                else:
+                    process = self.store.get_process(owner, upid)
+
+                if key in assigned_procs:
+                    new_assigned.append(key)
+                # prune process assignments once the process has terminated or
+                # moved onto the next round
+                elif (process and process.round == round
+                     and process.state < ProcessState.TERMINATED):
+                    new_assigned.append(key)
+        else:
+            new_assigned = resource.assigned
 
         if len(new_assigned) != len(resource.assigned):
             # first update node exclusive tags
@@ -690,7 +980,31 @@ class ProcessDispatcherCore(object):
                 self.store.update_resource(resource)
             except (WriteConflictError, NotFoundError):
                 # TODO? right now this will just wait for the next heartbeat
-                pass
+                return
+
+        if sequence is not None:
+            self.eeagent_client.ack_heartbeat(sender, sequence)
+
+    def _apply_heartbeat_delta(self, resource, beat):
+        """Apply a delta heartbeat to the processes last reported by an EE
+
+        @return the full list of processes the EE reports, or None if the
+            delta doesn't apply
+        """
+        if beat['base'] is None or \
+                beat['base'] != resource.get('heartbeat_sequence'):
+            return None
+
+        reported = dict((p['upid'], p) for p in resource.get('reported') or ())
+        for upid in beat.get('removed') or ():
+            reported.pop(upid, None)
+        for procstate in beat['processes']:
+            reported[procstate['upid']] = procstate
+        reported = reported.values()
+
+        if get_heartbeat_digest(reported) != beat.get('digest'):
+            return None
+        return reported
 
     def process_should_restart(self, process, exit_state, is_system_restart=False):
 
@@ -933,6 +1247,9 @@ class ProcessDispatcherCore(object):
             self.notifier.notify_process(process)
         return process, updated
 
+    def _get_definition_engine_id(self, definition):
+        return self.ee_registry.get_process_definition_engine_id(definition)
+
     def get_process_constraints(self, process):
         """Returns a dict of process constraints
 
@@ -954,27 +1271,116 @@ class ProcessDispatcherCore(object):
         processes = {}
         state = dict(resources=resources, processes=processes, nodes=nodes)
 
-        for resource_id in self.store.get_resource_ids():
-            resource = self.store.get_resource(resource_id)
-            if not resource:
-                continue
-            resources[resource_id] = dict(resource)
+        for resource in self.store.get_resources():
+            resources[resource.resource_id] = dict(resource)
 
-        for owner, upid in self.store.get_process_ids():
-            process = self.store.get_process(owner, upid)
-            if not process:
-                continue
+        for process in self.store.get_processes():
             processes[process.upid] = dict(process)
 
-        for node_id in self.store.get_node_ids():
-            node = self.store.get_node(node_id)
-            if not node:
-                continue
-            nodes[node_id] = dict(node)
+        for node in self.store.get_nodes():
+            nodes[node.node_id] = dict(node)
+
+        if self.matchmaker_stats is not None:
+            state['matchmaker'] = self.matchmaker_stats.summary()
 
         return state
 
 
+class HeartbeatInbox(object):
+    """Feeds EEAgent heartbeats to the core
+
+    Heartbeats are queued per sender and ingested by a bounded pool of
+    workers, so the caller (the message consumer) never waits on the store.
+    Only the newest heartbeat queued for a sender is kept. A full beat
+    reports all of the EEAgent's processes. A delta beat reports the changes
+    since its base, which is a sequence the PD has already applied and
+    acknowledged, as EEAgents only send deltas against acknowledged beats. So
+    the newest beat is never built on an older one still in the queue, and
+    the older ones can be dropped. A sender's heartbeats are ingested one at
+    a time, by one worker.
+
+    With no workers, heartbeats are ingested immediately in the caller's
+    thread.
+    """
+    def __init__(self, core, workers=None):
+        self.core = core
+        self.pool = None
+        if workers:
+            self.pool = tevent.Pool(workers)
+
+        self.lock = threading.Lock()
+
+        # sender -> newest heartbeat waiting to be ingested, or None. A
+        # sender has an entry for as long as a worker is responsible for it.
+        self.pending = {}
+
+        # sender -> heartbeat being ingested
+        self.in_flight = {}
+
+    def heartbeat(self, sender, beat):
+        if self.pool is None:
+            self.core.ee_heartbeat(sender, beat)
+            return
+
+        with self.lock:
+            if sender in self.pending:
+                # a queued beat is never older than the one in flight
+                newest = self.pending[sender] or self.in_flight.get(sender)
+                if newest is None or not _is_older_beat(beat, newest):
+                    self.pending[sender] = beat
+                return
+            self.pending[sender] = beat
+
+        self.pool.spawn(self._deliver, sender)
+
+    def join(self):
+        """Wait for all pending heartbeats to be ingested
+        """
+        if self.pool is not None:
+            self.pool.join()
+
+    def _deliver(self, sender):
+        while True:
+            with self.lock:
+                beat = self.pending[sender]
+                if beat is None:
+                    del self.pending[sender]
+                    self.in_flight.pop(sender, None)
+                    return
+                self.pending[sender] = None
+                self.in_flight[sender] = beat
+
+            self._ingest(sender, beat)
+
+    def _ingest(self, sender, beat):
+        try:
+            self.core.ee_heartbeat(sender, beat)
+        except Exception:
+            log.exception("Problem ingesting heartbeat from %s", sender)
+
+
+def _get_process_id(owners, upid):
+    """Get the (owner, upid) of a process known only by its upid
+
+    @param owners: dict of upid -> owners, from the store's owner index
+    """
+    found = owners.get(upid)
+    if found and len(found) == 1:
+        return found[0], upid
+    # unknown, or ambiguous
+    return None, upid
+
+
+def _is_older_beat(beat, other):
+    """Whether a heartbeat was sent before another one from the same sender
+    """
+    try:
+        return (parse_datetime(beat['timestamp']) <
+                parse_datetime(other['timestamp']))
+    except Exception:
+        return False
+
+
 def get_set_difference_debug_message(set1, set2):
     """Utility function for building log messages about set content changes
     """
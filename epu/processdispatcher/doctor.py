@@ -105,6 +105,10 @@ class PDDoctor(object):
 
     def initialize_pd(self):
 
+        # no worker serves requests before the PD is initialized, so this
+        # is when records left in an older store layout are moved
+        self.store.migrate_layout()
+
         system_boot = self.store.is_system_boot()
 
         # for system boot we clear out all nodes and roll relevant processes
@@ -112,11 +116,7 @@ class PDDoctor(object):
         # we requeue all of these UNSCHEDULED_PENDING processes
         if system_boot:
             # clear out all nodes
-            for node_id in self.store.get_node_ids():
-                node = self.store.get_node(node_id)
-                if node is None:
-                    continue
-
+            for node in self.store.get_nodes():
                 # evacuate the node. Move restartable processes to
                 # UNSCHEDULED_PENDING. They will be restarted after system
                 # boot completes. Move dead processes to TERMINATED.
@@ -125,11 +125,7 @@ class PDDoctor(object):
                     rescheduled_process_state=ProcessState.UNSCHEDULED_PENDING)
 
             # look for any other processes that should be queued after boot
-            for owner, upid in self.store.get_process_ids():
-                process = self.store.get_process(owner, upid)
-                if process is None:
-                    continue
-
+            for process in self.store.get_processes():
                 # these processes were stuck in a transitional state at shutdown
                 if process.state in self._PROCESS_STATES_TO_REQUEUE:
 
@@ -160,11 +156,8 @@ class PDDoctor(object):
 
     def schedule_pending_processes(self):
         log.debug("Checking for UNSCHEDULED_PENDING processes to reschedule")
-        process_ids = self.store.get_process_ids()
-
-        for owner, upid in process_ids:
-            process = self.store.get_process(owner, upid)
-            if process is None or process.state != ProcessState.UNSCHEDULED_PENDING:
+        for process in self.store.get_processes():
+            if process.state != ProcessState.UNSCHEDULED_PENDING:
                 continue
 
             process, updated = self.core.process_change_state(process,
@@ -1,6 +1,8 @@
 import logging
 
 from epu.util import ensure_timedelta
+from epu.processdispatcher.placement import PLACEMENT_POLICIES, \
+    DEFAULT_PLACEMENT_POLICY
 
 log = logging.getLogger(__name__)
 
@@ -52,7 +54,9 @@ class EngineRegistry(object):
                 maximum_vms=engine_conf.get('maximum_vms', None),
                 heartbeat_period=engine_conf.get('heartbeat_period', 30),
                 heartbeat_warning=engine_conf.get('heartbeat_warning'),
-                heartbeat_missing=engine_conf.get('heartbeat_missing'))
+                heartbeat_missing=engine_conf.get('heartbeat_missing'),
+                placement_policy=engine_conf.get('placement_policy',
+                    DEFAULT_PLACEMENT_POLICY))
             registry.add(spec)
 
         if process_engines:
@@ -115,6 +119,34 @@ class EngineRegistry(object):
 
         return None
 
+    def get_matchmaker_shards(self, groups=None):
+        """returns a dict of matchmaker shard name -> set of engine ids
+
+        Each shard is matched by its own matchmaker, under its own election.
+        groups is a dict of shard name -> engine ids. Engines not in any group
+        get a shard to themselves, named after the engine.
+        """
+        shards = {}
+        grouped = set()
+        for shard, engine_ids in (groups or {}).iteritems():
+            for engine_id in engine_ids:
+                if engine_id not in self.by_engine:
+                    raise KeyError("engine %s in matchmaker shard %s is unknown" % (
+                        engine_id, shard))
+                if engine_id in grouped:
+                    raise ValueError("engine %s is in more than one matchmaker shard" % (
+                        engine_id,))
+                grouped.add(engine_id)
+            shards[shard] = set(engine_ids)
+
+        for engine_id in self.by_engine:
+            if engine_id not in grouped:
+                if engine_id in shards:
+                    raise ValueError("matchmaker shard %s conflicts with engine of the same name" % (
+                        engine_id,))
+                shards[engine_id] = set([engine_id])
+        return shards
+
 
 _DEFAULT_HEARTBEAT_PERIOD = 30
 
@@ -122,12 +154,18 @@ _DEFAULT_HEARTBEAT_PERIOD = 30
 class EngineSpec(object):
     def __init__(self, engine_id, slots, base_need=0, config=None, replicas=1,
                  spare_slots=0, iaas_allocation=None, maximum_vms=None,
-                 heartbeat_period=30, heartbeat_warning=45, heartbeat_missing=60):
+                 heartbeat_period=30, heartbeat_warning=45, heartbeat_missing=60,
+                 placement_policy=DEFAULT_PLACEMENT_POLICY):
         self.engine_id = engine_id
         self.config = config
         self.base_need = int(base_need)
         self.iaas_allocation = iaas_allocation
 
+        if placement_policy not in PLACEMENT_POLICIES:
+            raise ValueError("placement_policy must be one of: %s" % (
+                ", ".join(sorted(PLACEMENT_POLICIES)),))
+        self.placement_policy = placement_policy
+
         slots = int(slots)
         if slots < 1:
             raise ValueError("slots must be a positive integer")
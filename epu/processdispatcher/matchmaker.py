@@ -1,16 +1,23 @@
+import heapq
 import logging
 import threading
 import time
+from itertools import count
 from math import ceil
+from bisect import bisect_left, insort
 from copy import deepcopy
-from collections import defaultdict
+from collections import defaultdict, Counter
 from operator import attrgetter
 
+import epu.tevent as tevent
 from epu.exceptions import WriteConflictError, NotFoundError
 from epu.states import ProcessState, ProcessDispatcherState, ExecutionResourceState
 from epu.processdispatcher.modes import QueueingMode
 from epu.processdispatcher.engines import domain_id_from_engine
 from epu.processdispatcher.util import get_process_state_message
+from epu.processdispatcher.stats import MatchmakerStats, InstrumentedStore
+from epu.processdispatcher.placement import get_placement_policy, \
+    DEFAULT_PLACEMENT_POLICY
 
 log = logging.getLogger(__name__)
 
@@ -31,20 +38,37 @@ class PDMatchmaker(object):
     resource. The other node will be blank. If you start four more processes,
     they will slot onto the already-occupied node and the second node will
     still be empty. A ninth process will finally spill onto the second node.
+
+    That is the default "pack" placement policy. Engines can instead be
+    configured to "spread" processes across nodes or to place them on the
+    least recently used ("lru") node. See epu.processdispatcher.placement.
+
+    Matchmaking can be sharded by engine. A sharded matchmaker holds its own
+    election and only sees queued processes and resources for the engines
+    in its shard, so several PD workers can matchmake disjoint engines at
+    the same time.
     """
 
     def __init__(self, core, store, resource_client, ee_registry, epum_client,
                  notifier, service_name, domain_definition_id,
-                 base_domain_config, run_type, restart_throttling_config):
+                 base_domain_config, run_type, restart_throttling_config,
+                 dispatch_workers=None, stats=None, shard=None,
+                 engine_ids=None, batch_window=None):
         """
         @type core: ProcessDispatcherCore
         @type store: ProcessDispatcherStore
         @type resource_client: EEAgentClient
         @type ee_registry: EngineRegistry
         @type notifier: SubscriberNotifier
+        @type stats: MatchmakerStats
+        @param shard: name of the matchmaker shard, or None if unsharded
+        @param engine_ids: engines matched by this shard. all if None
+        @param batch_window: minimum seconds between matchmaking cycles, so
+            bursts of notifications are folded into a single cycle
         """
         self.core = core
-        self.store = store
+        self.stats = stats or MatchmakerStats()
+        self.store = InstrumentedStore(store, self.stats)
         self.resource_client = resource_client
         self.ee_registry = ee_registry
         self.epum_client = epum_client
@@ -55,11 +79,33 @@ class PDMatchmaker(object):
         self.run_type = run_type
         self._cached_pd_state = None
         self.restart_throttling_config = restart_throttling_config
+        self.minimum_time_between_starts = _get_minimum_time_between_starts(
+            restart_throttling_config)
+        self.dispatch_workers = dispatch_workers
+        self.outbox = None
+        self.batch_window = float(batch_window or 0)
+
+        self.shard = shard
+        self.engine_ids = None
+        if engine_ids is not None:
+            self.engine_ids = frozenset(engine_ids)
+        self.shard_process_engines = None
+        self.foreign_resources = None
+        self.constraint_predicates = None
 
         self.resources = None
+        self.assignments = None
+        self.available_nodes = None
+        self.property_index = None
+        self.need_counts = None
         self.queued_processes = None
+        self.process_queue = None
+        self.process_cache = None
+        self.changed_processes = None
         self.stale_processes = None
         self.throttled_processes = None
+        self.throttle_heap = None
+        self.throttle_intervals = None
         self.unscheduled_pending_processes = []
 
         self.condition = threading.Condition()
@@ -72,7 +118,7 @@ class PDMatchmaker(object):
 
     def start_election(self):
         """Initiates participation in the leader election"""
-        self.store.contend_matchmaker(self)
+        self.store.contend_matchmaker(self, shard=self.shard)
 
     def inaugurate(self):
         """Callback from the election fired when this leader is elected
@@ -86,27 +132,46 @@ class PDMatchmaker(object):
         self.is_leader = True
 
         self.initialize()
-        self.run()
+        try:
+            self.run()
+        finally:
+            # launches still in the outbox have already been committed
+            # to the store, so they must go out even though we are done.
+            self.outbox.join()
 
     def initialize(self):
 
+        self.outbox = DispatchOutbox(self.resource_client, self.dispatch_workers)
         self.resources = {}
+        self.assignments = {}
+        self.available_nodes = SortedNodeContainers(self._get_placement_policy)
+        self.property_index = self.available_nodes.property_index
+        self.need_counts = NeedCounts()
         self.queued_processes = []
-        self.stale_processes = []
-        self.throttled_processes = []
+        self.process_queue = ProcessQueue()
+        self.process_cache = {}
+        self.stale_processes = set()
+        self.throttled_processes = {}
+        self.throttle_heap = []
+        self.throttle_intervals = {}
+        self.shard_process_engines = {}
+        self.foreign_resources = set()
+        self.constraint_predicates = {}
 
         self.resource_set_changed = True
         self.changed_resources = set()
+        self.changed_processes = set()
         self.process_set_changed = True
 
         self.needs_matchmaking = True
 
         self.registered_needs = {}
+        self.unscheduled_pending_processes = []
         self._get_pending_processes()
 
         # create the domains if they don't already exist
         if self.epum_client:
-            for engine in list(self.ee_registry):
+            for engine in self._shard_engines():
 
                 if not self.domain_definition_id:
                     raise Exception("domain definition must be provided")
@@ -127,27 +192,109 @@ class PDMatchmaker(object):
     def queued_processes_by_engine(self, engine_id):
         procs = []
         for p in self.queued_processes:
-            proc = self.store.get_process(p[0], p[1])
-            if proc and proc.constraints.get('engine') == engine_id:
-                procs.append(proc)
-            elif engine_id == self.ee_registry.default and not proc.constraints.get('engine'):
+            proc = self._get_process(p[0], p[1])
+            if not proc:
+                continue
+            if self._get_process_engine_id(proc) == engine_id:
                 procs.append(proc)
         return procs
 
-    def pending_processes_by_engine(self, engine_id):
-        procs = []
-        for proc in self.unscheduled_pending_processes:
-            if proc and proc.constraints.get('engine') == engine_id:
-                procs.append(proc)
-            elif engine_id == self.ee_registry.default and not proc.constraints.get('engine'):
-                procs.append(proc)
-        return procs
+    def _get_process_engine_id(self, process):
+        engine_id = process.constraints.get('engine')
+        if isinstance(engine_id, (list, tuple)):
+            # a process which may run on several engines is counted towards
+            # the need of the first of them
+            engine_id = engine_id[0] if engine_id else None
+        return engine_id or self.ee_registry.default
+
+    def _get_placement_policy(self, engine_id):
+        try:
+            engine = self.ee_registry.get_engine_by_id(engine_id)
+        except KeyError:
+            return get_placement_policy(DEFAULT_PLACEMENT_POLICY)
+        return get_placement_policy(engine.placement_policy)
+
+    def _shard_engines(self):
+        """Engines this matchmaker is responsible for
+        """
+        if self.engine_ids is None:
+            return list(self.ee_registry)
+        return [engine for engine in self.ee_registry
+                if engine.engine_id in self.engine_ids]
+
+    def _process_in_shard(self, process):
+        if self.engine_ids is None:
+            return True
+        engine_id = self._get_constraint_predicate(process).constraints.get('engine')
+        if engine_id is None:
+            # a constraint of None matches any engine. the process belongs to
+            # the shard of the engine it is mapped to, or of the default one
+            engine_id = (self.ee_registry.get_process_definition_engine_id(
+                process.definition) or self.ee_registry.default)
+        return self._engine_in_shard(engine_id)
+
+    def _engine_in_shard(self, engine_id):
+        """Whether an engine constraint or property value is in this shard
+
+        Values may be a single engine id or a list of them.
+        """
+        if isinstance(engine_id, (list, tuple)):
+            return any(e in self.engine_ids for e in engine_id)
+        return engine_id in self.engine_ids
+
+    def _get_constraint_predicate(self, process):
+        """Get the compiled constraints of a process
+
+        Predicates are cached by the process definition and constraint
+        content, since many processes usually share them.
+        """
+        key = _constraint_predicate_key(process, self.ee_registry)
+        if key is not None:
+            predicate = self.constraint_predicates.get(key)
+            if predicate is not None:
+                return predicate
+
+        predicate = ConstraintPredicate(self.core.get_process_constraints(process))
+        if key is not None:
+            if len(self.constraint_predicates) >= _MAX_CACHED_PREDICATES:
+                self.constraint_predicates.clear()
+            self.constraint_predicates[key] = predicate
+        return predicate
+
+    def _resource_in_shard(self, resource):
+        if self.engine_ids is None:
+            return True
+        engine_id = (resource.properties or {}).get('engine')
+        if engine_id is None:
+            engine_id = self.ee_registry.default
+        return self._engine_in_shard(engine_id)
+
+    def _filter_shard_processes(self, processes):
+        """Narrow queued process entries down to those in this shard
+
+        A process is checked against the shard once, when it first shows up
+        in the queue.
+        """
+        in_shard = self.shard_process_engines
+        queued = set()
+        shard_processes = []
+        for entry in processes:
+            key = entry[:2]
+            queued.add(key)
+            if key not in in_shard:
+                process = self._get_process(*key)
+                if process is None:
+                    continue
+                in_shard[key] = self._process_in_shard(process)
+                if not in_shard[key]:
+                    self.process_cache.pop(key, None)
+            if in_shard[key]:
+                shard_processes.append(entry)
 
-    def resources_by_engine(self, engine_id):
-        filtered = {rid: r
-                for rid, r in self.resources.iteritems()
-                  if r and r.properties.get('engine') == engine_id}
-        return filtered
+        for key in in_shard.keys():
+            if key not in queued:
+                del in_shard[key]
+        return shard_processes
 
     def engine(self, engine_id):
         return self.ee_registry.get_engine_by_id(engine_id)
@@ -182,12 +329,47 @@ class PDMatchmaker(object):
         return config
 
     def _find_assigned_resource(self, owner, upid, round):
-        # could speedup with cache
-        for resource in self.resources.itervalues():
-            if resource.is_assigned(owner, upid, round):
-                return resource
+        resource_id = self.assignments.get((owner, upid, round))
+        if resource_id is None:
+            return None
+
+        resource = self.resources.get(resource_id)
+        if resource and resource.is_assigned(owner, upid, round):
+            return resource
         return None
 
+    def _add_resource(self, resource):
+        """Track a resource record, replacing any previous copy
+
+        Keeps the assignment index and available nodes in sync with the
+        resource
+        """
+        resource_id = resource.resource_id
+        previous = self.resources.get(resource_id)
+        if previous is not None:
+            self._unindex_assignments(previous)
+
+        self.resources[resource_id] = resource
+        for key in resource.assigned:
+            self.assignments[tuple(key)] = resource_id
+
+        self.available_nodes.update_resource(resource)
+        self.need_counts.set_resource(resource)
+
+    def _remove_resource(self, resource_id):
+        resource = self.resources.pop(resource_id, None)
+        if resource is not None:
+            self._unindex_assignments(resource)
+        self.available_nodes.remove_resource(resource_id)
+        self.need_counts.remove_resource(resource_id)
+
+    def _unindex_assignments(self, resource):
+        resource_id = resource.resource_id
+        for key in resource.assigned:
+            key = tuple(key)
+            if self.assignments.get(key) == resource_id:
+                del self.assignments[key]
+
     def _notify_resource_set_changed(self, *args):
         with self.condition:
             self.resource_set_changed = True
@@ -203,6 +385,42 @@ class PDMatchmaker(object):
             self.changed_resources.add(resource_id)
             self.condition.notifyAll()
 
+    def _notify_process_changed(self, owner, upid, *args):
+        # only invalidates the cached record, the matchmaker doesn't need
+        # to wake up for this.
+        with self.condition:
+            self.changed_processes.add((owner, upid))
+
+    def _get_process(self, owner, upid):
+        """Get a process record, from the local cache if possible
+
+        Cached records are watched and dropped when they change in the store.
+        They may still be briefly out of date, which is caught by the version
+        check when the record is written.
+        """
+        if self.changed_processes:
+            with self.condition:
+                changed = self.changed_processes.copy()
+                self.changed_processes.clear()
+            for key in changed:
+                self.process_cache.pop(key, None)
+
+        process = self.process_cache.get((owner, upid))
+        if process is None:
+            process = self._refresh_process(owner, upid)
+        return process
+
+    def _refresh_process(self, owner, upid):
+        """Fetch a process record from the store, updating the cache
+        """
+        process = self.store.get_process(owner, upid,
+                                         watcher=self._notify_process_changed)
+        if process is None:
+            self.process_cache.pop((owner, upid), None)
+        else:
+            self.process_cache[(owner, upid)] = process
+        return process
+
     def _get_pd_state(self):
         if self._cached_pd_state != ProcessDispatcherState.OK:
             self._cached_pd_state = self.store.get_pd_state()
@@ -218,65 +436,126 @@ class PDMatchmaker(object):
                 # for processes
                 return
 
-            process_ids = self.store.get_process_ids()
-            for process_id in process_ids:
-                process = self.store.get_process(process_id[0], process_id[1])
-                if process.state == ProcessState.UNSCHEDULED_PENDING:
+            for process in self.store.get_processes():
+                if (process.state == ProcessState.UNSCHEDULED_PENDING and
+                        self._process_in_shard(process)):
                     self.unscheduled_pending_processes.append(process)
+
+            self.need_counts.set_pending(
+                (self._get_process_engine_id(process), (process.owner, process.upid))
+                for process in self.unscheduled_pending_processes)
+
         elif self.unscheduled_pending_processes:
             self.unscheduled_pending_processes = []
+            self.need_counts.set_pending(())
 
     def _get_queued_processes(self):
         self.process_set_changed = False
         processes = self.store.get_queued_processes(
             watcher=self._notify_process_set_changed)
+        if self.engine_ids is not None:
+            processes = self._filter_shard_processes(processes)
 
-        #TODO not really caring about priority or queue order
-        # at this point
+        # the store only keeps queued processes in arrival order. they are
+        # ordered for matchmaking by the process queue.
 
         if processes != self.queued_processes:
             log.debug("Queued process list has changed")
+            previous = Counter(self.queued_processes)
+            current = Counter(processes)
             self.queued_processes = processes
             self.needs_matchmaking = True
 
+            # only queued processes are worth caching
+            queued = set((owner, upid) for owner, upid, _ in processes)
+            for key in self.process_cache.keys():
+                if key not in queued:
+                    del self.process_cache[key]
+
+            # fold the queue changes into the process queue and need counts
+            for entry, n in (previous - current).iteritems():
+                if entry not in current:
+                    self._forget_queued_process(entry)
+                for _ in range(n):
+                    self.need_counts.remove_queued(entry)
+            added = current - previous
+            for entry in processes:
+                n = added.pop(entry, 0)
+                if not n:
+                    continue
+                process = self._get_process(entry[0], entry[1])
+                engine_id = None
+                priority = 0
+                if process:
+                    engine_id = self._get_process_engine_id(process)
+                    priority = process.get('priority') or 0
+                self.process_queue.add(entry, priority)
+                for _ in range(n):
+                    self.need_counts.add_queued(entry, engine_id)
+
     def _get_resource_set(self):
         self.resource_set_changed = False
         resource_ids = set(self.store.get_resource_ids(
             watcher=self._notify_resource_set_changed))
 
         previous = set(self.resources.keys())
+        previous.update(self.foreign_resources)
 
         added = resource_ids - previous
         removed = previous - resource_ids
 
-        # resource removal doesn't need to trigger matchmaking
-        if added:
-            self._dump_stale_processes()
-            self.needs_matchmaking = True
-
         for resource_id in removed:
-            del self.resources[resource_id]
+            self.foreign_resources.discard(resource_id)
+            self._remove_resource(resource_id)
 
+        # resource removal doesn't need to trigger matchmaking. resources
+        # outside of this shard are remembered but not tracked.
+        added_resources = False
         for resource_id in added:
             resource = self.store.get_resource(resource_id,
                                                watcher=self._notify_resource_changed)
-            self.resources[resource_id] = resource
+            if not resource:
+                continue
+            if self._resource_in_shard(resource):
+                self._add_resource(resource)
+                added_resources = True
+            else:
+                self.foreign_resources.add(resource_id)
+
+        if added_resources:
+            self._dump_stale_processes()
+            self.needs_matchmaking = True
 
     def _get_resources(self):
         with self.condition:
             changed = self.changed_resources.copy()
             self.changed_resources.clear()
+        changed -= self.foreign_resources
 
-        if changed:
-            self._dump_stale_processes()
-            self.needs_matchmaking = True
-
+        # most resource changes are heartbeats. the new record must be kept
+        # for its version, but only changes which affect scheduling warrant
+        # another matchmaking cycle.
+        affected = False
+        ignored = 0
         for resource_id in changed:
             resource = self.store.get_resource(resource_id,
                                                watcher=self._notify_resource_changed)
-            #TODO fold in assignment vector in some fancy way?
+            previous = self.resources.get(resource_id)
             if resource:
-                self.resources[resource_id] = resource
+                self._add_resource(resource)
+            if previous is None and resource is None:
+                continue
+            if (previous is None or resource is None or
+                    _resource_affects_scheduling(previous, resource)):
+                affected = True
+            else:
+                ignored += 1
+
+        if ignored:
+            self.stats.incr("ignored_resource_changes", ignored)
+        if affected:
+            self._dump_stale_processes()
+            self.needs_matchmaking = True
 
     def cancel(self):
         log.info("Stopping matchmaker")
@@ -288,19 +567,26 @@ class PDMatchmaker(object):
     def run(self):
         log.info("Elected as matchmaker!")
 
+        stats = self.stats
         while self.is_leader:
+            cycle_start = time.time()
+
             # first fold in any changes to queued processes and available resources
 
             if self.process_set_changed:
-                self._get_queued_processes()
+                with stats.time("get_queued_processes"):
+                    self._get_queued_processes()
 
             if self.resource_set_changed:
-                self._get_resource_set()
+                with stats.time("get_resource_set"):
+                    self._get_resource_set()
 
             if self.changed_resources:
-                self._get_resources()
+                with stats.time("get_resources"):
+                    self._get_resources()
 
-            self._check_throttled_processes()
+            with stats.time("check_throttled_processes"):
+                self._check_throttled_processes()
 
             # check again if we lost leadership
             if not self.is_leader:
@@ -308,12 +594,16 @@ class PDMatchmaker(object):
 
             # now do a matchmaking cycle if anything changed enough to warrant
             if self.needs_matchmaking:
-                self.matchmake()
+                with stats.time("matchmake"):
+                    self.matchmake()
 
             # only update needs if matchmaking round was successful
             # (and that is enabled)
             if not self.needs_matchmaking and self.epum_client:
-                self.register_needs()
+                with stats.time("register_needs"):
+                    self.register_needs()
+
+            stats.record("cycle", time.time() - cycle_start)
 
             with self.condition:
                 if self.is_leader and not (self.resource_set_changed or
@@ -322,22 +612,54 @@ class PDMatchmaker(object):
                     if timeout > 0 or timeout is None:
                         self.condition.wait(timeout)
 
+            # let a burst of notifications accumulate so it is folded into
+            # a single cycle
+            if self.batch_window:
+                self._wait_until(cycle_start + self.batch_window)
+
+    def _wait_until(self, deadline):
+        """Wait until a deadline, or until leadership is lost
+        """
+        with self.condition:
+            while self.is_leader:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                self.condition.wait(remaining)
+
     def matchmake(self):
         node_containers = self.get_available_resources()
         log.debug("Matchmaking. Processes: %d  Available nodes: %d",
                   len(self.queued_processes), len(node_containers))
 
-        fresh_processes = self._get_fresh_processes()
-
-        for owner, upid, round in list(fresh_processes):
-            try:
-                self._matchmake_process(owner, upid, round, node_containers)
-
-            except (WriteConflictError, NotFoundError):
-                # some write conflict errors are allowed to bubble up,
-                # meaning we should bail out of matchmaking loop and
-                # let outer loop update data and retry
-                return
+        # fresh processes are popped off the queue in order. stale ones
+        # aren't in the queue until resources change.
+        process_queue = self.process_queue
+        tried = []
+        try:
+            while True:
+                entry = process_queue.pop()
+                if entry is None:
+                    break
+                tried.append(entry)
+                owner, upid, round = entry
+                try:
+                    self._matchmake_process(owner, upid, round, node_containers)
+
+                except (WriteConflictError, NotFoundError):
+                    # some write conflict errors are allowed to bubble up,
+                    # meaning we should bail out of matchmaking loop and
+                    # let outer loop update data and retry. The cached process
+                    # record may have been modified but not written, drop it.
+                    self.process_cache.pop((owner, upid), None)
+                    return
+        finally:
+            # processes still queued which weren't found stale are tried
+            # again next time
+            for entry in tried:
+                if not (entry in self.stale_processes or
+                        entry in self.throttled_processes):
+                    process_queue.push(entry)
 
         # if we made it through all processes, we don't need to matchmake
         # again until new information arrives
@@ -346,14 +668,15 @@ class PDMatchmaker(object):
     def _matchmake_process(self, owner, upid, round, node_containers):
         log.debug("Matching process %s", upid)
 
-        process = self.store.get_process(owner, upid)
+        process = self._get_process(owner, upid)
         if not (process and process.round == round and
                 process.state < ProcessState.PENDING):
             self._remove_queued_process(owner, upid, round)
             return
 
-        if self._throttle_end_time(process) > time.time():
-            self._throttle_process(process)
+        throttle_end_time = self._throttle_end_time(process)
+        if throttle_end_time > time.time():
+            self._throttle_process(process, throttle_end_time)
             return
 
         # ensure process is not already assigned a slot
@@ -378,70 +701,98 @@ class PDMatchmaker(object):
         self._mark_process_stale((owner, upid, round))
 
     def _handle_matched_process(self, process, matched_resource, node_containers):
-        # update the resource record
-        if not matched_resource.is_assigned(process.owner, process.upid, process.round):
-            matched_resource.assigned.append((process.owner, process.upid, process.round))
-        try:
-            self.store.update_resource(matched_resource)
-        except (WriteConflictError, NotFoundError):
-            log.info("Conflict error updating resource. will retry.")
-
-            # in case of write conflict, bail out of the matchmaker
-            # run and the outer loop will take care of updating data
-            # and trying again
-            raise
+        key = process.key
+        newly_assigned = not matched_resource.is_assigned(*key)
+        if newly_assigned:
+            matched_resource.assigned.append(key)
 
         matched_node = None
+        added_tag = None
         if process.node_exclusive:
             matched_node = self.store.get_node(matched_resource.node_id)
             if matched_node is None:
                 log.error("Couldn't find node %s to update node_exclusive",
                         matched_resource.node_id)
             else:
-                self.core.node_add_exclusive_tags(matched_node, [process.node_exclusive])
-
-        # attempt to also update the process record and mark it as pending.
-        # If the process has since been terminated, this update will fail.
-        # In that case we must back out the resource record update we just
-        # made.
-        process, assigned = self._maybe_update_assigned_process(
-            process, matched_resource)
-
-        if assigned:
-            #TODO: move this to a separate operation that MM submits to queue?
+                tag = str(process.node_exclusive)
+                if tag not in matched_node.node_exclusive:
+                    matched_node.node_exclusive.append(tag)
+                    added_tag = tag
+
+        # the resource, process and node records are updated together. If
+        # the process record changed out of band it is re-read and the
+        # transaction rebuilt, for as long as the process still needs a
+        # slot. Other conflicts mean nothing is written.
+        while True:
+            self._prepare_assigned_process(process, matched_resource)
+            transaction = self.store.transaction()
+            transaction.update_resource(matched_resource)
+            transaction.update_process(process)
+            if added_tag:
+                transaction.update_node(matched_node)
             try:
-                self._dispatch_process(process, matched_resource)
-            except Exception:
-                #TODO: this is not a good failure behavior
-                log.exception("Problem dispatching process from matchmaker")
+                transaction.commit()
+                break
+            except (WriteConflictError, NotFoundError):
+                version = process.metadata.get('version')
+                process = self._refresh_process(process.owner, process.upid)
+                if process is None or process.metadata.get('version') != version:
+                    if (process and process.round == key[2] and
+                            process.state < ProcessState.PENDING):
+                        log.debug("Conflict error updating process. will retry.")
+                        continue
+
+                    # the process moved on out of band (for example it was
+                    # terminated) and no longer needs the slot
+                    log.debug("failed to assign process. it moved to %s out of band",
+                        process.state if process else "removed")
+                    self._undo_assignment(key, matched_resource,
+                        newly_assigned, matched_node, added_tag)
+                    self._remove_queued_process(*key)
+                    return
+
+                log.info("Conflict error assigning process. will retry.")
+                self._undo_assignment(key, matched_resource, newly_assigned,
+                    matched_node, added_tag)
+
+                # in case of write conflict, bail out of the matchmaker
+                # run. the resource is re-read and matching retried
+                # without waiting for another change.
+                with self.condition:
+                    self.changed_resources.add(matched_resource.resource_id)
+                raise
+
+        self.assignments[key] = matched_resource.resource_id
+        log.info(get_process_state_message(process))
+        self.notifier.notify_process(process)
 
-        else:
-            # backout resource record update if the process update failed due to
-            # 3rd party changes to the process.
-            log.debug("failed to assign process. it moved to %s out of band",
-                process.state)
-            matched_resource, removed = self._backout_resource_assignment(
-                matched_resource, process)
+        try:
+            self._dispatch_process(process, matched_resource)
+        except Exception:
+            #TODO: this is not a good failure behavior
+            log.exception("Problem dispatching process from matchmaker")
 
-            if process.node_exclusive:
-                self.core.node_remove_exclusive_tags(matched_node,
-                    [process.node_exclusive])
-
-        # update modified resource's node container and prune it out
-        # if the node has no more available slots
-        for i, node_container in enumerate(node_containers):
-            if matched_resource.node_id == node_container.node_id:
-                node_container.update()
-                if matched_node:
-                    node_container.update_node(matched_node)
-                if not node_container.available_slots:
-                    node_containers.pop(i)
-                break  # there can only be one match
+        # update modified resource's node container. It is resorted, or
+        # pruned out if the node has no more available slots
+        self._add_resource(matched_resource)
+        if matched_node:
+            node_containers.cache_node(matched_node)
 
         self._remove_queued_process(process.owner, process.upid, process.round)
 
+    def _undo_assignment(self, key, resource, newly_assigned, node, added_tag):
+        """Back out local record changes of an assignment that wasn't written
+        """
+        if newly_assigned:
+            resource.assigned.remove(key)
+        if added_tag:
+            node.node_exclusive.remove(added_tag)
+
     def _dispatch_process(self, process, resource):
         """Launch the process on a resource
+
+        The launch message is handed to the outbox and may be sent after
+        this returns.
         """
         definition = process.definition
         executable = definition['executable']
@@ -460,50 +811,19 @@ class PDMatchmaker(object):
             log.warning(msg)
             parameters = {}
 
-        self.resource_client.launch_process(
+        self.outbox.launch_process(
             resource.resource_id, process.upid, process.round,
             self.run_type, parameters)
 
-    def _maybe_update_assigned_process(self, process, resource):
-        updated = False
-        while process.state < ProcessState.PENDING:
-            process.assigned = resource.resource_id
-            process.state = ProcessState.PENDING
-            process.increment_dispatches()
-
-            # pull hostname directly onto process record, if available.
-            # it is commonly desired information and this saves the need to
-            # make multiple queries to get it.
-            process.hostname = resource.properties.get('hostname')
-
-            try:
-                self.store.update_process(process)
-                updated = True
-
-                log.info(get_process_state_message(process))
-
-            except WriteConflictError:
-                process = self.store.get_process(process.owner, process.upid)
+    def _prepare_assigned_process(self, process, resource):
+        process.assigned = resource.resource_id
+        process.state = ProcessState.PENDING
+        process.increment_dispatches()
 
-        if updated:
-            self.notifier.notify_process(process)
-
-        return process, updated
-
-    def _backout_resource_assignment(self, resource, process):
-        removed = False
-        pkey = process.key
-        while resource and pkey in resource.assigned:
-            resource.assigned.remove(pkey)
-            try:
-                self.store.update_resource(resource)
-                removed = True
-            except WriteConflictError:
-                resource = self.store.get_resource(resource.resource_id)
-            except NotFoundError:
-                resource = None
-
-        return resource, removed
+        # pull hostname directly onto process record, if available.
+        # it is commonly desired information and this saves the need to
+        # make multiple queries to get it.
+        process.hostname = resource.properties.get('hostname')
 
     def _remove_queued_process(self, owner, upid, round):
             try:
@@ -511,10 +831,21 @@ class PDMatchmaker(object):
             except NotFoundError:
                 # no problem if some other process removed the queue entry
                 pass
+            entry = (owner, upid, round)
             try:
-                self.queued_processes.remove((owner, upid, round))
+                self.queued_processes.remove(entry)
             except ValueError:
                 pass
+            else:
+                self.need_counts.remove_queued(entry)
+
+            if entry in self.queued_processes:
+                # the process was queued more than once. the duplicate needs
+                # to be matched (and removed) too.
+                self.process_queue.push(entry)
+            else:
+                self._forget_queued_process(entry)
+            self.process_cache.pop((owner, upid), None)
 
     def _mark_process_waiting(self, process):
 
@@ -557,7 +888,7 @@ class PDMatchmaker(object):
                 self.store.update_process(process)
                 updated = True
             except WriteConflictError:
-                process = self.store.get_process(process.owner, process.upid)
+                process = self._refresh_process(process.owner, process.upid)
                 continue
 
         if updated:
@@ -565,39 +896,72 @@ class PDMatchmaker(object):
 
         return process, updated
 
-    def _throttle_process(self, process):
+    def _forget_queued_process(self, entry):
+        """Drop all matchmaking state for a process that has left the queue
+        """
+        self.process_queue.remove(entry)
+        self.stale_processes.discard(entry)
+        self.throttled_processes.pop(entry, None)
+        self.throttle_intervals.pop(entry, None)
+
+    def _throttle_process(self, process, throttle_end_time):
         self._mark_process_waiting(process)
-        self.throttled_processes.append(process)
+
+        # throttled processes are held out of the process queue until their
+        # throttle ends. the heap is cleaned up lazily.
+        entry = process.key
+        self.throttled_processes[entry] = throttle_end_time
+        heapq.heappush(self.throttle_heap, (throttle_end_time, entry))
+
+    def _next_throttle_end_time(self):
+        heap = self.throttle_heap
+        while heap:
+            throttle_end_time, entry = heap[0]
+            if self.throttled_processes.get(entry) == throttle_end_time:
+                return throttle_end_time
+            heapq.heappop(heap)
+        return None
 
     def _time_until_throttling_ends(self):
-        process_throttle_times = []
-        for process in self.throttled_processes:
-            process_throttle_times.append(self._throttle_end_time(process))
-        try:
-            throttle_end_time = min(process_throttle_times)
-            time_until_throttling_ends = throttle_end_time - time.time()
-            return time_until_throttling_ends
-        except ValueError:
+        throttle_end_time = self._next_throttle_end_time()
+        if throttle_end_time is None:
             return None
+        return throttle_end_time - time.time()
 
     def _check_throttled_processes(self):
-        if self._time_until_throttling_ends() <= 0:
-            self.throttled_processes = []
+        now = time.time()
+        throttle_end_time = self._next_throttle_end_time()
+        while throttle_end_time is not None and throttle_end_time <= now:
+            _, entry = heapq.heappop(self.throttle_heap)
+            del self.throttled_processes[entry]
+            self.process_queue.push(entry)
             self.needs_matchmaking = True
 
-    def _throttle_end_time(self, process):
-        minimum_time_between_starts = None
+            throttle_end_time = self._next_throttle_end_time()
+
+    def _get_throttle_interval(self, process):
+        """Get the minimum time between starts of a process, or None
+
+        Parsed intervals are cached for as long as the process is queued.
+        """
+        entry = process.key
         try:
-            minimum_time_between_starts = float(self.restart_throttling_config['minimum_time_between_starts'])
-        except Exception:
-            # We might still be able to get a config from process config
+            return self.throttle_intervals[entry]
+        except KeyError:
             pass
 
         try:
-            minimum_time_between_starts = float(process.configuration['process']['minimum_time_between_starts'])
+            interval = float(process.configuration['process']['minimum_time_between_starts'])
         except Exception:
             # ignore if we can't get a config for this process
-            pass
+            interval = self.minimum_time_between_starts
+
+        if entry in self.process_queue:
+            self.throttle_intervals[entry] = interval
+        return interval
+
+    def _throttle_end_time(self, process):
+        minimum_time_between_starts = self._get_throttle_interval(process)
 
         # if there isn't a minimum time configured, never throttle
         if minimum_time_between_starts is None:
@@ -611,77 +975,32 @@ class PDMatchmaker(object):
         return last_start + minimum_time_between_starts
 
     def _mark_process_stale(self, process):
-        self.stale_processes.append(process)
+        if process in self.process_queue:
+            self.stale_processes.add(process)
 
     def _dump_stale_processes(self):
-        self.stale_processes = []
-
-    def _get_fresh_processes(self):
-        stale = set(self.stale_processes)
-        fresh_processes = [p for p in self.queued_processes if p not in stale]
-        return fresh_processes
+        for process in self.stale_processes:
+            self.process_queue.push(process)
+        self.stale_processes.clear()
 
     def get_available_resources(self):
         """Select the available execution resources
 
-        Returns a sorted list of NodeContainer objects
+        Returns a sorted collection of NodeContainer objects. It is kept up to
+        date as resources change, so this is cheap to call.
         """
-
-        # first break down available resources by node
-        available_by_node = defaultdict(list)
-        for resource in self.resources.itervalues():
-
-            # only consider OK resources. We definitely don't want to consider
-            # MISSING or DISABLED resources. We could arguably include WARNING
-            # resources, but perhaps at a lower priority than OK.
-
-            if resource.state == ExecutionResourceState.OK and resource.available_slots:
-                node_id = resource.node_id
-                available_by_node[node_id].append(resource)
-
-        # now create NodeResources container objects for each node,
-        # splitting unoccupied nodes off into a separate list
-        unoccupied_node_containers = []
-        node_containers = []
-        for node_id, resources in available_by_node.iteritems():
-            container = NodeContainer(node_id, resources)
-
-            if any(resource.assigned for resource in resources):
-                node_containers.append(container)
-            else:
-                unoccupied_node_containers.append(container)
-
-        # sort the occupied nodes by the aggregate number of available slots
-        node_containers.sort(key=attrgetter('available_slots'))
-
-        # append the unoccupied node lists onto the end
-        node_containers.extend(unoccupied_node_containers)
-        return node_containers
+        # node records may have changed since the last matchmaking cycle
+        self.available_nodes.clear_node_cache()
+        return self.available_nodes
 
     def calculate_need(self, engine_id):
 
-        # track a set of all known processes, both assigned and queued. it
-        # is possible for there to be some brief overlap between assigned
-        # and queued processes, where round N of a process is assigned and
-        # round N+1 is requeued.
-        process_set = set()
-        occupied_node_set = set()
-        node_set = set()
-
-        for process in self.pending_processes_by_engine(engine_id):
-            process_set.add((process.owner, process.upid))
-
-        for process in self.queued_processes_by_engine(engine_id):
-            process_set.add((process.owner, process.upid))
-
-        resources = self.resources_by_engine(engine_id)
-        for resource in resources.itervalues():
-            if resource.assigned:
-                for owner, upid, _ in resource.assigned:
-                    process_set.add((owner, upid))
-                occupied_node_set.add(resource.node_id)
-
-            node_set.add(resource.node_id)
+        # the need counts track all known processes, both assigned and
+        # queued. it is possible for there to be some brief overlap between
+        # assigned and queued processes, where round N of a process is
+        # assigned and round N+1 is requeued.
+        need_counts = self.need_counts
+        occupied_node_count = need_counts.occupied_node_count(engine_id)
 
         # need is the greater of the base need, the number of occupied
         # resources, and the number of instances that could be occupied
@@ -690,28 +1009,28 @@ class PDMatchmaker(object):
 
         # total number of unique runnable processes in the system plus
         # minimum free slots
-        process_count = len(process_set) + engine.spare_slots
+        process_count = need_counts.process_count(engine_id) + engine.spare_slots
 
         process_need = int(ceil(process_count / float(engine.slots * engine.replicas)))
-        need = max(engine.base_need, len(occupied_node_set), process_need)
+        need = max(engine.base_need, occupied_node_count, process_need)
         if engine.maximum_vms is not None:
             need = min(need, engine.maximum_vms)
             log.debug("Engine '%s' need=%d = min(maximum_vms=%d, max(base_need=%d, occupied=%d, process_need=%d))",
-            engine_id, need, engine.maximum_vms, engine.base_need, len(occupied_node_set), process_need)
+            engine_id, need, engine.maximum_vms, engine.base_need, occupied_node_count, process_need)
         else:
             log.debug("Engine '%s' need=%d = max(base_need=%d, occupied=%d, process_need=%d)",
-                engine_id, need, engine.base_need, len(occupied_node_set), process_need)
-        return need, list(node_set - occupied_node_set)
+                engine_id, need, engine.base_need, occupied_node_count, process_need)
+        return need
 
     def register_needs(self):
 
         self._get_pending_processes()
 
-        for engine in list(self.ee_registry):
+        for engine in self._shard_engines():
 
             engine_id = engine.engine_id
 
-            need, unoccupied_nodes = self.calculate_need(engine_id)
+            need = self.calculate_need(engine_id)
             registered_need = self.registered_needs.get(engine_id)
             if need != registered_need:
 
@@ -719,6 +1038,7 @@ class PDMatchmaker(object):
                 # on scale down, request for specific nodes to be terminated
                 if need < registered_need:
 
+                    unoccupied_nodes = self.need_counts.unoccupied_nodes(engine_id)
                     unoccupied_nodes.sort(key=self._node_state_time, reverse=True)
                     retiree_ids = unoccupied_nodes[:registered_need - need]
                     for resource in self.resources.itervalues():
@@ -743,11 +1063,36 @@ class PDMatchmaker(object):
             return 0
 
     def matchmake_process(self, process, node_containers):
-        constraints = self.core.get_process_constraints(process)
+        predicate = self._get_constraint_predicate(process)
+        constraints = predicate.constraints
 
         # node_resources is a list of NodeResources objects. each contains a
-        # sublist of resources.
-        for node_container in node_containers:
+        # sublist of resources. They are kept in placement order per engine,
+        # so only nodes of the process's engine need to be walked.
+        engine_id = constraints.get('engine')
+        if isinstance(engine_id, basestring):
+            engine_containers = node_containers.iter_engine(engine_id)
+            narrow = predicate.has_constraints_besides('engine')
+        else:
+            engine_containers = node_containers
+            narrow = True
+
+        # narrow the search down to resources that advertise properties
+        # which can satisfy the constraints. None means no narrowing.
+        candidates = None
+        if narrow:
+            candidates = self.property_index.candidates(predicate)
+        if candidates is not None:
+            if not candidates:
+                log.debug("No resources advertise properties matching "
+                          "process %s constraints: %s", process.upid, constraints)
+                return None
+            candidate_nodes = self.property_index.get_node_ids(candidates)
+
+        for node_container in engine_containers:
+
+            if candidates is not None and node_container.node_id not in candidate_nodes:
+                continue
 
             # skip ahead by whole nodes if we care about node exclusivity
             if process.node_exclusive:
@@ -756,7 +1101,9 @@ class PDMatchmaker(object):
                 # grab node object out of data store and cache it on the
                 # container
                 if node_container.node is None:
-                    node = node_container.node = self.store.get_node(node_id)
+                    node = self.store.get_node(node_id)
+                    if node:
+                        node_containers.cache_node(node)
                 else:
                     node = node_container.node
 
@@ -771,15 +1118,18 @@ class PDMatchmaker(object):
 
             # now inspect each resource in the node looking for a match
             for resource in node_container.resources:
+                if candidates is not None and resource.resource_id not in candidates:
+                    continue
+
                 logstr = "%s: process %s constraints: %s against resource %s properties: %s"
-                if match_constraints(constraints, resource.properties):
+                if predicate.matches(resource.properties):
                     log.debug(logstr, "MATCH", process.upid, constraints,
                         resource.resource_id, resource.properties)
 
                     return resource
 
                 else:
-                    log.debug(logstr, "NOTMATCH", process.upid, process.constraints,
+                    log.debug(logstr, "NOTMATCH", process.upid, constraints,
                         resource.resource_id, resource.properties)
 
         # no match was found!
@@ -798,28 +1148,435 @@ def match_constraints(constraints, properties):
 
     Simple equality matches for now.
     """
-    if constraints is None:
-        return True
+    return ConstraintPredicate(constraints).matches(properties)
 
-    for key, value in constraints.iteritems():
-        if value is None:
-            continue
 
-        if properties is None:
-            return False
+_MAX_CACHED_PREDICATES = 10000
+
+
+def _constraint_predicate_key(process, ee_registry):
+    """Returns a hashable key for the content of a process's constraints
+
+    Includes the definition's module and class when the registry maps them
+    to engines. Returns None if the constraints can't be hashed.
+    """
+    definition_key = None
+    if ee_registry.process_module_engines:
+        executable = (process.definition or {}).get('executable')
+        if isinstance(executable, dict):
+            definition_key = (executable.get('module'), executable.get('class'))
+
+    constraints = process.constraints
+    if not constraints:
+        return definition_key, None
+    try:
+        return definition_key, frozenset(
+            (key, tuple(value) if isinstance(value, list) else value)
+            for key, value in constraints.iteritems())
+    except TypeError:
+        return None
 
-        advertised = properties.get(key)
-        if advertised is None:
-            return False
 
-        if isinstance(value, (list, tuple)):
-            if not advertised in value:
+class ConstraintPredicate(object):
+    """Process constraints compiled for matching against resources
+
+    Constraints are reduced to (key, allowed values) pairs up front, so
+    matching a resource is a single pass over its properties. Constraints
+    with a value of None are ignored.
+    """
+    def __init__(self, constraints):
+        self.constraints = constraints
+        pairs = []
+        for key, value in (constraints or {}).iteritems():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                values = tuple(value)
+            else:
+                values = (value,)
+            try:
+                allowed = frozenset(values)
+            except TypeError:
+                allowed = values
+            pairs.append((key, values, allowed))
+        self.pairs = tuple(pairs)
+
+    def has_constraints_besides(self, key):
+        for pair in self.pairs:
+            if pair[0] != key:
+                return True
+        return False
+
+    def matches(self, properties):
+        if properties is None:
+            return not self.pairs
+
+        for key, _, allowed in self.pairs:
+            advertised = properties.get(key)
+            if advertised is None:
                 return False
-        else:
-            if advertised != value:
+            try:
+                if advertised not in allowed:
+                    return False
+            except TypeError:
+                # unhashable advertised values can't equal any of the
+                # hashable allowed values
                 return False
+        return True
+
+
+class ProcessQueue(object):
+    """Orders queued processes for matchmaking
+
+    Used only internally by the matchmaker. Processes with a higher priority
+    are matched first. Among processes of equal priority, each owner gets a
+    fair share: processes are tagged with a virtual start time as they are
+    queued (start-time fair queuing), so an owner with thousands of queued
+    processes can't starve everyone else. Each owner's own processes keep
+    their queue order.
+
+    Entries are (owner, upid, round) tuples, kept in a heap. An entry popped
+    off the heap stays queued, and can be pushed back with its original tag.
+    Removal is lazy: removed entries are skipped when they reach the top.
+    """
+    def __init__(self):
+        self.heap = []
+
+        # entry -> (-priority, virtual start, sequence) for queued entries
+        self.tags = {}
+
+        # entries which are currently in the heap
+        self.pushed = set()
+
+        self.owner_finish = {}
+        self.virtual_time = 0
+        self.sequence = count()
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, entry):
+        return entry in self.tags
+
+    def add(self, entry, priority=0):
+        """Queue a new entry
+        """
+        if entry in self.tags:
+            return
+
+        owner = entry[0]
+        start = max(self.virtual_time, self.owner_finish.get(owner, 0))
+        self.owner_finish[owner] = start + 1
+
+        self.tags[entry] = (-priority, start, next(self.sequence))
+        self.push(entry)
+
+    def remove(self, entry):
+        self.tags.pop(entry, None)
+        self.pushed.discard(entry)
+
+    def push(self, entry):
+        """Push a queued entry back onto the heap after it was popped
+        """
+        tag = self.tags.get(entry)
+        if tag is None or entry in self.pushed:
+            return
+        self.pushed.add(entry)
+        heapq.heappush(self.heap, tag + (entry,))
+
+    def pop(self):
+        """Pop the next entry off the heap, or None if there are none
+        """
+        heap = self.heap
+        while heap:
+            item = heapq.heappop(heap)
+            entry = item[-1]
+            if entry not in self.pushed or self.tags.get(entry) != item[:-1]:
+                continue
+
+            self.pushed.discard(entry)
+            self.virtual_time = max(self.virtual_time, item[1])
+            return entry
+        return None
+
+
+class NeedCounts(object):
+    """Per-engine counts that engine needs are calculated from
+
+    Used only internally by the matchmaker. The counts are updated as queue,
+    resource, and pending process changes are folded in, so calculating needs
+    doesn't require walking every process and resource. Processes and nodes
+    are reference counted: a process can briefly be both queued and assigned,
+    and a node can host several resources.
+    """
+    def __init__(self):
+        # engine_id -> {(owner, upid): references}
+        self.processes = defaultdict(dict)
+        # engine_id -> {node_id: resources}
+        self.nodes = defaultdict(dict)
+        # engine_id -> {node_id: resources with assigned processes}
+        self.occupied_nodes = defaultdict(dict)
+
+        # what has been counted, so it can be uncounted later
+        self.resources = {}
+        self.queued = {}
+        self.pending = []
+
+    def process_count(self, engine_id):
+        return len(self.processes.get(engine_id, ()))
+
+    def occupied_node_count(self, engine_id):
+        return len(self.occupied_nodes.get(engine_id, ()))
+
+    def unoccupied_nodes(self, engine_id):
+        occupied = self.occupied_nodes.get(engine_id, ())
+        return [node_id for node_id in self.nodes.get(engine_id, ())
+                if node_id not in occupied]
+
+    def set_resource(self, resource):
+        """Count a resource, replacing any previous count of it
+        """
+        self.remove_resource(resource.resource_id)
+
+        engine_id = (resource.properties or {}).get('engine')
+        if engine_id is None:
+            return
+
+        node_id = resource.node_id
+        keys = [(owner, upid) for owner, upid, _ in resource.assigned]
+        self.resources[resource.resource_id] = engine_id, node_id, keys
+
+        _incref(self.nodes[engine_id], node_id)
+        if keys:
+            _incref(self.occupied_nodes[engine_id], node_id)
+        processes = self.processes[engine_id]
+        for key in keys:
+            _incref(processes, key)
 
-    return True
+    def remove_resource(self, resource_id):
+        counted = self.resources.pop(resource_id, None)
+        if counted is None:
+            return
+
+        engine_id, node_id, keys = counted
+        _decref(self.nodes[engine_id], node_id)
+        if keys:
+            _decref(self.occupied_nodes[engine_id], node_id)
+        processes = self.processes[engine_id]
+        for key in keys:
+            _decref(processes, key)
+
+    def add_queued(self, entry, engine_id):
+        """Count a queued (owner, upid, round) entry
+        """
+        counted = self.queued.get(entry)
+        if counted is None:
+            self.queued[entry] = [engine_id, 1]
+        else:
+            counted[1] += 1
+
+        if engine_id is not None:
+            _incref(self.processes[engine_id], entry[:2])
+
+    def remove_queued(self, entry):
+        counted = self.queued.get(entry)
+        if counted is None:
+            return
+
+        engine_id = counted[0]
+        counted[1] -= 1
+        if not counted[1]:
+            del self.queued[entry]
+
+        if engine_id is not None:
+            _decref(self.processes[engine_id], entry[:2])
+
+    def set_pending(self, pending):
+        """Replace the counted pending processes
+
+        @param pending: iterable of (engine_id, (owner, upid)) tuples
+        """
+        for engine_id, key in self.pending:
+            if engine_id is not None:
+                _decref(self.processes[engine_id], key)
+
+        self.pending = list(pending)
+        for engine_id, key in self.pending:
+            if engine_id is not None:
+                _incref(self.processes[engine_id], key)
+
+
+def _incref(counts, key):
+    counts[key] = counts.get(key, 0) + 1
+
+
+def _decref(counts, key):
+    count = counts.get(key, 0) - 1
+    if count > 0:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
+
+
+class PropertyIndex(object):
+    """Inverted index of execution resource properties
+
+    Used only internally in matchmaking algorithm. Maps each advertised
+    (key, value) property pair to the set of resources advertising it, so the
+    resources that could possibly satisfy a process's constraints can be found
+    without inspecting every resource. Property values which can't be hashed
+    are not indexed; constraints on them are left to match_constraints().
+    """
+    def __init__(self):
+        self.index = defaultdict(set)
+        self.resource_nodes = {}
+        self.resource_pairs = {}
+
+    def add(self, resource):
+        resource_id = resource.resource_id
+        self.resource_nodes[resource_id] = resource.node_id
+        pairs = self.resource_pairs[resource_id] = []
+        if not resource.properties:
+            return
+        for pair in resource.properties.iteritems():
+            try:
+                self.index[pair].add(resource_id)
+            except TypeError:
+                continue
+            pairs.append(pair)
+
+    def remove(self, resource_id):
+        self.resource_nodes.pop(resource_id, None)
+        for pair in self.resource_pairs.pop(resource_id, ()):
+            found = self.index[pair]
+            found.discard(resource_id)
+            if not found:
+                del self.index[pair]
+
+    def get_node_ids(self, resource_ids):
+        """Returns the set of nodes hosting a collection of resources
+        """
+        resource_nodes = self.resource_nodes
+        return set(resource_nodes[resource_id] for resource_id in resource_ids)
+
+    def candidates(self, constraints):
+        """Returns the set of resource IDs which may satisfy constraints
+
+        constraints may be a dict or a ConstraintPredicate. Returns None if
+        the constraints can't be narrowed using the index.
+        """
+        if not isinstance(constraints, ConstraintPredicate):
+            constraints = ConstraintPredicate(constraints)
+
+        candidates = None
+        for key, values, _ in constraints.pairs:
+            matched = set()
+            try:
+                for value in values:
+                    found = self.index.get((key, value))
+                    if found:
+                        matched.update(found)
+            except TypeError:
+                # unhashable constraint value, can't use the index for this key
+                continue
+
+            if candidates is None:
+                candidates = matched
+            else:
+                candidates &= matched
+
+            if not candidates:
+                break
+
+        return candidates
+
+
+class DispatchOutbox(object):
+    """Delivers launch messages to EEAgents on behalf of the matchmaker
+
+    Used only internally by the matchmaker. Launches are queued per resource
+    and sent by a bounded pool of workers, so the matchmaker can keep
+    assigning processes while messages go out. A worker sends all of the
+    launches pending for a resource before moving on, so launches to the same
+    EEAgent are delivered together and in order.
+
+    With no workers, launches are sent immediately in the caller's thread.
+    """
+    def __init__(self, resource_client, workers=None):
+        self.resource_client = resource_client
+        self.pool = None
+        if workers:
+            self.pool = tevent.Pool(workers)
+
+        self.lock = threading.Lock()
+
+        # resource_id -> list of launches waiting to be sent. A resource
+        # has an entry for as long as a worker is responsible for it.
+        self.pending = {}
+
+    def launch_process(self, resource_id, upid, round, run_type, parameters):
+        launch = (upid, round, run_type, parameters)
+        if self.pool is None:
+            self._send(resource_id, [launch])
+            return
+
+        with self.lock:
+            launches = self.pending.get(resource_id)
+            if launches is not None:
+                launches.append(launch)
+                return
+            self.pending[resource_id] = [launch]
+
+        self.pool.spawn(self._deliver, resource_id)
+
+    def join(self):
+        """Wait for all pending launches to be sent
+        """
+        if self.pool is not None:
+            self.pool.join()
+
+    def _deliver(self, resource_id):
+        while True:
+            with self.lock:
+                launches = self.pending[resource_id]
+                if not launches:
+                    del self.pending[resource_id]
+                    return
+                self.pending[resource_id] = []
+
+            self._send(resource_id, launches)
+
+    def _send(self, resource_id, launches):
+        for upid, round, run_type, parameters in launches:
+            try:
+                self.resource_client.launch_process(resource_id, upid, round,
+                    run_type, parameters)
+            except Exception:
+                log.exception("Problem dispatching process %s to %s", upid,
+                              resource_id)
+
+
+_SCHEDULING_RESOURCE_FIELDS = ('state', 'slot_count', 'assigned',
+                               'properties', 'node_id')
+
+
+def _resource_affects_scheduling(previous, resource):
+    """Whether a resource changed in a way that matters to matchmaking
+
+    Heartbeats only touch last_heartbeat, which doesn't.
+    """
+    for field in _SCHEDULING_RESOURCE_FIELDS:
+        if previous.get(field) != resource.get(field):
+            return True
+    return False
+
+
+def _get_minimum_time_between_starts(restart_throttling_config):
+    try:
+        return float(restart_throttling_config['minimum_time_between_starts'])
+    except Exception:
+        # We might still be able to get a config from process config
+        return None
 
 
 def _get_process_config(process):
@@ -848,6 +1605,176 @@ def _get_process_config(process):
     return None
 
 
+class SortedNodeContainers(object):
+    """Ordered collection of NodeContainer objects, one per available node
+
+    Used only internally in matchmaking algorithm. The nodes of each engine
+    are kept in the order the matchmaker should try them, as decided by the
+    engine's placement policy. Iteration goes through the engines in turn.
+
+    The collection persists across matchmaking cycles. Each engine's order is
+    maintained as a bisect-sorted list of keys, so a resource change only
+    costs an update of its own node rather than a rebuild of the whole
+    collection. Resource properties are indexed along the way, and so is the
+    last time each node was assigned a process.
+    """
+    def __init__(self, get_policy=None):
+        self.get_policy = get_policy
+        self.policies = {}
+        self.containers = {}
+        self.keys = {}
+        self.orders = {}
+        self.resource_nodes = {}
+        self.property_index = PropertyIndex()
+        self.cached_nodes = set()
+
+        # usage of all resources, including ones with no available slots.
+        # resource_id -> (node_id, assigned count)
+        self.resource_usage = {}
+        self.node_resources = defaultdict(set)
+        self.last_used = {}
+        self.clock = count(1)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        for engine_id in sorted(self.orders):
+            for container in self.iter_engine(engine_id):
+                yield container
+
+    def iter_engine(self, engine_id):
+        """Iterate over the containers of a single engine
+        """
+        containers = self.containers
+        for key in self.orders.get(engine_id, ()):
+            yield containers[key[-1]]
+
+    def get(self, node_id):
+        return self.containers.get(node_id)
+
+    def update_resource(self, resource):
+        """Add, update, or drop a resource depending on its availability
+        """
+        resource_id = resource.resource_id
+        old_node_id = self._discard(resource_id)
+        self._track_usage(resource)
+
+        # only consider OK resources. We definitely don't want to consider
+        # MISSING or DISABLED resources. We could arguably include WARNING
+        # resources, but perhaps at a lower priority than OK.
+        node_id = resource.node_id
+        if resource.state == ExecutionResourceState.OK and resource.available_slots:
+            container = self.containers.get(node_id)
+            if container is None:
+                container = self.containers[node_id] = NodeContainer(node_id, ())
+                container.engine_id = (resource.properties or {}).get('engine')
+            container.resources.append(resource)
+            self.resource_nodes[resource_id] = node_id
+            self.property_index.add(resource)
+
+        self._update_node(node_id)
+        if old_node_id is not None and old_node_id != node_id:
+            self._update_node(old_node_id)
+
+    def remove_resource(self, resource_id):
+        self._untrack_usage(resource_id)
+        node_id = self._discard(resource_id)
+        if node_id is not None:
+            self._update_node(node_id)
+
+    def cache_node(self, node):
+        """Cache a node record on its container, until clear_node_cache()
+        """
+        container = self.containers.get(node.node_id)
+        if container is not None:
+            container.update_node(node)
+            self.cached_nodes.add(node.node_id)
+
+    def clear_node_cache(self):
+        for node_id in self.cached_nodes:
+            container = self.containers.get(node_id)
+            if container is not None:
+                container.update_node(None)
+        self.cached_nodes.clear()
+
+    def _discard(self, resource_id):
+        node_id = self.resource_nodes.pop(resource_id, None)
+        if node_id is None:
+            return None
+
+        container = self.containers[node_id]
+        container.resources = [r for r in container.resources
+                               if r.resource_id != resource_id]
+        self.property_index.remove(resource_id)
+        return node_id
+
+    def _track_usage(self, resource):
+        """Note when a node is assigned another process
+        """
+        resource_id = resource.resource_id
+        node_id = resource.node_id
+        assigned = len(resource.assigned)
+
+        previous = self.resource_usage.get(resource_id)
+        if previous is not None and previous[0] != node_id:
+            self._untrack_usage(resource_id)
+            previous = None
+
+        if assigned > (previous[1] if previous else 0):
+            self.last_used[node_id] = next(self.clock)
+        self.resource_usage[resource_id] = node_id, assigned
+        self.node_resources[node_id].add(resource_id)
+
+    def _untrack_usage(self, resource_id):
+        usage = self.resource_usage.pop(resource_id, None)
+        if usage is None:
+            return
+        node_id = usage[0]
+        node_resources = self.node_resources[node_id]
+        node_resources.discard(resource_id)
+        if not node_resources:
+            del self.node_resources[node_id]
+            self.last_used.pop(node_id, None)
+
+    def _get_policy(self, engine_id):
+        policy = self.policies.get(engine_id)
+        if policy is None:
+            if self.get_policy is None:
+                policy = get_placement_policy(DEFAULT_PLACEMENT_POLICY)
+            else:
+                policy = self.get_policy(engine_id)
+            self.policies[engine_id] = policy
+        return policy
+
+    def _update_node(self, node_id):
+        previous = self.keys.pop(node_id, None)
+        if previous is not None:
+            engine_id, key = previous
+            order = self.orders[engine_id]
+            del order[bisect_left(order, key)]
+            if not order:
+                del self.orders[engine_id]
+
+        container = self.containers.get(node_id)
+        if container is None:
+            return
+        if not container.resources:
+            del self.containers[node_id]
+            self.cached_nodes.discard(node_id)
+            return
+
+        container.update()
+        engine_id = container.engine_id
+        policy = self._get_policy(engine_id)
+        key = policy.node_key(container, self.last_used.get(node_id, 0)) + (node_id,)
+        self.keys[node_id] = engine_id, key
+        order = self.orders.get(engine_id)
+        if order is None:
+            order = self.orders[engine_id] = []
+        insort(order, key)
+
+
 class NodeContainer(object):
     """Represents the execution resources on a single node (VM)
 
@@ -862,6 +1789,7 @@ class NodeContainer(object):
         self.node_id = node_id
         self.resources = list(resources)
         self.node = None
+        self.engine_id = None
 
         # sort the resource list to begin with
         self.update()
@@ -870,6 +1798,10 @@ class NodeContainer(object):
     def available_slots(self):
         return sum(r.available_slots for r in self.resources)
 
+    @property
+    def occupied(self):
+        return any(r.assigned for r in self.resources)
+
     def update(self):
         """Ensure the resource set is sorted and available
 
@@ -0,0 +1,72 @@
+"""Placement policies decide which node the matchmaker tries first
+
+Each engine has a placement policy. The matchmaker keeps the available nodes
+of each engine sorted by the key its policy gives them, so picking a node is
+a matter of taking the first one that satisfies the process. Keys are
+recalculated only when a node's resources change.
+"""
+
+
+class PlacementPolicy(object):
+
+    name = None
+
+    def node_key(self, container, last_used):
+        """Returns the sort key of a node. Lower keys are tried first
+
+        @param container: NodeContainer with the node's available resources
+        @param last_used: sequence number of the last assignment to the node,
+            0 if it was never assigned a process
+        """
+        raise NotImplementedError()
+
+
+class PackPlacement(PlacementPolicy):
+    """Fill up occupied nodes, fullest first, before starting on empty ones
+
+    Keeps processes on as few nodes as possible, so idle nodes can be
+    retired sooner.
+    """
+
+    name = "pack"
+
+    def node_key(self, container, last_used):
+        if container.occupied:
+            return 0, container.available_slots
+        return 1, 0
+
+
+class SpreadPlacement(PlacementPolicy):
+    """Place processes on the nodes with the most available slots first
+
+    Spreads load across nodes to avoid hot spots.
+    """
+
+    name = "spread"
+
+    def node_key(self, container, last_used):
+        return -container.available_slots,
+
+
+class LeastRecentlyUsedPlacement(PlacementPolicy):
+    """Place processes on the node which least recently got one
+    """
+
+    name = "lru"
+
+    def node_key(self, container, last_used):
+        return last_used,
+
+
+PLACEMENT_POLICIES = dict((policy.name, policy) for policy in
+    (PackPlacement, SpreadPlacement, LeastRecentlyUsedPlacement))
+
+DEFAULT_PLACEMENT_POLICY = PackPlacement.name
+
+
+def get_placement_policy(name):
+    try:
+        policy_class = PLACEMENT_POLICIES[name]
+    except KeyError:
+        raise ValueError("unknown placement policy '%s'" % (name,))
+    return policy_class()
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from epu.exceptions import WriteConflictError
+
+try:
+    from statsd import StatsClient
+except ImportError:
+    StatsClient = None
+
+log = logging.getLogger(__name__)
+
+_DEFAULT_WINDOW = 100
+
+_STORE_READ_PREFIXES = ("get_", "is_", "list_")
+_STORE_WRITE_PREFIXES = ("add_", "update_", "remove_", "enqueue_", "set_")
+
+
+class MatchmakerStats(object):
+    """Timings and counters for the matchmaker loop
+
+    Each phase keeps a rolling window of its most recent durations, which is
+    summarized for ProcessDispatcherCore.dump(). When a statsd configuration
+    is provided, timings and counters are also submitted to statsd.
+    """
+
+    def __init__(self, statsd_cfg=None, window=_DEFAULT_WINDOW,
+                 prefix="pd.matchmaker"):
+        self.window = window
+        self.prefix = prefix
+        self.phases = {}
+        self.phase_counts = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+
+        self.statsd_client = None
+        if statsd_cfg is not None:
+            try:
+                host = statsd_cfg["host"]
+                port = statsd_cfg["port"]
+                log.info("Setting up statsd client with host %s and port %d" % (host, port))
+                self.statsd_client = StatsClient(host, port)
+            except Exception:
+                log.exception("Failed to set up statsd client")
+
+    @contextmanager
+    def time(self, phase):
+        """Context manager which records the duration of a phase
+        """
+        before = time.time()
+        try:
+            yield
+        finally:
+            self.record(phase, time.time() - before)
+
+    def record(self, phase, duration):
+        """Record a duration (in seconds) for a phase
+        """
+        with self.lock:
+            durations = self.phases.get(phase)
+            if durations is None:
+                durations = self.phases[phase] = deque(maxlen=self.window)
+            durations.append(duration)
+            self.phase_counts[phase] += 1
+
+        if self.statsd_client is not None:
+            try:
+                self.statsd_client.timing("%s.%s.timing" % (self.prefix, phase),
+                    duration * 1000)
+            except Exception:
+                log.exception("Failed to submit metrics")
+
+    def incr(self, counter, count=1):
+        with self.lock:
+            self.counters[counter] += count
+
+        if self.statsd_client is not None:
+            try:
+                self.statsd_client.incr("%s.%s" % (self.prefix, counter), count)
+            except Exception:
+                log.exception("Failed to submit metrics")
+
+    def summary(self):
+        """Summarize recent phase timings (in milliseconds) and all counters
+        """
+        with self.lock:
+            phases = {}
+            for phase, durations in self.phases.iteritems():
+                durations = sorted(durations)
+                if not durations:
+                    continue
+                p95 = durations[int(round((len(durations) - 1) * 0.95))]
+                phases[phase] = dict(count=self.phase_counts[phase],
+                    window=len(durations),
+                    mean=sum(durations) / len(durations) * 1000,
+                    p95=p95 * 1000, max=durations[-1] * 1000)
+            return dict(phases=phases, counters=dict(self.counters))
+
+
+class InstrumentedStore(object):
+    """Wraps a store and counts reads, writes and write conflicts
+
+    Only data access methods are counted. Everything else (elections,
+    watches, shutdown) passes straight through.
+    """
+
+    def __init__(self, store, stats):
+        self.store = store
+        self.stats = stats
+
+    def __getattr__(self, name):
+        attr = getattr(self.store, name)
+        if name == "transaction":
+            stats = self.stats
+
+            def instrumented_transaction():
+                return InstrumentedTransaction(attr(), stats)
+            return instrumented_transaction
+
+        if name.startswith(_STORE_READ_PREFIXES):
+            counter = "store_reads"
+        elif name.startswith(_STORE_WRITE_PREFIXES):
+            counter = "store_writes"
+        else:
+            return attr
+
+        stats = self.stats
+
+        def instrumented(*args, **kwargs):
+            stats.incr(counter)
+            try:
+                return attr(*args, **kwargs)
+            except WriteConflictError:
+                stats.incr("write_conflicts")
+                raise
+        return instrumented
+
+
+class InstrumentedTransaction(object):
+    """Wraps a store transaction and counts its commit as one store write
+    """
+
+    def __init__(self, transaction, stats):
+        self.transaction = transaction
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.transaction, name)
+
+    def commit(self):
+        self.stats.incr("store_writes")
+        try:
+            return self.transaction.commit()
+        except WriteConflictError:
+            self.stats.incr("write_conflicts")
+            raise
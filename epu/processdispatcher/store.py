@@ -1,3 +1,4 @@
+from bisect import bisect_right
 from functools import partial
 import simplejson as json
 import logging
@@ -5,10 +6,16 @@ import time
 import re
 import threading
 import copy
+import zlib
+import base64
+import hashlib
+import urllib
+from collections import deque
 
 from kazoo.client import KazooClient, KazooState
 from kazoo.exceptions import NodeExistsException, BadVersionException, \
-    NoNodeException
+    NoNodeException, KazooException, RolledBackError
+from kazoo.protocol.states import EventType
 
 import epu.tevent as tevent
 from epu.exceptions import NotFoundError, WriteConflictError
@@ -18,6 +25,166 @@ from epu.util import parse_datetime
 
 log = logging.getLogger(__name__)
 
+_PROCESS_ID_RE = re.compile(r'^owner=(.+)&upid=(.+)$')
+_PROCESS_ID_NO_OWNER_RE = re.compile(r'^upid=(.+)$')
+
+# queue entries of the bucketed layout are sequenced by a stamp and the
+# sequence number of their bucket, as in "+<stamp>-<seq>"
+_QUEUED_PROCESS_RE = re.compile(r'^owner=(.+)&upid=(.+)&round=([0-9]+)\+([0-9]+(?:-[0-9]+)?)$')
+_QUEUED_PROCESS_NO_OWNER_RE = re.compile(r'^upid=(.+)&round=([0-9]+)\+([0-9]+(?:-[0-9]+)?)$')
+
+# process records and queue entries are spread over buckets, named by a hash
+# prefix of the process id, so that no single znode has all of them as
+# children
+BUCKETS = tuple("%02x" % i for i in range(256))
+_BUCKET_SET = frozenset(BUCKETS)
+
+# schema of encoded process records. records without a schema embed their
+# definition and are stored as plain JSON
+PROCESS_SCHEMA_VERSION = 2
+
+# encoded process configurations larger than this are compressed
+COMPRESS_CONFIGURATION_SIZE = 4096
+
+# number of start and dispatch times kept in process records
+PROCESS_TIME_HISTORY = 10
+
+# fields of process records kept in secondary indexes, so that processes can
+# be looked up by them without reading every record
+PROCESS_INDEXES = ("state", "engine", "assigned")
+
+# the assigned index has an entry only for processes assigned to a resource
+_ASSIGNED_INDEX = "assigned"
+
+
+def get_bucket(name):
+    """Bucket of a node, from its name
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return BUCKETS[zlib.crc32(name) & 0xff]
+
+
+def get_process_index_values(process, engine_resolver=None):
+    """Values of a process record in each of the process indexes
+
+    The engine is the one the process is constrained to, which may be a list
+    of engines. Processes constrained to none have the engine engine_resolver
+    maps their definition to, or None.
+    """
+    constraints = process.get('constraints') or {}
+    engine = constraints.get('engine')
+    if engine is None and engine_resolver is not None:
+        engine = engine_resolver(process.get('definition') or {})
+    return dict(state=process.get('state'), engine=engine,
+                assigned=process.get('assigned'))
+
+
+def _is_index_entry(index, value):
+    """Whether a process with a value in an index has an entry in it
+    """
+    return value is not None or index != _ASSIGNED_INDEX
+
+
+def get_process_index_entries(index, value):
+    """Values a process with a value in an index has entries under
+
+    A process constrained to a list of engines has an entry under each one.
+    """
+    if isinstance(value, (list, tuple)):
+        return set(value)
+    if _is_index_entry(index, value):
+        return set([value])
+    return set()
+
+
+def _encode_index_value(value):
+    # index values are used as node names. None is "-" and other values are
+    # quoted after a "="
+    if value is None:
+        return "-"
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return "=" + urllib.quote(str(value), safe="")
+
+
+def _decode_index_value(name):
+    if name == "-":
+        return None
+    return urllib.unquote(name[1:]).decode('utf-8')
+
+
+def encode_definition(definition):
+    """Encode a process definition snapshot
+
+    @return (digest, data) tuple. the digest identifies the definition content
+    """
+    data = json.dumps(definition, sort_keys=True)
+    return hashlib.sha1(data).hexdigest(), data
+
+
+def encode_process(process):
+    """Encode a process record compactly
+
+    The definition is replaced with a reference to a snapshot of it, holding
+    its id, version and digest. Start and dispatch times are trimmed to the
+    last PROCESS_TIME_HISTORY entries and large configurations are
+    compressed.
+
+    @return (data, definition) tuple, where definition is the (digest, data)
+        snapshot to be stored, or None if the process has no definition
+    """
+    d = dict(process)
+    d['schema'] = PROCESS_SCHEMA_VERSION
+
+    definition = d.pop('definition', None)
+    snapshot = None
+    if definition is not None:
+        snapshot = encode_definition(definition)
+        d['definition_ref'] = dict(definition_id=definition.get('definition_id'),
+            version=definition.get('version'), digest=snapshot[0])
+
+    for key in ('start_times', 'dispatch_times'):
+        if d.get(key):
+            d[key] = d[key][-PROCESS_TIME_HISTORY:]
+
+    if d.get('configuration'):
+        configuration = json.dumps(d['configuration'])
+        if len(configuration) > COMPRESS_CONFIGURATION_SIZE:
+            del d['configuration']
+            d['configuration_zlib'] = base64.b64encode(zlib.compress(configuration))
+
+    return json.dumps(d), snapshot
+
+
+def decode_process(data, get_definition):
+    """Decode a process record encoded by encode_process()
+
+    Records without a schema are decoded as plain JSON.
+
+    @param get_definition: callable returning the definition snapshot data
+        for a digest
+    """
+    rawdict = json.loads(data)
+    schema = rawdict.pop('schema', None)
+    if schema is None:
+        return ProcessRecord(rawdict)
+    if schema > PROCESS_SCHEMA_VERSION:
+        raise ValueError("process record schema %s is not supported" % schema)
+
+    definition_ref = rawdict.pop('definition_ref', None)
+    if definition_ref is None:
+        rawdict['definition'] = None
+    else:
+        rawdict['definition'] = json.loads(get_definition(definition_ref['digest']))
+
+    configuration = rawdict.pop('configuration_zlib', None)
+    if configuration is not None:
+        rawdict['configuration'] = json.loads(
+            zlib.decompress(base64.b64decode(configuration)))
+
+    return ProcessRecord(rawdict)
+
 
 def get_processdispatcher_store(config, use_gevent=False):
     """Instantiate PD store object for the given configuration
@@ -25,11 +192,14 @@ def get_processdispatcher_store(config, use_gevent=False):
     if zkutil.is_zookeeper_enabled(config):
         zookeeper = zkutil.get_zookeeper_config(config)
 
-        log.info("Using ZooKeeper ProcessDispatcher store")
-        store = ProcessDispatcherZooKeeperStore(zookeeper['hosts'],
-                                                zookeeper['path'],
-                                                zookeeper.get('timeout'),
-                                                use_gevent=use_gevent)
+        if zookeeper.get('read_cache'):
+            log.info("Using cached ZooKeeper ProcessDispatcher store")
+            store_class = CachedProcessDispatcherZooKeeperStore
+        else:
+            log.info("Using ZooKeeper ProcessDispatcher store")
+            store_class = ProcessDispatcherZooKeeperStore
+        store = store_class(zookeeper['hosts'], zookeeper['path'],
+                            zookeeper.get('timeout'), use_gevent=use_gevent)
 
     else:
         log.info("Using in-memory ProcessDispatcher store")
@@ -38,6 +208,37 @@ def get_processdispatcher_store(config, use_gevent=False):
     return store
 
 
+class StoreTransaction(object):
+    """Record updates which are committed together, all or nothing
+
+    Updates are versioned, as with update_process(), update_resource() and
+    update_node() without force. commit() raises a WriteConflictError or
+    NotFoundError if any update fails, in which case none are made. When
+    the commit succeeds, the versions of all records are updated.
+    """
+
+    def __init__(self, commit):
+        self._commit = commit
+        self.processes = []
+        self.resources = []
+        self.nodes = []
+
+    def update_process(self, process):
+        self.processes.append(process)
+
+    def update_resource(self, resource):
+        self.resources.append(resource)
+
+    def update_node(self, node):
+        self.nodes.append(node)
+
+    def commit(self):
+        for record in self.processes + self.resources + self.nodes:
+            if record.metadata.get('version') is None:
+                raise ValueError("record has no version")
+        self._commit(self)
+
+
 class ProcessDispatcherStore(object):
     """
     This store is responsible for persistence of several types of records.
@@ -61,6 +262,15 @@ class ProcessDispatcherStore(object):
         self.processes = {}
         self.process_watches = {}
 
+        # upid -> owners of the processes with that upid
+        self.process_owners = {}
+
+        # index -> value -> ids of the processes with that value, and
+        # process id -> its values in each index
+        self.process_index = dict((index, {}) for index in PROCESS_INDEXES)
+        self.process_index_values = {}
+        self.process_engine_resolver = None
+
         self.queued_processes = []
         self.queued_process_set_watches = []
 
@@ -72,9 +282,9 @@ class ProcessDispatcherStore(object):
         self.node_set_watches = []
         self.node_watches = {}
 
-        self._matchmaker = None
-        self._matchmaker_thread = None
-        self.is_matchmaker = False
+        # shard -> matchmaker. the unsharded matchmaker is under None
+        self._matchmakers = {}
+        self._matchmaker_threads = {}
 
         self._doctor = None
         self._doctor_thread = None
@@ -83,21 +293,24 @@ class ProcessDispatcherStore(object):
     def initialize(self):
         pass
 
-    def contend_matchmaker(self, matchmaker):
+    def contend_matchmaker(self, matchmaker, shard=None):
         """Provide a matchmaker object to participate in an election
+
+        Each shard holds its own election, so matchmakers for different
+        shards can lead at the same time.
         """
-        assert self._matchmaker is None
-        self._matchmaker = matchmaker
+        assert shard not in self._matchmakers
+        self._matchmakers[shard] = matchmaker
 
         # since this is in-memory store, we are the only possible matchmaker
-        self._make_matchmaker()
+        self._make_matchmaker(shard)
 
-    def _make_matchmaker(self):
-        assert self._matchmaker
-        assert not self.is_matchmaker
-        self.is_matchmaker = True
+    def _make_matchmaker(self, shard):
+        assert shard in self._matchmakers
+        assert shard not in self._matchmaker_threads
 
-        self._matchmaker_thread = tevent.spawn(self._matchmaker.inaugurate)
+        self._matchmaker_threads[shard] = tevent.spawn(
+            self._matchmakers[shard].inaugurate)
 
     def contend_doctor(self, doctor):
         """Provide a doctor object to participate in an election
@@ -117,11 +330,11 @@ class ProcessDispatcherStore(object):
 
     def shutdown(self):
         # In-memory store, only stop the leaders
-        try:
-            if self._matchmaker:
-                self._matchmaker.cancel()
-        except Exception, e:
-            log.exception("Error cancelling matchmaker: %s", e)
+        for matchmaker in self._matchmakers.values():
+            try:
+                matchmaker.cancel()
+            except Exception, e:
+                log.exception("Error cancelling matchmaker: %s", e)
         try:
             if self._doctor:
                 self._doctor.cancel()
@@ -129,13 +342,13 @@ class ProcessDispatcherStore(object):
             log.exception("Error cancelling matchmaker: %s", e)
         if self._doctor_thread:
             self._doctor_thread.join()
-        if self._matchmaker_thread:
-            self._matchmaker_thread.join()
+        for matchmaker_thread in self._matchmaker_threads.values():
+            matchmaker_thread.join()
 
         self._doctor = None
         self.is_doctor = False
-        self._matchmaker = None
-        self.is_matchmaker = False
+        self._matchmakers.clear()
+        self._matchmaker_threads.clear()
 
         self._is_initialized.clear()
 
@@ -260,6 +473,16 @@ class ProcessDispatcherStore(object):
     # PROCESSES
     #########################################################################
 
+    def set_process_engine_resolver(self, resolver):
+        """Set how processes constrained to no engine are indexed by engine
+
+        All stores sharing records must use the same resolver.
+
+        @param resolver: callable taking a process definition and returning
+            the id of the engine it is mapped to, or None
+        """
+        self.process_engine_resolver = resolver
+
     def add_process(self, process):
         """Adds a new process record to the store
 
@@ -273,6 +496,8 @@ class ProcessDispatcherStore(object):
 
             data = json.dumps(process)
             self.processes[key] = data, 0
+            self.process_owners.setdefault(process.upid, []).append(process.owner)
+            self._index_process(key, process)
             process.metadata['version'] = 0
 
     def update_process(self, process, force=False):
@@ -308,6 +533,7 @@ class ProcessDispatcherStore(object):
             # pushing to JSON to prevent side effects of shared objects
             data = json.dumps(process)
             self.processes[key] = data, version + 1
+            self._index_process(key, process)
             process.metadata['version'] = version + 1
 
             self._fire_process_watchers(process.owner, process.upid)
@@ -347,12 +573,168 @@ class ProcessDispatcherStore(object):
                 raise NotFoundError()
             del self.processes[key]
 
+            owners = self.process_owners[upid]
+            owners.remove(owner)
+            if not owners:
+                del self.process_owners[upid]
+            self._index_process(key)
+
+            self._fire_process_watchers(owner, upid)
+
+    def get_process_owners(self, upids):
+        """Look up the owners of processes by upid
+
+        @param upids: sequence of upids
+        @return dict of upid -> list of the owners of processes with that
+            upid. upids of no process are left out
+        """
+        with self.lock:
+            return dict((upid, list(self.process_owners[upid]))
+                        for upid in upids if upid in self.process_owners)
+
+    def list_process_index_values(self, index):
+        """List the values of a process index
+
+        @param index: one of PROCESS_INDEXES
+        @return list of the values of processes in the index
+        """
+        if index not in PROCESS_INDEXES:
+            raise ValueError("unknown process index %s" % index)
+        with self.lock:
+            return self.process_index[index].keys()
+
+    def get_indexed_process_ids(self, index, values):
+        """Retrieve the IDs of processes by their values in an index
+
+        @param index: one of PROCESS_INDEXES
+        @param values: sequence of index values
+        @return list of (owner, upid) tuples of processes with any of values
+        """
+        if index not in PROCESS_INDEXES:
+            raise ValueError("unknown process index %s" % index)
+        with self.lock:
+            process_ids = set()
+            for value in values:
+                process_ids.update(self.process_index[index].get(value, ()))
+            return list(process_ids)
+
+    def find_process_ids(self, index_values=None, owner=None, after=None,
+                         limit=None):
+        """Find the IDs of processes by their index values and owner
+
+        IDs are found in (owner, upid) order.
+
+        @param index_values: dict of index -> sequence of values. processes
+            must have one of the values in each index
+        @param owner: only processes of this owner, if not None
+        @param after: (owner, upid) of a process. only IDs after it are found
+        @param limit: maximum number of IDs, all if None
+        @return list of (owner, upid) tuples
+        """
+        with self.lock:
+            process_ids = None
+            for index, values in (index_values or {}).iteritems():
+                if index not in PROCESS_INDEXES:
+                    raise ValueError("unknown process index %s" % index)
+                matching = set()
+                for value in values:
+                    matching.update(self.process_index[index].get(value, ()))
+                if process_ids is None:
+                    process_ids = matching
+                else:
+                    process_ids &= matching
+            if process_ids is None:
+                process_ids = self.processes.keys()
+
+        if owner:
+            process_ids = [process_id for process_id in process_ids
+                           if process_id[0] == owner]
+        process_ids = sorted(process_ids)
+        if after is not None:
+            process_ids = process_ids[bisect_right(process_ids, tuple(after)):]
+        if limit is not None:
+            process_ids = process_ids[:limit]
+        return process_ids
+
     def get_process_ids(self):
         """Retrieve available process IDs
         """
         with self.lock:
             return self.processes.keys()
 
+    def get_processes(self, process_ids=None):
+        """Retrieve several process records at once
+
+        @param process_ids: sequence of (owner, upid) tuples. all if None
+        @return list of process records. missing records are skipped
+        """
+        with self.lock:
+            if process_ids is None:
+                process_ids = self.processes.keys()
+            return self._get_records(self.processes, process_ids, ProcessRecord)
+
+    def transaction(self):
+        """Start a transaction of record updates. See StoreTransaction
+        """
+        return StoreTransaction(self._commit_transaction)
+
+    def _commit_transaction(self, transaction):
+        with self.lock:
+            # check everything before writing anything
+            for records, stored, get_key in (
+                    (transaction.processes, self.processes,
+                     lambda process: (process.owner, process.upid)),
+                    (transaction.resources, self.resources,
+                     lambda resource: resource.resource_id),
+                    (transaction.nodes, self.nodes, lambda node: node.node_id)):
+                for record in records:
+                    found = stored.get(get_key(record))
+                    if found is None:
+                        raise NotFoundError()
+                    if record.metadata['version'] != found[1]:
+                        raise WriteConflictError("version mismatch. " +
+                            "current=%s, attempted to write %s" %
+                            (found[1], record.metadata['version']))
+
+            for process in transaction.processes:
+                self.update_process(process)
+            for resource in transaction.resources:
+                self.update_resource(resource)
+            for node in transaction.nodes:
+                self.update_node(node)
+
+    def _get_records(self, records, keys, record_class):
+        # expected to be called under lock
+        found_records = []
+        for key in keys:
+            found = records.get(key)
+            if found is None:
+                continue
+            record = record_class(json.loads(found[0]))
+            record.metadata['version'] = found[1]
+            found_records.append(record)
+        return found_records
+
+    def _index_process(self, key, process=None):
+        # expected to be called under lock. a process of None is unindexed
+        values = self.process_index_values.pop(key, None)
+        if values is not None:
+            for index, value in values.iteritems():
+                for entry in get_process_index_entries(index, value):
+                    process_ids = self.process_index[index][entry]
+                    process_ids.discard(key)
+                    if not process_ids:
+                        del self.process_index[index][entry]
+
+        if process is not None:
+            values = get_process_index_values(process,
+                self.process_engine_resolver)
+            for index, value in values.iteritems():
+                for entry in get_process_index_entries(index, value):
+                    self.process_index[index].setdefault(entry,
+                        set()).add(key)
+            self.process_index_values[key] = values
+
     def _fire_process_watchers(self, owner, upid):
         # expected to be called under lock
         watchers = self.process_watches.get((owner, upid))
@@ -378,6 +760,15 @@ class ProcessDispatcherStore(object):
             self.queued_processes.append(key)
             self._fire_queued_process_set_watchers()
 
+    def enqueue_processes(self, keys):
+        """Mark several processes as runnable, in order, in one batch
+
+        @param keys: sequence of (owner, upid, round) tuples
+        """
+        with self.lock:
+            self.queued_processes.extend(tuple(key) for key in keys)
+            self._fire_queued_process_set_watchers()
+
     def _fire_queued_process_set_watchers(self):
     # expected to be called under lock
         if self.queued_process_set_watches:
@@ -418,6 +809,15 @@ class ProcessDispatcherStore(object):
             self.queued_processes[:] = []
             self._fire_queued_process_set_watchers()
 
+    #########################################################################
+    # LAYOUT
+    #########################################################################
+
+    def migrate_layout(self):
+        """Move records stored in the layout of earlier releases
+        """
+        # records only live in memory, so there is never anything to move
+
     #########################################################################
     # NODES
     #########################################################################
@@ -522,6 +922,17 @@ class ProcessDispatcherStore(object):
                 self.node_set_watches.append(watcher)
             return self.nodes.keys()
 
+    def get_nodes(self, node_ids=None):
+        """Retrieve several node records at once
+
+        @param node_ids: sequence of node IDs. all if None
+        @return list of node records. missing records are skipped
+        """
+        with self.lock:
+            if node_ids is None:
+                node_ids = self.nodes.keys()
+            return self._get_records(self.nodes, node_ids, NodeRecord)
+
     #########################################################################
     # EXECUTION RESOURCES
     #########################################################################
@@ -627,6 +1038,18 @@ class ProcessDispatcherStore(object):
                 self.resource_set_watches.append(watcher)
             return self.resources.keys()
 
+    def get_resources(self, resource_ids=None):
+        """Retrieve several resource records at once
+
+        @param resource_ids: sequence of resource IDs. all if None
+        @return list of resource records. missing records are skipped
+        """
+        with self.lock:
+            if resource_ids is None:
+                resource_ids = self.resources.keys()
+            return self._get_records(self.resources, resource_ids,
+                ResourceRecord)
+
 
 class ProcessDispatcherZooKeeperStore(object):
     """
@@ -653,17 +1076,58 @@ class ProcessDispatcherZooKeeperStore(object):
 
     PROCESSES_PATH = "/processes"
 
+    # index of process owners, by upid
+    PROCESS_OWNERS_PATH = "/process_owners"
+
+    # secondary indexes of process records, as
+    # /process_index/<index>/<value>/<bucket>/<process name>. Resources come
+    # and go, so the assigned index is kept in a fixed set of buckets instead,
+    # as /process_index/assigned/<bucket of value>/<value>&<process name>
+    PROCESS_INDEX_PATH = "/process_index"
+
+    # created once the processes stored before there were process indexes
+    # have been indexed
+    PROCESS_INDEX_BUILT_PATH = "/process_index_built"
+
     DEFINITIONS_PATH = "/definitions"
 
     QUEUED_PROCESSES_PATH = "/requested"
 
+    # holds the stamp of the newest queue entry. Queue entries are created
+    # in transactions which advance it, so stamps follow commit order
+    # across all stores.
+    QUEUE_COUNTER_PATH = "/queue_counter"
+
+    # stamps start past the range of ZooKeeper sequence numbers, which
+    # entries migrated from the flat queue are stamped with
+    QUEUE_COUNTER_START = 2 ** 31
+
     RESOURCES_PATH = "/resources"
 
+    # immutable snapshots of the definitions of process records, by digest
+    DEFINITION_SNAPSHOTS_PATH = "/definition_snapshots"
+
     # these paths is used for leader election. PD workers line up for
     # an exclusive lock on leadership.
     MATCHMAKER_ELECTION_PATH = "/elections/matchmaker"
     DOCTOR_ELECTION_PATH = "/elections/doctor"
 
+    # sharded matchmakers each hold an election under this path
+    MATCHMAKER_SHARD_ELECTIONS_PATH = "/elections/matchmaker_shards"
+
+    # maximum number of processes enqueued in a single transaction
+    ENQUEUE_BATCH_SIZE = 500
+
+    # maximum number of reads in flight during bulk record reads
+    READ_WINDOW = 100
+
+    # number of buckets listed at a time when finding process IDs
+    FIND_BUCKETS = 16
+
+    # maximum number of records moved in a single transaction when migrating
+    # from the flat layout
+    MIGRATE_BATCH_SIZE = 20
+
     def __init__(self, hosts, base_path, username=None, password=None,
                  timeout=None, use_gevent=False):
 
@@ -671,7 +1135,6 @@ class ProcessDispatcherZooKeeperStore(object):
                                          timeout=timeout, use_gevent=use_gevent)
         self.kazoo = KazooClient(hosts + base_path, **kwargs)
         self.retry = zkutil.get_kazoo_retry()
-        self.matchmaker_election = self.kazoo.Election(self.MATCHMAKER_ELECTION_PATH)
         self.doctor_election = self.kazoo.Election(self.DOCTOR_ELECTION_PATH)
 
         # callback fired when the connection state changes
@@ -683,22 +1146,74 @@ class ProcessDispatcherZooKeeperStore(object):
         self._shutdown = False
         self._election_enabled = False
         self._election_condition = threading.Condition()
-        self._matchmaker_election_thread = None
         self._doctor_election_thread = None
 
-        self._matchmaker = None
+        # shard -> matchmaker, election and election thread. the unsharded
+        # matchmaker is under None
+        self._matchmakers = {}
+        self._matchmaker_elections = {}
+        self._matchmaker_election_threads = {}
         self._doctor = None
 
+        # cache of the queue, kept fresh by a children watch on each bucket.
+        # maps buckets to {node name: (seq, (owner, upid, round))} and keys
+        # to queue node paths, so the queue can be read and entries removed
+        # without listing it. Names of entries removed by this store are
+        # kept by bucket until a listing of the bucket no longer has them.
+        self._queued_lock = threading.Lock()
+        self._queued_buckets = {}
+        self._queued_paths = {}
+        self._queued_removed = {}
+        self._queued_process_set_watches = []
+
+        # last known (stamp, version) of the queue counter, or None
+        self._queue_counter = None
+
+        # definition snapshots never change, so they are cached for good
+        self._definition_snapshots = {}
+
+        # parents of process index entries which are known to exist. they
+        # are never removed
+        self._process_index_paths = set()
+
+        # maps the definitions of processes constrained to no engine to one,
+        # for the engine index
+        self.process_engine_resolver = None
+
     def initialize(self):
         self._shutdown = False
         self.kazoo.start()
 
         for path in (self.NODES_PATH, self.PROCESSES_PATH,
-                     self.DEFINITIONS_PATH, self.QUEUED_PROCESSES_PATH,
-                     self.RESOURCES_PATH, self.MATCHMAKER_ELECTION_PATH,
+                     self.PROCESS_OWNERS_PATH, self.DEFINITIONS_PATH, self.QUEUED_PROCESSES_PATH,
+                     self.RESOURCES_PATH, self.DEFINITION_SNAPSHOTS_PATH,
+                     self.MATCHMAKER_ELECTION_PATH,
+                     self.MATCHMAKER_SHARD_ELECTIONS_PATH,
                      self.DOCTOR_ELECTION_PATH, self.PARTY_PATH):
             self.retry(self.kazoo.ensure_path, path)
 
+        for index in PROCESS_INDEXES:
+            self.retry(self.kazoo.ensure_path,
+                self.PROCESS_INDEX_PATH + "/" + index)
+        assigned_path = self.PROCESS_INDEX_PATH + "/" + _ASSIGNED_INDEX
+        self._ensure_buckets(assigned_path)
+        self._process_index_paths.update(assigned_path + "/" + bucket
+            for bucket in BUCKETS)
+
+        try:
+            self.retry(self.kazoo.create, self.QUEUE_COUNTER_PATH,
+                str(self.QUEUE_COUNTER_START))
+        except NodeExistsException:
+            pass
+
+        for path in (self.PROCESSES_PATH, self.PROCESS_OWNERS_PATH,
+                     self.QUEUED_PROCESSES_PATH):
+            self._ensure_buckets(path)
+
+        for bucket in BUCKETS:
+            self.kazoo.ChildrenWatch(self._make_queue_bucket_path(bucket),
+                partial(self._queued_processes_watcher, bucket))
+
         # the Process Dispatcher is in the UNINITIALIZED state until
         # one or both of the following conditions is true:
         # 1. The /initialized flag is set (ephemeral node exists). This
@@ -723,6 +1238,48 @@ class ProcessDispatcherZooKeeperStore(object):
                 self.INITIALIZED_PATH, self._initialized_watcher,
                 allow_missing_node=True)
 
+    def _ensure_buckets(self, path):
+        existing = set(self.retry(self.kazoo.get_children, path))
+        for bucket in BUCKETS:
+            if bucket not in existing:
+                try:
+                    self.retry(self.kazoo.create, path + "/" + bucket, "")
+                except NodeExistsException:
+                    pass
+
+    def _list_buckets(self, path):
+        """List the children of all buckets under a path
+
+        @return list of (bucket path, children) tuples
+        """
+        return self._list_paths(path + "/" + bucket for bucket in BUCKETS)
+
+    def _list_paths(self, paths):
+        """List the children of several paths, pipelining up to READ_WINDOW
+        listings at once
+
+        @return list of (path, children) tuples
+        """
+        listings = []
+        pending = deque()
+        for path in paths:
+            pending.append((path, self.kazoo.get_children_async(path)))
+            if len(pending) >= self.READ_WINDOW:
+                listings.append(self._collect_children(*pending.popleft()))
+        while pending:
+            listings.append(self._collect_children(*pending.popleft()))
+        return listings
+
+    def _collect_children(self, path, async_result):
+        try:
+            children = async_result.get()
+        except NoNodeException:
+            raise
+        except KazooException:
+            # async reads are not retried. fall back to a retried read
+            children = self.retry(self.kazoo.get_children, path)
+        return path, children
+
     def _initialized_watcher(self, data, stat):
         if not (data is None and stat is None):
             # initialized node exists! set our event and join the party.
@@ -746,17 +1303,12 @@ class ProcessDispatcherZooKeeperStore(object):
                 self._election_condition.notify_all()
 
             # depose the leaders and cancel the elections just in case
-            try:
-                if self._matchmaker:
-                    self._matchmaker.cancel()
-            except Exception, e:
-                log.exception("Error deposing matchmaker: %s", e)
+            self._cancel_matchmakers()
             try:
                 if self._doctor:
                     self._doctor.cancel()
             except Exception, e:
                 log.exception("Error deposing doctor: %s", e)
-            self.matchmaker_election.cancel()
             self.doctor_election.cancel()
 
         elif state == KazooState.CONNECTED:
@@ -765,13 +1317,34 @@ class ProcessDispatcherZooKeeperStore(object):
                 self._election_enabled = True
                 self._election_condition.notify_all()
 
-    def contend_matchmaker(self, matchmaker):
+    def contend_matchmaker(self, matchmaker, shard=None):
         """Provide a matchmaker object to participate in an election
+
+        Each shard holds its own election, so matchmakers for different
+        shards can lead at the same time, in the same or different workers.
         """
-        assert self._matchmaker is None
-        self._matchmaker = matchmaker
-        self._matchmaker_election_thread = tevent.spawn(self._run_election,
-            self.matchmaker_election, matchmaker, "matchmaker")
+        assert shard not in self._matchmakers
+        if shard is None:
+            path = self.MATCHMAKER_ELECTION_PATH
+            name = "matchmaker"
+        else:
+            path = self.MATCHMAKER_SHARD_ELECTIONS_PATH + "/" + shard
+            name = "matchmaker %s" % shard
+        election = self.kazoo.Election(path)
+
+        self._matchmakers[shard] = matchmaker
+        self._matchmaker_elections[shard] = election
+        self._matchmaker_election_threads[shard] = tevent.spawn(
+            self._run_election, election, matchmaker, name)
+
+    def _cancel_matchmakers(self):
+        for matchmaker in self._matchmakers.values():
+            try:
+                matchmaker.cancel()
+            except Exception, e:
+                log.exception("Error deposing matchmaker: %s", e)
+        for election in self._matchmaker_elections.values():
+            election.cancel()
 
     def contend_doctor(self, doctor):
         """Provide a doctor object to participate in an election
@@ -806,28 +1379,31 @@ class ProcessDispatcherZooKeeperStore(object):
             self._shutdown = True
             self._election_enabled = False
             self._election_condition.notify_all()
-        try:
-            if self._matchmaker:
-                self._matchmaker.cancel()
-        except Exception, e:
-            log.exception("Error deposing matchmaker: %s", e)
+        self._cancel_matchmakers()
         try:
             if self._doctor:
                 self._doctor.cancel()
         except Exception, e:
             log.exception("Error deposing doctor: %s", e)
-        self.matchmaker_election.cancel()
         self.doctor_election.cancel()
-        if self._matchmaker_election_thread:
-            self._matchmaker_election_thread.join()
+        for election_thread in self._matchmaker_election_threads.values():
+            election_thread.join()
         if self._doctor_election_thread:
             self._doctor_election_thread.join()
         self._doctor = None
-        self._matchmaker = None
+        self._matchmakers.clear()
+        self._matchmaker_elections.clear()
+        self._matchmaker_election_threads.clear()
 
         self.kazoo.stop()
         self._is_initialized.clear()
 
+        with self._queued_lock:
+            self._queued_buckets.clear()
+            self._queued_paths.clear()
+            self._queued_removed.clear()
+            self._queued_process_set_watches[:] = []
+
     #########################################################################
     # PROCESS DISPATCHER STATE
     #########################################################################
@@ -971,33 +1547,121 @@ class ProcessDispatcherZooKeeperStore(object):
     # PROCESSES
     #########################################################################
 
-    def _make_process_path(self, owner=None, upid=None):
+    def _make_process_name(self, owner=None, upid=None):
         if upid is None:
             raise ValueError('invalid process upid')
 
-        path = self.PROCESSES_PATH + "/"
+        name = ""
         if owner is not None:
-            path += "owner=" + owner + "&"
-        path += "upid=" + upid
+            name += "owner=" + owner + "&"
+        name += "upid=" + upid
 
-        return path
+        return name
+
+    def _make_process_path(self, owner=None, upid=None):
+        name = self._make_process_name(owner=owner, upid=upid)
+        return "%s/%s/%s" % (self.PROCESSES_PATH, get_bucket(name), name)
+
+    def _make_process_index_value_path(self, index, value):
+        return "%s/%s/%s" % (self.PROCESS_INDEX_PATH, index,
+            _encode_index_value(value))
+
+    def _make_process_index_path(self, index, value, name):
+        if index == _ASSIGNED_INDEX:
+            value = _encode_index_value(value)
+            return "%s/%s/%s/%s&%s" % (self.PROCESS_INDEX_PATH, index,
+                get_bucket(value), value, name)
+        return "%s/%s/%s" % (self._make_process_index_value_path(index, value),
+            get_bucket(name), name)
+
+    def _make_process_owners_path(self, upid):
+        if upid is None:
+            raise ValueError('invalid process upid')
+
+        return "%s/%s/%s" % (self.PROCESS_OWNERS_PATH, get_bucket(upid), upid)
+
+    def _get_process_owners_entry(self, path):
+        """Read an entry of the owner index
+
+        @return (owners, version) tuple. version is None if there is no entry
+        """
+        try:
+            data, stat = self.retry(self.kazoo.get, path)
+        except NoNodeException:
+            return [], None
+        return json.loads(data)['owners'], stat.version
+
+    def _set_process_owners(self, transaction, path, upid, owners, version):
+        """Add the write of an entry of the owner index to a transaction
+        """
+        if version is None:
+            transaction.create(path,
+                json.dumps(ProcessOwnersRecord.new(upid, owners)))
+        elif owners:
+            transaction.set_data(path,
+                json.dumps(ProcessOwnersRecord.new(upid, owners)), version)
+        else:
+            transaction.delete(path, version)
+
+    def set_process_engine_resolver(self, resolver):
+        """Set how processes constrained to no engine are indexed by engine
+
+        All stores sharing records must use the same resolver.
+
+        @param resolver: callable taking a process definition and returning
+            the id of the engine it is mapped to, or None
+        """
+        self.process_engine_resolver = resolver
 
     def add_process(self, process):
         """Adds a new process record to the store
 
         If the process record already exists, a WriteConflictError exception
-        is raised.
+        is raised. The process is added to the owner index in the same
+        transaction.
         """
-        data = json.dumps(process)
+        data = self._encode_process(process)
+        name = self._make_process_name(owner=process.owner, upid=process.upid)
+        path = self._make_process_path(owner=process.owner, upid=process.upid)
+        owners_path = self._make_process_owners_path(process.upid)
 
-        try:
-            self.retry(self.kazoo.create,
-                self._make_process_path(owner=process.owner, upid=process.upid),
-                data)
-        except NodeExistsException:
-            raise WriteConflictError("process %s for user %s already exists" % (process.upid, process.owner))
+        values = get_process_index_values(process,
+            self.process_engine_resolver)
+        ops = self._get_process_index_ops(name, None, values)
+
+        while True:
+            owners, version = self._get_process_owners_entry(owners_path)
+            results = self.retry(self._create_process, path, data,
+                process.upid, owners_path, owners + [process.owner], version,
+                ops)
+
+            process_result, owners_result = results[:2]
+            if isinstance(process_result, NodeExistsException):
+                raise WriteConflictError("process %s for user %s already exists" % (process.upid, process.owner))
+            if isinstance(owners_result, (NodeExistsException,
+                    BadVersionException, NoNodeException)):
+                # the index entry changed since it was read
+                continue
+            stale = self._get_stale_process_index_ops(ops, results[2:])
+            if stale:
+                ops = [op for op in ops if op not in stale]
+                continue
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            break
 
         process.metadata['version'] = 0
+        process.metadata['indexed'] = values
+
+    def _create_process(self, path, data, upid, owners_path, owners, version,
+                        ops):
+        transaction = self.kazoo.transaction()
+        transaction.create(path, data)
+        self._set_process_owners(transaction, owners_path, upid, owners,
+            version)
+        self._add_process_index_ops(transaction, ops)
+        return transaction.commit()
 
     def update_process(self, process, force=False):
         """Updates an existing process record
@@ -1013,95 +1677,593 @@ class ProcessDispatcherZooKeeperStore(object):
         @param process: process record
         @return:
         """
+        name = self._make_process_name(owner=process.owner, upid=process.upid)
         path = self._make_process_path(owner=process.owner, upid=process.upid)
-        data = json.dumps(process)
+        data = self._encode_process(process)
         version = process.metadata.get('version')
 
         if version is None and not force:
             raise ValueError("process has no version and force=False")
 
-        try:
-            if force:
-                set_version = -1
+        if force:
+            set_version = -1
+        else:
+            set_version = version
+
+        # the process moves between index entries in the same transaction
+        values = get_process_index_values(process,
+            self.process_engine_resolver)
+        ops = self._get_process_index_ops(name,
+            self._get_stored_index_values(path, process), values)
+
+        while True:
+            results = self.retry(self._set_process, path, data, set_version,
+                ops)
+            if isinstance(results[0], BadVersionException):
+                raise WriteConflictError()
+            if isinstance(results[0], NoNodeException):
+                raise NotFoundError()
+            stale = self._get_stale_process_index_ops(ops, results[1:])
+            if stale:
+                ops = [op for op in ops if op not in stale]
+                continue
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            break
+
+        process.metadata['version'] = results[0].version
+        process.metadata['indexed'] = values
+
+    def _set_process(self, path, data, version, ops):
+        transaction = self.kazoo.transaction()
+        transaction.set_data(path, data, version)
+        self._add_process_index_ops(transaction, ops)
+        return transaction.commit()
+
+    def _get_stored_index_values(self, path, process):
+        """Index values of the stored copy of a process record
+
+        They are kept with records as they are read. Records which were not
+        read from the store are read again.
+        """
+        values = process.metadata.get('indexed')
+        if values is None:
+            try:
+                data, stat = self.retry(self.kazoo.get, path)
+            except NoNodeException:
+                raise NotFoundError()
+            values = self._decode_record(ProcessRecord,
+                data).metadata['indexed']
+        return values
+
+    def _get_process_index_ops(self, name, old_values, new_values):
+        """List the (create, path) index entry writes which move a process
+        from its old index values to new ones
+
+        Either may be None, for a process being added or removed.
+        """
+        ops = []
+        for index in PROCESS_INDEXES:
+            old_entries = new_entries = set()
+            if old_values is not None:
+                old_entries = get_process_index_entries(index,
+                    old_values[index])
+            if new_values is not None:
+                new_entries = get_process_index_entries(index,
+                    new_values[index])
+            for entry in old_entries - new_entries:
+                ops.append((False, self._make_process_index_path(index,
+                    entry, name)))
+            for entry in new_entries - old_entries:
+                ops.append((True, self._make_process_index_path(index,
+                    entry, name)))
+        return ops
+
+    def _add_process_index_ops(self, transaction, ops):
+        for create, path in ops:
+            if create:
+                self._ensure_process_index_parent(path)
+                transaction.create(path, "")
             else:
-                set_version = version
-            self.retry(self.kazoo.set, path, data, set_version)
-        except BadVersionException:
-            raise WriteConflictError()
-        except NoNodeException:
-            raise NotFoundError()
+                transaction.delete(path)
+
+    def _ensure_process_index_parent(self, path):
+        parent = path.rsplit("/", 1)[0]
+        if parent not in self._process_index_paths:
+            self.retry(self.kazoo.ensure_path, parent)
+            self._process_index_paths.add(parent)
+
+    def _get_stale_process_index_ops(self, ops, results):
+        """Find the index entry writes of a transaction which failed because
+        the index was out of step with the records
+
+        These are creates of entries which exist and deletes of entries which
+        do not. The transaction is retried without them.
+        """
+        stale = []
+        for op, result in zip(ops, results):
+            create = op[0]
+            if ((create and isinstance(result, NodeExistsException)) or
+                    (not create and isinstance(result, NoNodeException))):
+                stale.append(op)
+        return stale
+
+    def _process_watcher_wrapper(self, watched_event, watcher=None):
+        # Extract owner and upid from the watched_event path
+        match = re.match(r'^%s/[0-9a-f]{2}/(.*)$' % self.PROCESSES_PATH,
+            watched_event.path)
+        if match is None:
+            raise AttributeError("could not parse watched_event %s" % str(watched_event))
+        owner, upid = self._parse_process_id(match.group(1))
 
-        process.metadata['version'] = version + 1
+        if watcher is not None:
+            watcher(owner, upid)
 
     def get_process(self, owner, upid, watcher=None):
         """Retrieve process record
         """
         path = self._make_process_path(owner=owner, upid=upid)
 
+        watch = None
         if watcher:
             if not callable(watcher):
                 raise ValueError("watcher is not callable")
+            watch = partial(self._process_watcher_wrapper, watcher=watcher)
 
         try:
             data, stat = self.retry(self.kazoo.get,
-                path, watch=watcher)
+                path, watch=watch)
         except NoNodeException:
             return None
 
-        rawdict = json.loads(data)
-        process = ProcessRecord(rawdict)
+        process = self._decode_record(ProcessRecord, data)
         process.metadata['version'] = stat.version
 
         return process
 
+    def _encode_process(self, process):
+        data, snapshot = encode_process(process)
+        if snapshot is not None:
+            digest, definition_data = snapshot
+            if digest not in self._definition_snapshots:
+                try:
+                    self.retry(self.kazoo.create, self._make_definition_snapshot_path(digest),
+                        definition_data)
+                except NodeExistsException:
+                    pass
+                self._definition_snapshots[digest] = definition_data
+        return data
+
+    def _get_definition_snapshot(self, digest):
+        definition_data = self._definition_snapshots.get(digest)
+        if definition_data is None:
+            definition_data, _ = self.retry(self.kazoo.get,
+                self._make_definition_snapshot_path(digest))
+            self._definition_snapshots[digest] = definition_data
+        return definition_data
+
+    def _make_definition_snapshot_path(self, digest):
+        return self.DEFINITION_SNAPSHOTS_PATH + "/" + digest
+
+    def _decode_record(self, record_class, data):
+        if record_class is ProcessRecord:
+            process = decode_process(data, self._get_definition_snapshot)
+            # kept so writes of the record know which index entries to move
+            process.metadata['indexed'] = get_process_index_values(process,
+                self.process_engine_resolver)
+            return process
+        return record_class(json.loads(data))
+
+    def transaction(self):
+        """Start a transaction of record updates. See StoreTransaction
+
+        The updates are committed in a single ZooKeeper multi operation.
+        """
+        return StoreTransaction(self._commit_transaction)
+
+    def _commit_transaction(self, transaction):
+        self._commit_writes(self._get_transaction_writes(transaction))
+
+    def _commit_writes(self, writes):
+        ops = []
+        indexed = []
+        for path, data, record in writes:
+            if isinstance(record, ProcessRecord):
+                name = self._make_process_name(owner=record.owner,
+                    upid=record.upid)
+                values = get_process_index_values(record,
+                    self.process_engine_resolver)
+                ops.extend(self._get_process_index_ops(name,
+                    self._get_stored_index_values(path, record), values))
+                indexed.append((record, values))
+
+        while True:
+            results = self.retry(self._set_records, writes, ops)
+
+            for result in results[:len(writes)]:
+                if isinstance(result, BadVersionException):
+                    raise WriteConflictError()
+                if isinstance(result, NoNodeException):
+                    raise NotFoundError()
+            stale = self._get_stale_process_index_ops(ops,
+                results[len(writes):])
+            if stale:
+                ops = [op for op in ops if op not in stale]
+                continue
+            for result in results:
+                if isinstance(result, RolledBackError):
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+            break
+
+        for (path, data, record), stat in zip(writes, results):
+            record.metadata['version'] = stat.version
+        for record, values in indexed:
+            record.metadata['indexed'] = values
+
+    def _get_transaction_writes(self, transaction):
+        """List the (path, data, record) writes of a transaction
+        """
+        writes = []
+        for process in transaction.processes:
+            writes.append((self._make_process_path(owner=process.owner,
+                upid=process.upid), self._encode_process(process), process))
+        for resource in transaction.resources:
+            writes.append((self._make_resource_path(resource.resource_id),
+                json.dumps(resource), resource))
+        for node in transaction.nodes:
+            writes.append((self._make_node_path(node.node_id),
+                json.dumps(node), node))
+        return writes
+
+    def _set_records(self, writes, ops):
+        transaction = self.kazoo.transaction()
+        for path, data, record in writes:
+            transaction.set_data(path, data, record.metadata['version'])
+        self._add_process_index_ops(transaction, ops)
+        return transaction.commit()
+
     def remove_process(self, owner, upid):
         """Remove process record from store
+
+        The process is removed from the owner index and the process indexes
+        in the same transaction. Processes added before there was an owner
+        index have no entry in it.
         """
+        name = self._make_process_name(owner=owner, upid=upid)
         path = self._make_process_path(owner=owner, upid=upid)
+        owners_path = self._make_process_owners_path(upid)
 
-        try:
-            self.retry(self.kazoo.delete, path)
-        except NoNodeException:
-            raise NotFoundError()
+        stale = []
+        while True:
+            # the record is read to find its index entries. it is deleted at
+            # the version read, so the entries can not change meanwhile
+            process = ProcessDispatcherZooKeeperStore.get_process(self,
+                owner, upid)
+            if process is None:
+                raise NotFoundError()
+            ops = [op for op in self._get_process_index_ops(name,
+                   process.metadata['indexed'], None) if op not in stale]
+
+            owners, version = self._get_process_owners_entry(owners_path)
+            if owner in owners:
+                owners.remove(owner)
+            else:
+                version = None
+
+            results = self.retry(self._delete_process, path,
+                process.metadata['version'], upid, owners_path, owners,
+                version, ops)
+
+            if isinstance(results[0], NoNodeException):
+                raise NotFoundError()
+            if isinstance(results[0], BadVersionException):
+                # the record changed since it was read
+                continue
+            if version is not None:
+                if isinstance(results[1], (BadVersionException,
+                        NoNodeException)):
+                    # the index entry changed since it was read
+                    continue
+                index_results = results[2:]
+            else:
+                index_results = results[1:]
+            found = self._get_stale_process_index_ops(ops, index_results)
+            if found:
+                stale.extend(found)
+                continue
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            break
+
+    def _delete_process(self, path, process_version, upid, owners_path,
+                        owners, version, ops):
+        transaction = self.kazoo.transaction()
+        transaction.delete(path, process_version)
+        if version is not None:
+            self._set_process_owners(transaction, owners_path, upid, owners,
+                version)
+        self._add_process_index_ops(transaction, ops)
+        return transaction.commit()
+
+    def get_process_owners(self, upids):
+        """Look up the owners of processes by upid
+
+        Processes added before there was an owner index are not found.
+
+        @param upids: sequence of upids
+        @return dict of upid -> list of the owners of processes with that
+            upid. upids of no process are left out
+        """
+        upids = list(upids)
+        paths = [self._make_process_owners_path(upid) for upid in upids]
+        owners = {}
+        for upid, record in zip(upids,
+                self._read_records(paths, ProcessOwnersRecord)):
+            if record is not None and record.owners:
+                owners[upid] = record.owners
+        return owners
+
+    def list_process_index_values(self, index):
+        """List the values of a process index
+
+        Index nodes are kept once created, so values which no process holds
+        any longer may be listed.
+
+        @param index: one of PROCESS_INDEXES
+        @return list of the values of processes in the index
+        """
+        if index not in PROCESS_INDEXES:
+            raise ValueError("unknown process index %s" % index)
+        path = self.PROCESS_INDEX_PATH + "/" + index
+        if index == _ASSIGNED_INDEX:
+            values = set()
+            for bucket_path, names in self._list_buckets(path):
+                values.update(name.split("&", 1)[0] for name in names)
+            return [_decode_index_value(value) for value in values]
+        names = self.retry(self.kazoo.get_children, path)
+        return [_decode_index_value(name) for name in names]
+
+    def get_indexed_process_ids(self, index, values):
+        """Retrieve the IDs of processes by their values in an index
+
+        Only the index is read, not the process records.
+
+        @param index: one of PROCESS_INDEXES
+        @param values: sequence of index values
+        @return list of (owner, upid) tuples of processes with any of values
+        """
+        if index not in PROCESS_INDEXES:
+            raise ValueError("unknown process index %s" % index)
+        if index == _ASSIGNED_INDEX:
+            return self._get_assigned_process_ids(values)
+
+        bucket_paths = []
+        for value in values:
+            path = self._make_process_index_value_path(index, value)
+            try:
+                buckets = self.retry(self.kazoo.get_children, path)
+            except NoNodeException:
+                continue
+            bucket_paths.extend(path + "/" + bucket for bucket in buckets)
+
+        process_ids = set()
+        for path, names in self._list_paths(bucket_paths):
+            process_ids.update(self._parse_process_id(name) for name in names)
+        return list(process_ids)
+
+    def _get_assigned_process_ids(self, values):
+        # bucket -> encoded values in it
+        buckets = {}
+        for value in values:
+            if _is_index_entry(_ASSIGNED_INDEX, value):
+                value = _encode_index_value(value)
+                buckets.setdefault(get_bucket(value), set()).add(value)
+
+        index_path = self.PROCESS_INDEX_PATH + "/" + _ASSIGNED_INDEX
+        process_ids = set()
+        for path, names in self._list_paths(index_path + "/" + bucket
+                                            for bucket in buckets):
+            bucket_values = buckets[path.rsplit("/", 1)[1]]
+            for name in names:
+                value, process_name = name.split("&", 1)
+                if value in bucket_values:
+                    process_ids.add(self._parse_process_id(process_name))
+        return list(process_ids)
+
+    def find_process_ids(self, index_values=None, owner=None, after=None,
+                         limit=None):
+        """Find the IDs of processes by their index values and owner
+
+        Only the indexes and process IDs are read, not the process records.
+        IDs are found in store order, which is by bucket and then by name.
+        Buckets are listed FIND_BUCKETS at a time, starting with the bucket
+        of after, until limit IDs are found.
+
+        @param index_values: dict of index -> sequence of values. processes
+            must have one of the values in each index
+        @param owner: only processes of this owner, if not None
+        @param after: (owner, upid) of a process. only IDs after it are found
+        @param limit: maximum number of IDs, all if None
+        @return list of (owner, upid) tuples
+        """
+        index_values = dict(index_values or {})
+        for index in index_values:
+            if index not in PROCESS_INDEXES:
+                raise ValueError("unknown process index %s" % index)
+
+        start = None
+        if after is not None:
+            name = self._make_process_name(owner=after[0], upid=after[1])
+            start = get_bucket(name), name
+
+        # processes assigned to some resources are few and found at once.
+        # only their buckets are listed
+        candidates = None
+        if _ASSIGNED_INDEX in index_values:
+            candidates = {}
+            for process_id in self._get_assigned_process_ids(
+                    index_values.pop(_ASSIGNED_INDEX)):
+                name = self._make_process_name(owner=process_id[0],
+                    upid=process_id[1])
+                candidates.setdefault(get_bucket(name), set()).add(name)
+            buckets = sorted(candidates)
+        else:
+            buckets = BUCKETS
+        if start is not None:
+            buckets = [bucket for bucket in buckets if bucket >= start[0]]
+
+        # index -> (value path, buckets under it) of each value
+        value_paths = {}
+        for index, values in index_values.iteritems():
+            paths = []
+            for value in values:
+                path = self._make_process_index_value_path(index, value)
+                try:
+                    paths.append((path, set(self.retry(self.kazoo.get_children,
+                        path))))
+                except NoNodeException:
+                    pass
+            value_paths[index] = paths
+
+        process_ids = []
+        for i in range(0, len(buckets), self.FIND_BUCKETS):
+            chunk = buckets[i:i + self.FIND_BUCKETS]
+            names = self._find_bucket_names(chunk, value_paths, candidates)
+            for bucket in chunk:
+                for name in sorted(names[bucket]):
+                    if start is not None and (bucket, name) <= start:
+                        continue
+                    process_id = self._parse_process_id(name)
+                    if owner and process_id[0] != owner:
+                        continue
+                    process_ids.append(process_id)
+                    if limit is not None and len(process_ids) >= limit:
+                        return process_ids
+        return process_ids
+
+    def _find_bucket_names(self, buckets, value_paths, candidates):
+        """List the names of processes in buckets with one of the values of
+        each index
+
+        @param value_paths: index -> (value path, buckets under it) tuples
+        @param candidates: bucket -> names the processes must be among, or
+            None
+        @return dict of bucket -> set of process names
+        """
+        if candidates is None and not value_paths:
+            return dict((path.rsplit("/", 1)[1], set(names))
+                        for path, names in self._list_paths(
+                            self.PROCESSES_PATH + "/" + bucket
+                            for bucket in buckets))
+
+        found = dict((bucket, candidates[bucket]
+                      if candidates is not None else None)
+                     for bucket in buckets)
+        for index, paths in value_paths.iteritems():
+            listed = dict((bucket, set()) for bucket in buckets)
+            for path, names in self._list_paths(path + "/" + bucket
+                    for path, existing in paths
+                    for bucket in buckets if bucket in existing):
+                listed[path.rsplit("/", 1)[1]].update(names)
+            for bucket in buckets:
+                if found[bucket] is None:
+                    found[bucket] = listed[bucket]
+                else:
+                    found[bucket] = found[bucket] & listed[bucket]
+        return found
 
     def get_process_ids(self):
-        """Retrieve available node IDs
+        """Retrieve available process IDs
         """
         process_ids = []
-        processes = self.kazoo.get_children(self.PROCESSES_PATH)
+        for path, processes in self._list_buckets(self.PROCESSES_PATH):
+            process_ids.extend(self._parse_process_id(p) for p in processes)
+        return process_ids
 
-        for p in processes:
-            owner = None
+    def get_processes(self, process_ids=None):
+        """Retrieve several process records at once
 
-            match = re.match(r'^owner=(.+)&upid=(.+)$', p)
-            if match is not None:
-                owner = match.group(1)
-                upid = match.group(2)
-            else:
-                match = re.match(r'^upid=(.+)$', p)
-                if match is None:
-                    raise ValueError("queued process %s could not be parsed" % p)
-                upid = match.group(1)
+        @param process_ids: sequence of (owner, upid) tuples. all if None
+        @return list of process records. missing records are skipped
+        """
+        if process_ids is None:
+            process_ids = self.get_process_ids()
+        paths = [self._make_process_path(owner=owner, upid=upid)
+                 for owner, upid in process_ids]
+        return self._get_records(paths, ProcessRecord)
+
+    def _get_records(self, paths, record_class):
+        """Read several records, skipping missing ones
+        """
+        return [record for record in self._read_records(paths, record_class)
+                if record is not None]
 
-            process_ids.append((owner, upid))
+    def _read_records(self, paths, record_class):
+        """Read several records, pipelining up to READ_WINDOW reads at once
 
-        return process_ids
+        @return list of records in the order of paths, None for missing ones
+        """
+        records = []
+        pending = deque()
+        for path in paths:
+            pending.append((path, self.kazoo.get_async(path)))
+            if len(pending) >= self.READ_WINDOW:
+                records.append(self._collect_record(record_class, *pending.popleft()))
+        while pending:
+            records.append(self._collect_record(record_class, *pending.popleft()))
+        return records
+
+    def _collect_record(self, record_class, path, async_result):
+        try:
+            try:
+                data, stat = async_result.get()
+            except NoNodeException:
+                raise
+            except KazooException:
+                # async reads are not retried. fall back to a retried read
+                data, stat = self.retry(self.kazoo.get, path)
+        except NoNodeException:
+            return None
+
+        record = self._decode_record(record_class, data)
+        record.metadata['version'] = stat.version
+        return record
+
+    def _parse_process_id(self, name):
+        """Parse a process node name into an (owner, upid) tuple
+        """
+        owner = None
+
+        match = _PROCESS_ID_RE.match(name)
+        if match is not None:
+            owner = match.group(1)
+            upid = match.group(2)
+        else:
+            match = _PROCESS_ID_NO_OWNER_RE.match(name)
+            if match is None:
+                raise ValueError("process %s could not be parsed" % name)
+            upid = match.group(1)
+
+        return owner, upid
 
     #########################################################################
     # QUEUED PROCESSES
     #########################################################################
 
+    def _make_queue_bucket_path(self, bucket):
+        return self.QUEUED_PROCESSES_PATH + "/" + bucket
+
     def _make_requested_path(self, owner=None, upid=None, round=None, seq=None):
-        if upid is None:
-            raise ValueError('invalid process upid')
         if round is None:
             raise ValueError('invalid process round')
 
-        path = self.QUEUED_PROCESSES_PATH + "/"
-        if owner is not None:
-            path += "owner=" + owner + "&"
-
-        path += "upid=" + upid + "&round=" + str(round) + "+"
+        name = self._make_process_name(owner=owner, upid=upid)
+        path = "%s/%s&round=%s+" % (
+            self._make_queue_bucket_path(get_bucket(name)), name, round)
 
         if seq is not None:
             path += str(seq)
@@ -1116,90 +2278,416 @@ class ProcessDispatcherZooKeeperStore(object):
         @param round:
         @return:
         """
-        try:
-            path = self._make_requested_path(owner=owner, upid=upid, round=round)
-            self.retry(self.kazoo.create, path, "", sequence=True)
-        except NodeExistsException:
-            raise WriteConflictError("process %s for user %s already in queue" % (upid, owner))
+        self.enqueue_processes([(owner, upid, round)])
+
+    def enqueue_processes(self, keys):
+        """Mark several processes as runnable, in order, in one batch
+
+        Queue entries are created in ZooKeeper transactions of up to
+        ENQUEUE_BATCH_SIZE entries.
+
+        @param keys: sequence of (owner, upid, round) tuples
+        """
+        keys = list(keys)
+        for i in range(0, len(keys), self.ENQUEUE_BATCH_SIZE):
+            paths = self._create_queue_entries(
+                keys[i:i + self.ENQUEUE_BATCH_SIZE])
+            self._cache_queued_processes(paths)
+
+    def _create_queue_entries(self, keys):
+        """Create the queue entries of several processes in one transaction
+
+        ZooKeeper sequence numbers only order the entries of a bucket, so
+        entries are also stamped from the queue counter, which the
+        transaction advances. If another store advanced it first, the
+        counter is read again and the transaction retried.
+
+        @return list of the new paths
+        """
+        while True:
+            with self._queued_lock:
+                counter = self._queue_counter
+            if counter is None:
+                data, stat = self.retry(self.kazoo.get, self.QUEUE_COUNTER_PATH)
+                counter = int(data), stat.version
+            stamp, version = counter
+
+            paths = [self._make_requested_path(owner=owner, upid=upid,
+                         round=round, seq="%016d-" % (stamp + i + 1))
+                     for i, (owner, upid, round) in enumerate(keys)]
+            stamp += len(keys)
+            results = self.retry(self._commit_queue_entries, paths, stamp,
+                version)
+
+            if isinstance(results[0], BadVersionException):
+                with self._queued_lock:
+                    if self._queue_counter == counter:
+                        self._queue_counter = None
+                continue
+
+            for path, result in zip(paths, results[1:]):
+                if isinstance(result, NodeExistsException):
+                    raise WriteConflictError("queued process %s already exists" % path)
+            for result in results:
+                if isinstance(result, RolledBackError):
+                    continue
+                if isinstance(result, Exception):
+                    raise result
+
+            with self._queued_lock:
+                if (self._queue_counter is None or
+                        self._queue_counter[1] < results[0].version):
+                    self._queue_counter = stamp, results[0].version
+            return results[1:]
+
+    def _commit_queue_entries(self, paths, stamp, version):
+        transaction = self.kazoo.transaction()
+        transaction.set_data(self.QUEUE_COUNTER_PATH, str(stamp), version)
+        for path in paths:
+            transaction.create(path, "", sequence=True)
+        return transaction.commit()
+
+    def _parse_queued_process(self, name):
+        """Parse a queue node name into a (seq, (owner, upid, round)) tuple
+        """
+        owner = None
+        match = _QUEUED_PROCESS_RE.match(name)
+        if match is not None:
+            owner = match.group(1)
+            upid = match.group(2)
+            round = int(match.group(3))
+            seq = match.group(4)
+        else:
+            match = _QUEUED_PROCESS_NO_OWNER_RE.match(name)
+            if match is None:
+                raise ValueError("queued process %s could not be parsed" % name)
+            upid = match.group(1)
+            round = int(match.group(2))
+            seq = match.group(3)
+        return seq, (owner, upid, round)
+
+    def _queued_processes_watcher(self, bucket, children):
+        if self._shutdown:
+            # returning False stops the watch
+            return False
+
+        bucket_path = self._make_queue_bucket_path(bucket)
+        with self._queued_lock:
+            previous = self._queued_buckets.get(bucket, {})
+            removed = self._queued_removed.get(bucket)
+            if removed:
+                removed.intersection_update(children)
+
+            # only names which are new since the last call need parsing
+            names = {}
+            for name in children:
+                if removed and name in removed:
+                    continue
+                parsed = previous.get(name)
+                if parsed is None:
+                    try:
+                        parsed = self._parse_queued_process(name)
+                    except ValueError:
+                        log.warning("Ignoring unparseable queued process %s", name)
+                        continue
+                names[name] = parsed
+
+            for name, (seq, key) in previous.iteritems():
+                if name not in names and \
+                        self._queued_paths.get(key) == bucket_path + "/" + name:
+                    del self._queued_paths[key]
+            for name, (seq, key) in names.iteritems():
+                self._queued_paths[key] = bucket_path + "/" + name
+            self._queued_buckets[bucket] = names
+
+            watchers = []
+            if names.viewkeys() != previous.viewkeys():
+                watchers = self._pop_queued_process_set_watches()
+        self._call_queued_process_set_watches(watchers)
+
+    def _cache_queued_processes(self, paths):
+        """Add entries queued by this store to the queue cache
+        """
+        changed = False
+        with self._queued_lock:
+            for path in paths:
+                bucket_path, name = path.rsplit("/", 1)
+                bucket = bucket_path.rsplit("/", 1)[1]
+                names = self._queued_buckets.setdefault(bucket, {})
+                if name not in names:
+                    names[name] = parsed = self._parse_queued_process(name)
+                    self._queued_paths[parsed[1]] = path
+                    changed = True
+            watchers = []
+            if changed:
+                watchers = self._pop_queued_process_set_watches()
+        self._call_queued_process_set_watches(watchers)
+
+    def _uncache_queued_processes(self, paths):
+        """Drop entries removed by this store from the queue cache
+        """
+        changed = False
+        with self._queued_lock:
+            for path in paths:
+                bucket_path, name = path.rsplit("/", 1)
+                bucket = bucket_path.rsplit("/", 1)[1]
+                self._queued_removed.setdefault(bucket, set()).add(name)
+                parsed = self._queued_buckets.get(bucket, {}).pop(name, None)
+                if parsed is not None:
+                    if self._queued_paths.get(parsed[1]) == path:
+                        del self._queued_paths[parsed[1]]
+                    changed = True
+            watchers = []
+            if changed:
+                watchers = self._pop_queued_process_set_watches()
+        self._call_queued_process_set_watches(watchers)
+
+    def _pop_queued_process_set_watches(self):
+        # expected to be called under the queue lock
+        watchers = list(self._queued_process_set_watches)
+        self._queued_process_set_watches[:] = []
+        return watchers
+
+    def _call_queued_process_set_watches(self, watchers):
+        for watcher in watchers:
+            try:
+                watcher()
+            except Exception:
+                log.exception("Error in queued process set watcher")
 
     def get_queued_processes(self, watcher=None):
         """Get the queued processes and optionally set a watcher for changes
 
+        The queue is read from the queue cache.
+
         @param watcher: callable to be called ONCE when the queued process set changes
         @return list of (owner, upid, round) tuples
         """
-        queued_processes = []
-
         if watcher:
             if not callable(watcher):
                 raise ValueError("watcher is not callable")
-        processes = self.retry(self.kazoo.get_children,
-            self.QUEUED_PROCESSES_PATH, watch=watcher)
 
-        for p in processes:
-            owner = None
-            match = re.match(r'^owner=(.+)&upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-            if match is not None:
-                owner = match.group(1)
-                upid = match.group(2)
-                round = int(match.group(3))
-                seq = match.group(4)
-            else:
-                match = re.match(r'^upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-                if match is None:
-                    raise ValueError("queued process %s could not be parsed" % p)
-                upid = match.group(1)
-                round = int(match.group(2))
-                seq = match.group(3)
-
-            queued_processes.append((seq, (owner, upid, round)))
+        with self._queued_lock:
+            if watcher:
+                self._queued_process_set_watches.append(watcher)
+            queued_processes = []
+            for names in self._queued_buckets.itervalues():
+                queued_processes.extend(names.itervalues())
 
         return map(lambda x: x[1], sorted(queued_processes))
 
     def remove_queued_process(self, owner, upid, round):
         """Remove a process from the runnable queue
+
+        The path of the queue entry normally comes from the cache. If the
+        entry is not cached yet, or the cached entry is stale, the bucket of
+        the process is listed to find it.
         """
-        processes = self.retry(self.kazoo.get_children,
-            self.QUEUED_PROCESSES_PATH)
+        key = (owner, upid, round)
+        with self._queued_lock:
+            path = self._queued_paths.get(key)
+
+        if path is not None:
+            try:
+                self.retry(self.kazoo.delete, path)
+            except NoNodeException:
+                self._uncache_queued_processes([path])
+                path = None
+
+        if path is None:
+            path = self._find_queued_process_path(key)
+            try:
+                self.retry(self.kazoo.delete, path)
+            except NoNodeException:
+                raise NotFoundError("queue process (%s, %s, %s) could not be found" % (owner, upid, str(round)))
 
-        seq = None
-        # Find a zknode that matches this process
+        self._uncache_queued_processes([path])
+
+    def _find_queued_process_path(self, key):
+        owner, upid, round = key
+        bucket_path = self._make_queue_bucket_path(
+            get_bucket(self._make_process_name(owner=owner, upid=upid)))
+        processes = self.retry(self.kazoo.get_children, bucket_path)
         for p in processes:
-            p_owner = None
-            match = re.match(r'^owner=(.+)&upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-            if match is not None:
-                p_owner = match.group(1)
-                p_upid = match.group(2)
-                p_round = int(match.group(3))
-                p_seq = match.group(4)
-            else:
-                match = re.match(r'^upid=(.+)&round=([0-9]+)\+([0-9]+)$', p)
-                if match is None:
-                    raise ValueError("queued process %s could not be parsed" % p)
-                p_upid = match.group(1)
-                p_round = int(match.group(2))
-                p_seq = match.group(3)
-            if owner == p_owner and upid == p_upid and round == p_round:
-                seq = p_seq
-                break
-
-        if seq is None:
-            raise NotFoundError("queue process (%s, %s, %s) could not be found" % (owner, upid, str(round)))
-
-        path = self._make_requested_path(owner=owner, upid=upid, round=round, seq=seq)
-        try:
-            self.retry(self.kazoo.delete, path)
-        except NoNodeException:
-            raise NotFoundError()
+            seq, p_key = self._parse_queued_process(p)
+            if p_key == key:
+                return bucket_path + "/" + p
+        raise NotFoundError("queue process (%s, %s, %s) could not be found" % key)
 
     def clear_queued_processes(self):
         """Reset the process queue
         """
-        processes = self.retry(self.kazoo.get_children,
-            self.QUEUED_PROCESSES_PATH)
+        for bucket_path, processes in self._list_buckets(
+                self.QUEUED_PROCESSES_PATH):
+            paths = [bucket_path + "/" + process for process in processes]
+            for path in paths:
+                try:
+                    self.retry(self.kazoo.delete, path)
+                except NoNodeException:
+                    pass
+            self._uncache_queued_processes(paths)
+
+    #########################################################################
+    # LAYOUT
+    #########################################################################
+
+    def migrate_layout(self):
+        """Bring records stored in the layout of earlier releases up to date
+
+        Process records and queue entries of the flat layout are moved into
+        buckets, then processes stored before there were process indexes are
+        indexed.
+        """
+        self._migrate_buckets()
+        self._build_process_index()
+
+    def _build_process_index(self):
+        """Index all processes, unless it was done before
+        """
+        if self.retry(self.kazoo.exists, self.PROCESS_INDEX_BUILT_PATH):
+            return
+
+        processes = self.get_processes()
+        if processes:
+            log.info("Indexing %d process records", len(processes))
         for process in processes:
-            self.retry(self.kazoo.delete,
-                "%s/%s" % (self.QUEUED_PROCESSES_PATH, process))
+            name = self._make_process_name(owner=process.owner,
+                upid=process.upid)
+            for create, path in self._get_process_index_ops(name, None,
+                    process.metadata['indexed']):
+                self._ensure_process_index_parent(path)
+                try:
+                    self.retry(self.kazoo.create, path, "")
+                except NodeExistsException:
+                    pass
+
+        try:
+            self.retry(self.kazoo.create, self.PROCESS_INDEX_BUILT_PATH, "")
+        except NodeExistsException:
+            pass
+
+    def _migrate_buckets(self):
+        """Move process records and queue entries of the flat layout into
+        buckets
+
+        Earlier releases kept all process records directly under /processes
+        and all queue entries directly under /requested. Each record is moved
+        in a transaction which creates the bucketed copy and deletes the
+        original, checking its version, so records are never lost or
+        duplicated.
+        """
+        moves = []
+        for name in self.retry(self.kazoo.get_children, self.PROCESSES_PATH):
+            if name in _BUCKET_SET:
+                continue
+            try:
+                owner, upid = self._parse_process_id(name)
+            except ValueError:
+                log.warning("Not migrating unparseable process %s", name)
+                continue
+            moves.append((self.PROCESSES_PATH + "/" + name,
+                self._make_process_path(owner=owner, upid=upid), False))
+
+        queued = []
+        for name in self.retry(self.kazoo.get_children,
+                self.QUEUED_PROCESSES_PATH):
+            if name in _BUCKET_SET:
+                continue
+            try:
+                seq, key = self._parse_queued_process(name)
+            except ValueError:
+                log.warning("Not migrating unparseable queued process %s", name)
+                continue
+            queued.append((seq, name, key))
+        # the old sequence number stands in for the stamp, which keeps the
+        # entries in order and ahead of any queued since
+        for seq, name, (owner, upid, round) in sorted(queued):
+            moves.append((self.QUEUED_PROCESSES_PATH + "/" + name,
+                self._make_requested_path(owner=owner, upid=upid, round=round,
+                    seq="%016d-" % int(seq)), True))
+
+        if not moves:
+            return
+        log.info("Migrating %d process records and queue entries to the "
+                 "bucketed layout", len(moves))
+
+        moved = []
+        for i in range(0, len(moves), self.MIGRATE_BATCH_SIZE):
+            batch = moves[i:i + self.MIGRATE_BATCH_SIZE]
+            try:
+                moved.extend(self._move_records(batch))
+            except (NoNodeException, BadVersionException, NodeExistsException):
+                # something changed under the batch. move one at a time
+                for move in batch:
+                    path = self._move_record(*move)
+                    if path is not None:
+                        moved.append(path)
+
+        self._cache_queued_processes(path for path in moved
+            if path.startswith(self.QUEUED_PROCESSES_PATH + "/"))
+
+    def _move_records(self, moves):
+        """Move several records in one transaction
+
+        @return list of the new paths
+        """
+        reads = [(move, self.kazoo.get_async(move[0])) for move in moves]
+        records = []
+        for (path, new_path, sequence), async_result in reads:
+            try:
+                data, stat = async_result.get()
+            except NoNodeException:
+                raise
+            except KazooException:
+                data, stat = self.retry(self.kazoo.get, path)
+            records.append((path, new_path, sequence, data, stat.version))
+
+        results = self.retry(self._commit_moves, records)
+        for result in results:
+            if isinstance(result, RolledBackError):
+                continue
+            if isinstance(result, Exception):
+                raise result
+        return results[::2]
+
+    def _move_record(self, path, new_path, sequence):
+        """Move a record on its own, as its version allows
+
+        @return the new path, or None if the record is gone or was moved
+            already
+        """
+        while True:
+            try:
+                data, stat = self.retry(self.kazoo.get, path)
+            except NoNodeException:
+                return None
+
+            create_result, delete_result = self.retry(self._commit_moves,
+                [(path, new_path, sequence, data, stat.version)])
+            if isinstance(create_result, NodeExistsException):
+                log.warning("%s exists in the bucketed layout. Dropping %s",
+                    new_path, path)
+                try:
+                    self.retry(self.kazoo.delete, path)
+                except NoNodeException:
+                    pass
+                return None
+            if isinstance(delete_result, NoNodeException):
+                return None
+            if isinstance(delete_result, BadVersionException):
+                # changed since it was read. try again
+                continue
+            for result in (create_result, delete_result):
+                if isinstance(result, Exception):
+                    raise result
+            return create_result
+
+    def _commit_moves(self, records):
+        transaction = self.kazoo.transaction()
+        for path, new_path, sequence, data, version in records:
+            transaction.create(new_path, data, sequence=sequence)
+            transaction.delete(path, version)
+        return transaction.commit()
 
     #########################################################################
     # NODES
@@ -1288,6 +2776,17 @@ class ProcessDispatcherZooKeeperStore(object):
         node_ids = self.retry(self.kazoo.get_children, self.NODES_PATH)
         return node_ids
 
+    def get_nodes(self, node_ids=None):
+        """Retrieve several node records at once
+
+        @param node_ids: sequence of node IDs. all if None
+        @return list of node records. missing records are skipped
+        """
+        if node_ids is None:
+            node_ids = self.get_node_ids()
+        paths = [self._make_node_path(node_id) for node_id in node_ids]
+        return self._get_records(paths, NodeRecord)
+
     #########################################################################
     # EXECUTION RESOURCES
     #########################################################################
@@ -1390,6 +2889,318 @@ class ProcessDispatcherZooKeeperStore(object):
             self.RESOURCES_PATH, watch=watcher)
         return resource_ids
 
+    def get_resources(self, resource_ids=None):
+        """Retrieve several resource records at once
+
+        @param resource_ids: sequence of resource IDs. all if None
+        @return list of resource records. missing records are skipped
+        """
+        if resource_ids is None:
+            resource_ids = self.get_resource_ids()
+        paths = [self._make_resource_path(resource_id)
+                 for resource_id in resource_ids]
+        return self._get_records(paths, ResourceRecord)
+
+
+class CachedProcessDispatcherZooKeeperStore(ProcessDispatcherZooKeeperStore):
+    """ZooKeeper store which serves record reads from an in-memory replica
+
+    Process, resource and node records and the process owner index are
+    cached. Reads which set a watcher
+    and reads of records which are not cached (yet) go to ZooKeeper. Writes
+    always go to ZooKeeper with their usual version checks. Successful writes
+    update the cache and conflicting writes refresh it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachedProcessDispatcherZooKeeperStore, self).__init__(*args, **kwargs)
+
+        # process records and the owner index are cached by bucket
+        paths = [self.PROCESSES_PATH + "/" + bucket for bucket in BUCKETS]
+        paths.extend(self.PROCESS_OWNERS_PATH + "/" + bucket
+                     for bucket in BUCKETS)
+        paths.extend((self.RESOURCES_PATH, self.NODES_PATH))
+
+        self._caches = {}
+        for path in paths:
+            self._caches[path] = ZooKeeperRecordCache(self.kazoo, path)
+
+    def initialize(self):
+        super(CachedProcessDispatcherZooKeeperStore, self).initialize()
+        for cache in self._caches.itervalues():
+            cache.start()
+
+    def shutdown(self):
+        for cache in self._caches.itervalues():
+            cache.stop()
+        super(CachedProcessDispatcherZooKeeperStore, self).shutdown()
+
+    def _handle_connection_state(self, state):
+        super(CachedProcessDispatcherZooKeeperStore, self)._handle_connection_state(state)
+
+        # watches do not survive a lost session
+        for cache in self._caches.itervalues():
+            if state == KazooState.LOST:
+                cache.reset()
+            elif state == KazooState.CONNECTED:
+                cache.sync()
+
+    def _get_cache(self, path):
+        return self._caches[path.rsplit("/", 1)[0]]
+
+    def _get_cached_record(self, path, record_class):
+        entry = self._get_cache(path).get(path)
+        if entry is None:
+            return None
+        data, version = entry
+        record = self._decode_record(record_class, data)
+        record.metadata['version'] = version
+        return record
+
+    def _read_records(self, paths, record_class):
+        paths = list(paths)
+        records = [self._get_cached_record(path, record_class) for path in paths]
+
+        missed = [i for i, record in enumerate(records) if record is None]
+        if missed:
+            parent = super(CachedProcessDispatcherZooKeeperStore, self)
+            read = parent._read_records([paths[i] for i in missed], record_class)
+            for i, record in zip(missed, read):
+                records[i] = record
+        return records
+
+    def _write_record(self, path, record, encode, write, force):
+        cache = self._get_cache(path)
+        try:
+            write(record, force=force)
+        except (WriteConflictError, NotFoundError):
+            cache.refresh(path)
+            raise
+
+        if force:
+            # the version of a forced write is not known
+            cache.refresh(path)
+        else:
+            cache.put(path, encode(record), record.metadata['version'])
+
+    def _commit_writes(self, writes):
+        try:
+            super(CachedProcessDispatcherZooKeeperStore, self)._commit_writes(writes)
+        except (WriteConflictError, NotFoundError):
+            for path, data, record in writes:
+                self._get_cache(path).refresh(path)
+            raise
+
+        for path, data, record in writes:
+            self._get_cache(path).put(path, data, record.metadata['version'])
+
+    def get_process(self, owner, upid, watcher=None):
+        if watcher is None:
+            process = self._get_cached_record(
+                self._make_process_path(owner=owner, upid=upid), ProcessRecord)
+            if process is not None:
+                return process
+        return super(CachedProcessDispatcherZooKeeperStore, self).get_process(
+            owner, upid, watcher=watcher)
+
+    def update_process(self, process, force=False):
+        path = self._make_process_path(owner=process.owner, upid=process.upid)
+        self._write_record(path, process, self._encode_process,
+            super(CachedProcessDispatcherZooKeeperStore, self).update_process,
+            force)
+
+    def get_node(self, node_id, watcher=None):
+        if watcher is None:
+            node = self._get_cached_record(self._make_node_path(node_id),
+                NodeRecord)
+            if node is not None:
+                return node
+        return super(CachedProcessDispatcherZooKeeperStore, self).get_node(
+            node_id, watcher=watcher)
+
+    def update_node(self, node, force=False):
+        self._write_record(self._make_node_path(node.node_id), node, json.dumps,
+            super(CachedProcessDispatcherZooKeeperStore, self).update_node,
+            force)
+
+    def get_resource(self, resource_id, watcher=None):
+        if watcher is None:
+            resource = self._get_cached_record(
+                self._make_resource_path(resource_id), ResourceRecord)
+            if resource is not None:
+                return resource
+        return super(CachedProcessDispatcherZooKeeperStore, self).get_resource(
+            resource_id, watcher=watcher)
+
+    def update_resource(self, resource, force=False):
+        self._write_record(self._make_resource_path(resource.resource_id),
+            resource, json.dumps,
+            super(CachedProcessDispatcherZooKeeperStore, self).update_resource,
+            force)
+
+
+class ZooKeeperRecordCache(object):
+    """In-memory copy of the records stored under a ZooKeeper path
+
+    A children watch on the path and a data watch on each record keep the
+    copy current. Entries are kept as raw record data and version, so each
+    reader gets its own copy of a record.
+    """
+
+    def __init__(self, kazoo, path):
+        self.kazoo = kazoo
+        self.path = path
+
+        self.lock = threading.Lock()
+        self.stopped = True
+
+        # record path -> (data, version)
+        self.entries = {}
+
+        # record paths currently under the path
+        self.children = set()
+
+        # record paths with a data watch set or being set. kazoo does not
+        # deduplicate watches, so at most one is set per record.
+        self.watched = set()
+        self.children_watched = False
+
+    def start(self):
+        with self.lock:
+            self.stopped = False
+        self.sync()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+        self.reset()
+
+    def reset(self):
+        """Forget all records and watches, as when the session is lost
+        """
+        with self.lock:
+            self.entries.clear()
+            self.children.clear()
+            self.watched.clear()
+            self.children_watched = False
+
+    def sync(self):
+        """Set any watches which are missing, as after a reconnection
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            watch_children = not self.children_watched
+            missing = self.children - self.watched
+            self.watched.update(missing)
+
+        if watch_children:
+            self._watch_children()
+        for path in missing:
+            self._watch_record(path)
+
+    def get(self, path):
+        """Get the (data, version) of a cached record, or None
+        """
+        with self.lock:
+            return self.entries.get(path)
+
+    def put(self, path, data, version):
+        """Update a cached record after a successful write
+        """
+        with self.lock:
+            if path not in self.watched:
+                return
+            entry = self.entries.get(path)
+            if entry is None or entry[1] < version:
+                self.entries[path] = (data, version)
+
+    def refresh(self, path):
+        """Drop a cached record which may be stale and read it again
+        """
+        with self.lock:
+            self.entries.pop(path, None)
+            if self.stopped or path not in self.watched:
+                return
+
+        async_result = self.kazoo.get_async(path)
+        async_result.rawlink(partial(self._record_fetched, path, False))
+
+    def _watch_children(self):
+        with self.lock:
+            self.children_watched = True
+        async_result = self.kazoo.get_children_async(self.path,
+            watch=self._children_changed)
+        async_result.rawlink(self._children_fetched)
+
+    def _children_changed(self, event):
+        with self.lock:
+            self.children_watched = False
+            if self.stopped:
+                return
+        self._watch_children()
+
+    def _children_fetched(self, async_result):
+        try:
+            children = async_result.get()
+        except KazooException, e:
+            # the watch is set again on reconnection
+            log.debug("Failed to list %s: %s", self.path, e)
+            with self.lock:
+                self.children_watched = False
+            return
+
+        paths = set(self.path + "/" + child for child in children)
+        with self.lock:
+            if self.stopped:
+                return
+            for path in self.children - paths:
+                self.entries.pop(path, None)
+            self.children = paths
+            added = paths - self.watched
+            self.watched.update(added)
+
+        for path in added:
+            self._watch_record(path)
+
+    def _watch_record(self, path):
+        async_result = self.kazoo.get_async(path, watch=self._record_changed)
+        async_result.rawlink(partial(self._record_fetched, path, True))
+
+    def _record_changed(self, event):
+        path = event.path
+        with self.lock:
+            if event.type == EventType.DELETED or self.stopped:
+                self.watched.discard(path)
+                self.children.discard(path)
+                self.entries.pop(path, None)
+                return
+        self._watch_record(path)
+
+    def _record_fetched(self, path, watch, async_result):
+        try:
+            data, stat = async_result.get()
+        except KazooException, e:
+            with self.lock:
+                self.entries.pop(path, None)
+
+                # no watch is set when a read fails. unless the record is
+                # gone, the watch is set again on reconnection
+                if watch:
+                    self.watched.discard(path)
+                if isinstance(e, NoNodeException):
+                    self.children.discard(path)
+                else:
+                    log.debug("Failed to read %s: %s", path, e)
+            return
+
+        with self.lock:
+            if self.stopped or path not in self.watched:
+                return
+            entry = self.entries.get(path)
+            if entry is None or entry[1] <= stat.version:
+                self.entries[path] = (data, stat.version)
+
 
 class Record(dict):
     __slots__ = ['metadata']
@@ -1423,7 +3234,7 @@ class ProcessRecord(Record):
     def new(cls, owner, upid, definition, state, configuration=None,
             constraints=None, subscribers=None, round=0, assigned=None,
             hostname=None, queueing_mode=None, restart_mode=None,
-            node_exclusive=None, name=None):
+            node_exclusive=None, name=None, priority=0):
 
         definition = copy.deepcopy(definition)
 
@@ -1447,16 +3258,18 @@ class ProcessRecord(Record):
                  queueing_mode=queueing_mode, restart_mode=restart_mode,
                  starts=starts, node_exclusive=node_exclusive, name=name,
                  start_times=start_times, dispatches=dispatches,
-                 dispatch_times=dispatch_times)
+                 dispatch_times=dispatch_times, priority=int(priority))
         return cls(d)
 
     def increment_starts(self):
         self.starts += 1
         self.start_times.append(time.time())
+        del self.start_times[:-PROCESS_TIME_HISTORY]
 
     def increment_dispatches(self):
         self.dispatches += 1
         self.dispatch_times.append(time.time())
+        del self.dispatch_times[:-PROCESS_TIME_HISTORY]
 
     def get_key(self):
         return self.owner, self.upid, self.round
@@ -1469,6 +3282,15 @@ class ProcessRecord(Record):
         return hash(self.get_key())
 
 
+class ProcessOwnersRecord(Record):
+    """Entry of the owner index: the owners of the processes with a upid
+    """
+    @classmethod
+    def new(cls, upid, owners):
+        d = dict(upid=upid, owners=list(owners))
+        return cls(d)
+
+
 class ResourceRecord(Record):
     @classmethod
     def new(cls, resource_id, node_id, slot_count, properties=None,
@@ -1481,9 +3303,12 @@ class ResourceRecord(Record):
         # Special case to allow matching against resource_id
         props['resource_id'] = resource_id
 
+        # heartbeat_sequence and reported are the sequence number and the
+        # processes of the last numbered heartbeat applied
         d = dict(resource_id=resource_id, node_id=node_id, state=state,
                  slot_count=int(slot_count), properties=props, assigned=[],
-                 last_heartbeat=last_heartbeat)
+                 last_heartbeat=last_heartbeat, heartbeat_sequence=None,
+                 reported=[])
         return cls(d)
 
     @property
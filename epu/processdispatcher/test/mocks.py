@@ -40,6 +40,12 @@ class MockResourceClient(object):
     def cleanup_process(self, eeagent, upid, round):
         pass
 
+    def ack_heartbeat(self, eeagent, sequence):
+        pass
+
+    def request_heartbeat(self, eeagent):
+        pass
+
 
 class MockEPUMClient(object):
 
@@ -0,0 +1,26 @@
+import unittest
+from StringIO import StringIO
+
+from epu.processdispatcher.benchmark import run_benchmark, print_results
+
+
+class MatchmakerBenchmarkTests(unittest.TestCase):
+
+    def test_benchmark(self):
+        results = run_benchmark(nodes=10, resources=2, slots=2, engines=2,
+            processes=60, batch=20, throttled=0.1, seed=1)
+
+        self.assertEqual(results['slots'], 40)
+        self.assertEqual(results['cycles'], 3)
+        self.assertTrue(results['throttled'] > 0)
+        self.assertTrue(0 < results['assignments'] <= 40)
+        self.assertEqual(results['queued'], 60 - results['assignments'])
+        self.assertEqual(results['store_calls']['get_queued_processes'], 3)
+        # each assignment is committed in a single transaction
+        self.assertEqual(results['store_calls']['transaction'],
+            results['assignments'])
+        self.assertNotIn('update_resource', results['store_calls'])
+
+        out = StringIO()
+        print_results(results, out=out)
+        self.assertIn("assignments/sec", out.getvalue())
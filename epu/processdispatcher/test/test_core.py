@@ -1,15 +1,18 @@
 import unittest
 import uuid
+import threading
+import time
 
-from mock import Mock
+from mock import Mock, call
 
 from epu.states import InstanceState, ProcessState, ExecutionResourceState
-from epu.processdispatcher.core import ProcessDispatcherCore
+from epu.processdispatcher.core import ProcessDispatcherCore, HeartbeatInbox
 from epu.processdispatcher.store import ProcessDispatcherStore, ProcessRecord
 from epu.processdispatcher.engines import EngineRegistry, domain_id_from_engine
 from epu.processdispatcher.test.mocks import nosystemrestart_process_config, \
     MockNotifier, make_beat
 from epu.processdispatcher.modes import RestartMode, QueueingMode
+from epu.processdispatcher.util import get_heartbeat_digest
 from epu.exceptions import NotFoundError, BadRequestError
 from epu.util import parse_datetime
 
@@ -273,6 +276,108 @@ class ProcessDispatcherCoreTests(unittest.TestCase):
             self.core.schedule_process(None, proc,
                 queueing_mode=QueueingMode.START_ONLY)
 
+    def test_schedule_priority(self):
+        definition = "def1"
+        self.core.create_definition(definition, None, None)
+
+        process = self.core.schedule_process(None, "proc1", definition)
+        self.assertEqual(process.priority, 0)
+
+        process = self.core.schedule_process(None, "proc2", definition,
+            priority=5)
+        self.assertEqual(self.store.get_process(None, "proc2").priority, 5)
+
+        # repeating without a priority is fine, a different one is not
+        self.core.schedule_process(None, "proc2")
+        with self.assertRaises(BadRequestError):
+            self.core.schedule_process(None, "proc2", priority=1)
+
+        with self.assertRaises(BadRequestError):
+            self.core.schedule_process(None, "proc3", definition,
+                priority="hats")
+
+    def test_schedule_processes(self):
+        self.core.create_definition("def1", None, None)
+        self.core.create_definition("def2", None, None)
+        self.core.create_process(None, "proc0", "def1")
+
+        requests = [dict(upid="proc%d" % i, definition_id="def1") for i in range(5)]
+        requests.append(dict(upid="proc5", definition_id="def2", priority=3,
+            execution_engine_id="engine2"))
+        requests.append(dict(upid="proc6", definition_id="notadef"))
+        requests.append(dict(upid="proc7", definition_id="def1", hats=True))
+        requests.append(dict(definition_id="def1"))
+
+        definition_reads = []
+        get_definition = self.store.get_definition
+
+        def counting_get_definition(definition_id):
+            definition_reads.append(definition_id)
+            return get_definition(definition_id)
+        self.store.get_definition = counting_get_definition
+
+        results = self.core.schedule_processes(None, requests)
+        self.assertEqual(len(results), len(requests))
+
+        for i in range(6):
+            self.assertEqual(results[i].upid, "proc%d" % i)
+            self.assertEqual(results[i].state, ProcessState.REQUESTED)
+        self.assertEqual(results[5].priority, 3)
+        self.assertEqual(results[5].constraints, {"engine": "engine2"})
+        self.assertIsInstance(results[6], NotFoundError)
+        self.assertIsInstance(results[7], BadRequestError)
+        self.assertIsInstance(results[8], BadRequestError)
+
+        # each definition is fetched at most once
+        self.assertEqual(sorted(definition_reads), ["def1", "def2", "notadef"])
+
+        # all scheduled processes are queued, in order
+        self.assertEqual(self.store.get_queued_processes(),
+            [(None, "proc%d" % i, 0) for i in range(6)])
+
+    def test_schedule_processes_failure(self):
+        self.core.create_definition("def1", None, None)
+
+        # malformed constraints are a bad request of their process only
+        results = self.core.schedule_processes(None, [
+            dict(upid="proc1", definition_id="def1"),
+            dict(upid="proc2", definition_id="def1", constraints="bad",
+                 execution_engine_id="engine1")])
+        self.assertEqual(results[0].state, ProcessState.REQUESTED)
+        self.assertIsInstance(results[1], BadRequestError)
+        self.assertEqual(self.store.get_queued_processes(),
+            [(None, "proc1", 0)])
+
+        # processes scheduled before an unexpected error are still queued
+        update_process = self.store.update_process
+
+        def failing_update_process(process, *args, **kwargs):
+            if process.upid == "proc4":
+                raise Exception("store failure")
+            return update_process(process, *args, **kwargs)
+        self.store.update_process = failing_update_process
+
+        self.assertRaises(Exception, self.core.schedule_processes, None,
+            [dict(upid="proc3", definition_id="def1"),
+             dict(upid="proc4", definition_id="def1")])
+        self.assertEqual(self.store.get_process(None, "proc3").state,
+            ProcessState.REQUESTED)
+        self.assertEqual(self.store.get_queued_processes(),
+            [(None, "proc1", 0), (None, "proc3", 0)])
+
+    def test_terminate_processes(self):
+        p1 = ProcessRecord.new(None, "proc1", {}, ProcessState.WAITING)
+        p2 = ProcessRecord.new(None, "proc2", {}, ProcessState.TERMINATED)
+        for p in (p1, p2):
+            self.store.add_process(p)
+
+        results = self.core.terminate_processes(None, ["proc1", "proc2", "proc3"])
+        self.assertEqual(results[0].state, ProcessState.TERMINATED)
+        self.assertEqual(results[1].state, ProcessState.TERMINATED)
+        self.assertIsInstance(results[2], NotFoundError)
+        self.assertEqual(self.store.get_process(None, "proc1").state,
+            ProcessState.TERMINATED)
+
     def test_schedule_idempotency_procname(self):
         proc = "proc1"
         definition = "def1"
@@ -452,3 +557,350 @@ class ProcessDispatcherCoreTests(unittest.TestCase):
         self.core.ee_heartbeat("eeagent1", make_beat(node_id, timestamp=d2.isoformat()))
         resource = self.store.get_resource("eeagent1")
         self.assertEqual(resource.last_heartbeat_datetime, d3)
+
+    def test_heartbeat_owned_process(self):
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+
+        process = ProcessRecord.new("u1", "proc1", {}, ProcessState.PENDING)
+        process.assigned = "eeagent1"
+        self.store.add_process(process)
+        resource = self.store.get_resource("eeagent1")
+        resource.assigned.append(process.key)
+        self.store.update_resource(resource)
+
+        # EEAgents report processes by upid alone
+        beat = make_beat(node_id, [dict(upid="proc1", round=0,
+            state=ProcessState.RUNNING)])
+        self.core.ee_heartbeat("eeagent1", beat)
+
+        process = self.core.describe_process(None, "proc1")
+        self.assertEqual(process.owner, "u1")
+        self.assertEqual(process.state, ProcessState.RUNNING)
+        self.assertEqual(
+            [tuple(key) for key in self.store.get_resource("eeagent1").assigned],
+            [("u1", "proc1", 0)])
+
+    def test_describe_processes(self):
+        self.core.ee_registry = EngineRegistry.from_config(self.engine_conf,
+            default="engine1")
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine2"),
+            InstanceState.RUNNING)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+
+        self.store.add_process(ProcessRecord.new("u1", "p1", {},
+            ProcessState.REQUESTED))
+        self.store.add_process(ProcessRecord.new("u1", "p2", {},
+            ProcessState.RUNNING, constraints={"engine": "engine2"},
+            assigned="eeagent1"))
+        self.store.add_process(ProcessRecord.new("u2", "p3", {},
+            ProcessState.RUNNING, assigned="eeagent2"))
+        self.store.add_process(ProcessRecord.new(None, "p4", {},
+            ProcessState.TERMINATED))
+
+        def upids(processes):
+            return sorted(process['upid'] for process in processes)
+
+        self.assertEqual(upids(self.core.describe_processes()),
+            ["p1", "p2", "p3", "p4"])
+        self.assertEqual(upids(self.core.describe_processes(
+            min_state=ProcessState.PENDING, max_state=ProcessState.RUNNING)),
+            ["p2", "p3"])
+        self.assertEqual(upids(self.core.describe_processes(owner="u1")),
+            ["p1", "p2"])
+        self.assertEqual(upids(self.core.describe_processes(engine="engine2")),
+            ["p2"])
+
+        # processes constrained to no engine run on the default one
+        self.assertEqual(upids(self.core.describe_processes(engine="engine1")),
+            ["p1", "p3", "p4"])
+        self.assertEqual(upids(self.core.describe_processes(node_id=node_id)),
+            ["p2"])
+        self.assertEqual(self.core.describe_processes(owner="u2",
+            min_state=ProcessState.RUNNING, fields=["upid", "state"]),
+            [dict(upid="p3", state=ProcessState.RUNNING)])
+
+        # the in-memory store pages by owner and upid
+        processes, cursor = self.core.describe_processes_page(2)
+        self.assertEqual([p.upid for p in processes], ["p4", "p1"])
+        self.assertEqual(cursor, ["u1", "p1"])
+        processes, cursor = self.core.describe_processes_page(2, cursor=cursor)
+        self.assertEqual([p.upid for p in processes], ["p2", "p3"])
+        self.assertIsNone(cursor)
+
+        processes, cursor = self.core.describe_processes_page(2,
+            min_state=ProcessState.RUNNING, fields=["upid"])
+        self.assertEqual(processes, [dict(upid="p4"), dict(upid="p2")])
+        processes, cursor = self.core.describe_processes_page(2, cursor=cursor,
+            min_state=ProcessState.RUNNING, fields=["upid"])
+        self.assertEqual(processes, [dict(upid="p3")])
+        self.assertIsNone(cursor)
+
+        self.assertRaises(BadRequestError, self.core.describe_processes_page, 0)
+        self.assertRaises(BadRequestError, self.core.describe_processes_page, 1,
+            cursor="p1")
+
+    def test_describe_processes_module_engine(self):
+        self.core.ee_registry = EngineRegistry.from_config(self.engine_conf,
+            default="engine1", process_engines={"some.module": "engine3"})
+
+        definition = dict(executable=dict(module="some.module",
+            **{"class": "SomeClass"}))
+        self.store.add_process(ProcessRecord.new("u1", "p1", definition,
+            ProcessState.REQUESTED))
+        self.store.add_process(ProcessRecord.new("u1", "p2", {},
+            ProcessState.REQUESTED))
+
+        # processes mapped to an engine by their module are indexed under it
+        self.assertEqual([p.upid for p in self.core.describe_processes(
+            engine="engine3")], ["p1"])
+        self.assertEqual([p.upid for p in self.core.describe_processes(
+            engine="engine1")], ["p2"])
+
+    def test_heartbeat_reads_processes_together(self):
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+
+        states = {"proc1": ProcessState.PENDING,
+                  "proc2": ProcessState.TERMINATING,
+                  "proc3": ProcessState.RUNNING}
+        resource = self.store.get_resource("eeagent1")
+        for upid, state in sorted(states.items()):
+            process = ProcessRecord.new(None, upid, {}, state)
+            process.assigned = "eeagent1"
+            self.store.add_process(process)
+            resource.assigned.append(process.key)
+        self.store.update_resource(resource)
+
+        original_get_process = self.store.get_process
+        self.store.get_process = Mock(side_effect=original_get_process)
+
+        beat_processes = [
+            dict(upid="proc1", round=0, state=ProcessState.RUNNING),
+            dict(upid="proc2", round=0, state=ProcessState.TERMINATED),
+            dict(upid="proc3", round=0, state=ProcessState.RUNNING)]
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id, beat_processes))
+
+        # only the processes which changed are read again
+        self.assertEqual(sorted(args[1] for args, _ in
+            self.store.get_process.call_args_list), ["proc1", "proc2"])
+
+        self.store.get_process = original_get_process
+        self.assertEqual(self.store.get_process(None, "proc1").state,
+            ProcessState.RUNNING)
+        self.assertEqual(self.store.get_process(None, "proc2").state,
+            ProcessState.TERMINATED)
+        self.assertEqual(
+            [tuple(key) for key in self.store.get_resource("eeagent1").assigned],
+            [(None, "proc1", 0), (None, "proc3", 0)])
+
+    def test_delta_heartbeats(self):
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+
+        resource = self.store.get_resource("eeagent1")
+        for upid in ("proc1", "proc2"):
+            process = ProcessRecord.new(None, upid, {}, ProcessState.PENDING)
+            process.assigned = "eeagent1"
+            self.store.add_process(process)
+            resource.assigned.append(process.key)
+        self.store.update_resource(resource)
+
+        running = [dict(upid="proc1", round=0, state=ProcessState.RUNNING),
+                   dict(upid="proc2", round=0, state=ProcessState.RUNNING)]
+        beat = make_beat(node_id, running)
+        beat['sequence'] = 1
+        self.core.ee_heartbeat("eeagent1", beat)
+        self.resource_client.ack_heartbeat.assert_called_once_with("eeagent1", 1)
+        self.assertEqual(self.store.get_process(None, "proc2").state,
+            ProcessState.RUNNING)
+
+        # nothing changed. processes aren't even read
+        original_get_processes = self.store.get_processes
+        self.store.get_processes = Mock(side_effect=original_get_processes)
+        beat = make_beat(node_id)
+        beat.update(sequence=2, base=1, digest=get_heartbeat_digest(running))
+        self.core.ee_heartbeat("eeagent1", beat)
+        self.resource_client.ack_heartbeat.assert_called_with("eeagent1", 2)
+        self.store.get_processes.assert_called_once_with(set())
+        self.store.get_processes = original_get_processes
+
+        # proc2 exits and is cleaned up
+        exited = dict(upid="proc2", round=0, state=ProcessState.EXITED)
+        beat = make_beat(node_id, [exited])
+        beat.update(sequence=3, base=2,
+            digest=get_heartbeat_digest([running[0], exited]))
+        self.core.ee_heartbeat("eeagent1", beat)
+        self.resource_client.ack_heartbeat.assert_called_with("eeagent1", 3)
+        self.assertEqual(self.store.get_process(None, "proc2").state,
+            ProcessState.EXITED)
+        self.assertEqual(
+            [tuple(key) for key in self.store.get_resource("eeagent1").assigned],
+            [(None, "proc1", 0)])
+
+        beat = make_beat(node_id)
+        beat.update(sequence=4, base=3, removed=["proc2"],
+            digest=get_heartbeat_digest(running[:1]))
+        self.core.ee_heartbeat("eeagent1", beat)
+        self.resource_client.ack_heartbeat.assert_called_with("eeagent1", 4)
+        self.assertEqual(self.store.get_resource("eeagent1").reported,
+            running[:1])
+
+        # deltas from an unknown base or with a different view of the
+        # processes are not applied. a full beat is requested instead.
+        self.assertFalse(self.resource_client.request_heartbeat.called)
+        failed = dict(upid="proc1", round=0, state=ProcessState.FAILED)
+        for base, digest in ((2, get_heartbeat_digest([failed])),
+                             (4, get_heartbeat_digest([failed, exited]))):
+            self.resource_client.reset_mock()
+            beat = make_beat(node_id, [failed])
+            beat.update(sequence=5, base=base, digest=digest)
+            self.core.ee_heartbeat("eeagent1", beat)
+            self.resource_client.request_heartbeat.assert_called_once_with(
+                "eeagent1")
+            self.assertFalse(self.resource_client.ack_heartbeat.called)
+        self.assertEqual(self.store.get_process(None, "proc1").state,
+            ProcessState.RUNNING)
+        self.assertEqual(self.store.get_resource("eeagent1").heartbeat_sequence, 4)
+
+    def test_coalesced_delta_heartbeats(self):
+        node_id = uuid.uuid4().hex
+        self.core.node_state(node_id, domain_id_from_engine("engine1"),
+            InstanceState.RUNNING)
+        self.core.ee_heartbeat("eeagent1", make_beat(node_id))
+
+        resource = self.store.get_resource("eeagent1")
+        for upid in ("proc1", "proc2"):
+            process = ProcessRecord.new(None, upid, {}, ProcessState.PENDING)
+            process.assigned = "eeagent1"
+            self.store.add_process(process)
+            resource.assigned.append(process.key)
+        self.store.update_resource(resource)
+
+        # the worker is held up once the full beat is applied and acknowledged
+        acknowledged = threading.Event()
+        release = threading.Event()
+        ee_heartbeat = self.core.ee_heartbeat
+
+        def blocking_ee_heartbeat(sender, beat):
+            ee_heartbeat(sender, beat)
+            if beat.get('sequence') == 1:
+                acknowledged.set()
+                release.wait(5)
+        self.core.ee_heartbeat = blocking_ee_heartbeat
+
+        inbox = HeartbeatInbox(self.core, workers=1)
+        running = [dict(upid=upid, round=0, state=ProcessState.RUNNING)
+                   for upid in ("proc1", "proc2")]
+        beat = make_beat(node_id, running, timestamp="2013-04-02T19:37:00+00:00")
+        beat['sequence'] = 1
+        inbox.heartbeat("eeagent1", beat)
+        self.assertTrue(acknowledged.wait(5))
+        self.resource_client.ack_heartbeat.assert_called_once_with("eeagent1", 1)
+
+        # both deltas are against the acknowledged beat. the newest one has
+        # all of the changes since it, so the other is dropped.
+        exited = [dict(upid=upid, round=0, state=ProcessState.EXITED)
+                  for upid in ("proc1", "proc2")]
+        beat = make_beat(node_id, exited[:1],
+            timestamp="2013-04-02T19:38:00+00:00")
+        beat.update(sequence=2, base=1,
+            digest=get_heartbeat_digest([exited[0], running[1]]))
+        inbox.heartbeat("eeagent1", beat)
+        beat = make_beat(node_id, exited, timestamp="2013-04-02T19:39:00+00:00")
+        beat.update(sequence=3, base=1, digest=get_heartbeat_digest(exited))
+        inbox.heartbeat("eeagent1", beat)
+
+        release.set()
+        inbox.join()
+
+        self.assertEqual(self.resource_client.ack_heartbeat.call_args_list,
+            [call("eeagent1", 1), call("eeagent1", 3)])
+        self.assertFalse(self.resource_client.request_heartbeat.called)
+        for upid in ("proc1", "proc2"):
+            self.assertEqual(self.store.get_process(None, upid).state,
+                ProcessState.EXITED)
+        self.assertEqual(self.store.get_resource("eeagent1").heartbeat_sequence, 3)
+
+
+class HeartbeatInboxTests(unittest.TestCase):
+
+    def test_coalesce(self):
+        ingested = []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        class BlockingCore(object):
+            def ee_heartbeat(self, sender, beat):
+                if sender == "ee1" and not release.is_set():
+                    blocked.set()
+                    release.wait(5)
+                ingested.append((sender, beat['timestamp']))
+
+        inbox = HeartbeatInbox(BlockingCore(), workers=2)
+
+        inbox.heartbeat("ee1", make_beat("n1", timestamp="2013-04-02T19:37:00+00:00"))
+        self.assertTrue(blocked.wait(5))
+
+        # only the newest of the beats queued meanwhile is ingested
+        inbox.heartbeat("ee1", make_beat("n1", timestamp="2013-04-02T19:38:00+00:00"))
+        inbox.heartbeat("ee1", make_beat("n1", timestamp="2013-04-02T19:40:00+00:00"))
+        inbox.heartbeat("ee1", make_beat("n1", timestamp="2013-04-02T19:39:00+00:00"))
+
+        # other senders aren't held up
+        inbox.heartbeat("ee2", make_beat("n2", timestamp="2013-04-02T19:37:00+00:00"))
+        for _ in range(100):
+            if ingested:
+                break
+            time.sleep(0.01)
+        self.assertEqual(ingested, [("ee2", "2013-04-02T19:37:00+00:00")])
+
+        release.set()
+        inbox.join()
+        self.assertEqual([t for sender, t in ingested if sender == "ee1"],
+            ["2013-04-02T19:37:00+00:00", "2013-04-02T19:40:00+00:00"])
+        self.assertEqual(inbox.pending, {})
+        self.assertEqual(inbox.in_flight, {})
+
+    def test_older_than_in_flight(self):
+        ingested = []
+        blocked = threading.Event()
+        release = threading.Event()
+
+        class BlockingCore(object):
+            def ee_heartbeat(self, sender, beat):
+                if not release.is_set():
+                    blocked.set()
+                    release.wait(5)
+                ingested.append(beat['timestamp'])
+
+        inbox = HeartbeatInbox(BlockingCore(), workers=1)
+
+        inbox.heartbeat("ee1", make_beat("n1", timestamp="2013-04-02T19:38:00+00:00"))
+        self.assertTrue(blocked.wait(5))
+
+        # a late beat that is older than the one being ingested is dropped
+        inbox.heartbeat("ee1", make_beat("n1", timestamp="2013-04-02T19:37:00+00:00"))
+        self.assertEqual(inbox.pending, {"ee1": None})
+
+        inbox.heartbeat("ee1", make_beat("n1", timestamp="2013-04-02T19:39:00+00:00"))
+
+        release.set()
+        inbox.join()
+        self.assertEqual(ingested,
+            ["2013-04-02T19:38:00+00:00", "2013-04-02T19:39:00+00:00"])
+        self.assertEqual(inbox.in_flight, {})
+
+    def test_no_workers(self):
+        core = Mock()
+        inbox = HeartbeatInbox(core)
+        beat = make_beat("n1")
+        inbox.heartbeat("ee1", beat)
+        core.ee_heartbeat.assert_called_once_with("ee1", beat)
@@ -47,3 +47,31 @@ class EngineRegistryTests(unittest.TestCase):
 
         definition = dict(executable={"module": "e.f", "class": "G"})
         self.assertEqual(registry.get_process_definition_engine_id(definition), "engine1")
+
+    def test_matchmaker_shards(self):
+        registry = EngineRegistry.from_config(ENGINE_CONF1, default="engine1")
+
+        self.assertEqual(registry.get_matchmaker_shards(),
+            {'engine1': set(['engine1']), 'engine2': set(['engine2']),
+             'engine3': set(['engine3'])})
+
+        shards = registry.get_matchmaker_shards({'shard1': ['engine1', 'engine3']})
+        self.assertEqual(shards, {'shard1': set(['engine1', 'engine3']),
+                                  'engine2': set(['engine2'])})
+
+        with self.assertRaises(KeyError):
+            registry.get_matchmaker_shards({'shard1': ['engineX']})
+
+        with self.assertRaises(ValueError):
+            registry.get_matchmaker_shards({'shard1': ['engine1'],
+                                            'shard2': ['engine1', 'engine2']})
+
+    def test_placement_policy(self):
+        conf = {'engine1': {'slots': 4}, 'engine2': {'slots': 4, 'placement_policy': 'spread'}}
+        registry = EngineRegistry.from_config(conf, default="engine1")
+        self.assertEqual(registry.get_engine_by_id('engine1').placement_policy, 'pack')
+        self.assertEqual(registry.get_engine_by_id('engine2').placement_policy, 'spread')
+
+        conf['engine2']['placement_policy'] = 'scatter'
+        with self.assertRaises(ValueError):
+            EngineRegistry.from_config(conf, default="engine1")
@@ -11,7 +11,8 @@ import epu.tevent as tevent
 from nose.plugins.attrib import attr
 from nose.plugins.skip import SkipTest
 
-from epu.processdispatcher.matchmaker import PDMatchmaker
+from epu.processdispatcher.matchmaker import PDMatchmaker, DispatchOutbox, \
+    ProcessQueue, ConstraintPredicate
 from epu.processdispatcher.store import ProcessDispatcherStore, ProcessDispatcherZooKeeperStore
 from epu.processdispatcher.test.mocks import MockResourceClient, \
     MockEPUMClient, MockNotifier, get_definition, get_domain_config
@@ -124,6 +125,11 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.mm.matchmake()
         self.assertFalse(self.epum_client.reconfigures)
         self.assertTrue(self.mm.needs_matchmaking)
+        self.assertEqual(self.mm.stats.counters['write_conflicts'], 1)
+
+        # the resource is re-read on the next cycle, without waiting for
+        # another change
+        self.assertIn(r1.resource_id, self.mm.changed_resources)
 
         r1copy = self.store.get_resource(r1.resource_id)
         self.assertRecordVersions(r1, r1copy)
@@ -205,6 +211,39 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                           lambda p: p.assigned == r1.resource_id and
                                     p.state == ProcessState.PENDING)
 
+    def test_match_stats(self):
+        self.core.matchmaker_stats = self.mm.stats
+        self._run_in_thread()
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
+        self.store.add_resource(r1)
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED)
+        p1key = p1.get_key()
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1key)
+
+        self.wait_process(p1.owner, p1.upid,
+                          lambda p: p.state == ProcessState.PENDING)
+        time.sleep(0.05)
+
+        summary = self.core.dump()['matchmaker']
+        phases = summary['phases']
+        for phase in ("get_queued_processes", "get_resource_set",
+                      "check_throttled_processes", "matchmake",
+                      "register_needs", "cycle"):
+            self.assertIn(phase, phases)
+            self.assertTrue(phases[phase]['count'] >= 1)
+            self.assertTrue(phases[phase]['max'] >= phases[phase]['mean'] >= 0)
+
+        counters = summary['counters']
+        self.assertTrue(counters['store_reads'] > 0)
+        # assignment transaction, queue removal
+        self.assertTrue(counters['store_writes'] >= 2)
+        self.assertNotIn('backouts', counters)
+
     def test_match_double_queued_process(self):
 
         props = {"engine": "engine1"}
@@ -441,7 +480,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.mm.register_needs()
         self.epum_client.clear()
 
-        self.mm.queued_processes = []
+        self.clear_queued_processes()
 
         self.mm.register_needs()
         conf = self.epum_client.reconfigures['pd_domain_engine4'][0]
@@ -501,21 +540,28 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         # to it. we will simulate marking the process TERMINATED out-of-band
         # and ensure that is recognized before the dispatch.
 
-        # when the matchmaker attempts to update the process, sneak in an update
-        # first so the matchmaker request conflicts
-        original_update_process = self.store.update_process
+        # when the matchmaker attempts to commit the assignment, sneak in a
+        # process update first so the matchmaker transaction conflicts
+        original_transaction = self.store.transaction
 
-        def patched_update_process(process):
-            original = self.store.get_process(process.owner, process.upid)
-            original.state = ProcessState.TERMINATED
-            original_update_process(original)
+        def patched_transaction():
+            transaction = original_transaction()
+            original_commit = transaction.commit
 
-            try:
-                original_update_process(process)
-            finally:
-                event.set()
+            def patched_commit():
+                for process in transaction.processes:
+                    original = self.store.get_process(process.owner, process.upid)
+                    original.state = ProcessState.TERMINATED
+                    self.store.update_process(original)
 
-        self.store.update_process = patched_update_process
+                try:
+                    original_commit()
+                finally:
+                    event.set()
+            transaction.commit = patched_commit
+            return transaction
+
+        self.store.transaction = patched_transaction
 
         p1 = ProcessRecord.new(None, "p1", get_process_definition(),
             ProcessState.REQUESTED)
@@ -528,8 +574,8 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
         self.store.add_resource(r1)
 
-        # wait for MM to hit our update conflict, kill it, and check that it
-        # appropriately backed out the allocation
+        # wait for MM to hit our update conflict, kill it, and check that
+        # the allocation was not made
         assert event.wait(5)
         self.mm.cancel()
         self.mmthread.join()
@@ -540,6 +586,48 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
 
         self.assertEqual(self.resource_client.launch_count, 0)
 
+    def test_process_updated(self):
+        self._run_in_thread()
+
+        # the process record is updated out of band just before the
+        # matchmaker commits its assignment. The process still needs a slot,
+        # so the assignment is retried with the new record.
+        original_transaction = self.store.transaction
+        conflicts = []
+
+        def patched_transaction():
+            transaction = original_transaction()
+            original_commit = transaction.commit
+
+            def patched_commit():
+                if not conflicts:
+                    for process in transaction.processes:
+                        original = self.store.get_process(process.owner, process.upid)
+                        self.store.update_process(original)
+                        conflicts.append(process.key)
+                original_commit()
+            transaction.commit = patched_commit
+            return transaction
+
+        self.store.transaction = patched_transaction
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+            ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
+        self.store.add_resource(r1)
+
+        self.wait_process(p1.owner, p1.upid,
+            lambda p: p.assigned == r1.resource_id and
+                      p.state == ProcessState.PENDING)
+        self.assertEqual(conflicts, [p1.key])
+        self.wait_resource(r1.resource_id, lambda r: list(p1.key) in r.assigned)
+        time.sleep(0.05)
+        self.resource_client.check_process_launched(p1, r1.resource_id)
+
     def test_process_already_assigned(self):
 
         # this is a recovery situation, probably. The process is assigned
@@ -566,6 +654,287 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         self.assertTrue(r1.is_assigned(p1.owner, p1.upid, p1.round))
         self.assertEqual(r1.available_slots, 0)
 
+    def test_assignment_index(self):
+        self.mm.initialize()
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 2, properties=props)
+        r1.assigned.append(("u1", "p1", 0))
+        self.store.add_resource(r1)
+        r2 = ResourceRecord.new("r2", "n1", 2, properties=props)
+        self.store.add_resource(r2)
+
+        self.mm._get_resource_set()
+        found = self.mm._find_assigned_resource("u1", "p1", 0)
+        self.assertEqual(found.resource_id, "r1")
+        self.assertIsNone(self.mm._find_assigned_resource("u1", "p1", 1))
+
+        # move the assignment to another resource. index should follow.
+        r1.assigned = []
+        self.store.update_resource(r1)
+        r2.assigned = [("u1", "p1", 0)]
+        self.store.update_resource(r2)
+        self.mm._get_resources()
+
+        found = self.mm._find_assigned_resource("u1", "p1", 0)
+        self.assertEqual(found.resource_id, "r2")
+
+        self.store.remove_resource("r2")
+        self.mm._get_resource_set()
+        self.assertIsNone(self.mm._find_assigned_resource("u1", "p1", 0))
+        self.assertFalse(self.mm.assignments)
+
+    def test_constraint_predicate(self):
+        predicate = ConstraintPredicate({"engine": "engine1",
+            "site": ["site1", "site2"], "hats": None})
+        self.assertTrue(predicate.matches({"engine": "engine1", "site": "site2"}))
+        self.assertFalse(predicate.matches({"engine": "engine1", "site": "site3"}))
+        self.assertFalse(predicate.matches({"engine": "engine1"}))
+        self.assertFalse(predicate.matches({"engine": "engine1", "site": ["site1"]}))
+        self.assertFalse(predicate.matches(None))
+
+        self.assertTrue(ConstraintPredicate(None).matches(None))
+        self.assertTrue(ConstraintPredicate({"hats": None}).matches({}))
+
+        # unhashable values are compared for equality
+        predicate = ConstraintPredicate({"tags": [{"a": 1}, {"b": 2}]})
+        self.assertTrue(predicate.matches({"tags": {"b": 2}}))
+        self.assertFalse(predicate.matches({"tags": {"c": 3}}))
+
+    def test_constraint_predicate_cache(self):
+        self.mm.initialize()
+
+        constraints = {"engine": "engine2", "site": ["site1", "site2"]}
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+            ProcessState.REQUESTED, constraints=constraints)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+            ProcessState.REQUESTED, constraints=dict(constraints))
+        p3 = ProcessRecord.new(None, "p3", get_process_definition(),
+            ProcessState.REQUESTED)
+
+        predicate = self.mm._get_constraint_predicate(p1)
+        self.assertIs(self.mm._get_constraint_predicate(p2), predicate)
+        self.assertEqual(predicate.constraints,
+            self.core.get_process_constraints(p1))
+
+        predicate = self.mm._get_constraint_predicate(p3)
+        self.assertEqual(predicate.constraints, {"engine": "engine1"})
+        self.assertEqual(len(self.mm.constraint_predicates), 2)
+
+    def test_match_property_index(self):
+        self.mm.initialize()
+
+        for i, (engine, site) in enumerate([("engine1", "site1"),
+                ("engine2", "site1"), ("engine2", "site2")]):
+            props = {"engine": engine, "site": site}
+            resource = ResourceRecord.new("r%d" % i, "n%d" % i, 1, properties=props)
+            self.store.add_resource(resource)
+        self.mm._get_resource_set()
+
+        node_containers = self.mm.get_available_resources()
+        index = self.mm.property_index
+        self.assertEqual(index.candidates({"engine": "engine2"}), set(["r1", "r2"]))
+        self.assertEqual(index.candidates({"engine": "engine2", "site": "site1"}),
+            set(["r1"]))
+        self.assertEqual(index.candidates({"engine": "engine1", "site": ["site1", "site2"]}),
+            set(["r0"]))
+        self.assertEqual(index.candidates({"engine": "engine3"}), set())
+        self.assertIsNone(index.candidates({"site": None}))
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+            ProcessState.REQUESTED, constraints={"engine": "engine2", "site": "site2"})
+        matched = self.mm.matchmake_process(p1, node_containers)
+        self.assertEqual(matched.resource_id, "r2")
+
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+            ProcessState.REQUESTED, constraints={"engine": "engine1", "site": "site2"})
+        self.assertIsNone(self.mm.matchmake_process(p2, node_containers))
+
+    def test_process_cache(self):
+        self.mm.initialize()
+
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+                               ProcessState.REQUESTED)
+        self.store.add_process(p1)
+        self.store.enqueue_process(*p1.key)
+        self.mm._get_queued_processes()
+
+        self.assertEqual(len(self.mm.queued_processes_by_engine("engine1")), 1)
+        self.assertIn((None, "p1"), self.mm.process_cache)
+
+        # cached records are used until they change in the store
+        cached = self.mm._get_process(None, "p1")
+        self.assertIs(self.mm._get_process(None, "p1"), cached)
+
+        p1.state = ProcessState.WAITING
+        self.store.update_process(p1)
+        process = self.mm._get_process(None, "p1")
+        self.assertIsNot(process, cached)
+        self.assertEqual(process.state, ProcessState.WAITING)
+
+        # and dropped once the process leaves the queue
+        self.store.remove_queued_process(*p1.key)
+        self.mm._get_queued_processes()
+        self.assertNotIn((None, "p1"), self.mm.process_cache)
+
+    def test_dispatch_outbox(self):
+        blocked = threading.Event()
+        release = threading.Event()
+
+        class BlockingResourceClient(MockResourceClient):
+            def launch_process(self, eeagent, *args):
+                if eeagent == "r1" and not release.is_set():
+                    blocked.set()
+                    release.wait(5)
+                MockResourceClient.launch_process(self, eeagent, *args)
+
+        client = BlockingResourceClient()
+        outbox = DispatchOutbox(client, workers=2)
+
+        outbox.launch_process("r1", "p1", 0, "supd", {})
+        self.assertTrue(blocked.wait(5))
+        outbox.launch_process("r1", "p2", 0, "supd", {})
+        outbox.launch_process("r1", "p3", 0, "supd", {})
+
+        # launches to other resources aren't held up
+        outbox.launch_process("r2", "p4", 0, "supd", {})
+        for _ in range(100):
+            if client.launch_count:
+                break
+            time.sleep(0.01)
+        self.assertEqual([l[1] for l in client.launches], ["p4"])
+
+        release.set()
+        outbox.join()
+        self.assertEqual([l[1] for l in client.launches if l[0] == "r1"],
+            ["p1", "p2", "p3"])
+        self.assertEqual(outbox.pending, {})
+
+    def test_sorted_node_containers(self):
+        self.mm.initialize()
+
+        props = {"engine": "engine2"}
+        for node_id, slots, assigned in (("n1", 4, []), ("n2", 4, [(None, "p0", 0)]),
+                ("n3", 2, [(None, "p1", 0)]), ("n4", 4, [])):
+            resource = ResourceRecord.new("r" + node_id[1:], node_id, slots,
+                properties=props)
+            resource.assigned = assigned
+            self.store.add_resource(resource)
+        self.mm._get_resource_set()
+
+        # occupied nodes first, fullest first
+        node_containers = self.mm.get_available_resources()
+        self.assertEqual([c.node_id for c in node_containers],
+            ["n3", "n2", "n1", "n4"])
+
+        # only the changed node moves
+        r2 = self.store.get_resource("r2")
+        r2.assigned.extend([(None, "p2", 0), (None, "p3", 0)])
+        self.store.update_resource(r2)
+        r4 = self.store.get_resource("r4")
+        r4.assigned.append((None, "p4", 0))
+        self.store.update_resource(r4)
+        r3 = self.store.get_resource("r3")
+        r3.assigned.append((None, "p5", 0))
+        self.store.update_resource(r3)
+        self.mm._get_resources()
+
+        self.assertEqual([c.node_id for c in node_containers], ["n2", "n4", "n1"])
+        self.assertEqual(self.mm.property_index.candidates({"engine": "engine2"}),
+            set(["r1", "r2", "r4"]))
+
+        self.store.remove_resource("r2")
+        self.mm._get_resource_set()
+        self.assertEqual([c.node_id for c in node_containers], ["n4", "n1"])
+        self.assertEqual(len(node_containers), 2)
+
+    def test_placement_policies(self):
+        self.registry.get_engine_by_id("engine2").placement_policy = "spread"
+        self.registry.get_engine_by_id("engine3").placement_policy = "lru"
+        self.mm.initialize()
+
+        for engine in ("engine1", "engine2", "engine3"):
+            props = {"engine": engine}
+            for node_id, slots, assigned in (("n1", 4, [(None, "p0", 0)]),
+                    ("n2", 4, []), ("n3", 2, [])):
+                node_id = engine + node_id
+                resource = ResourceRecord.new(node_id + "r", node_id, slots,
+                    properties=props)
+                resource.assigned = assigned
+                self.store.add_resource(resource)
+        self.mm._get_resource_set()
+        node_containers = self.mm.get_available_resources()
+
+        def order(engine):
+            return [c.node_id[len(engine):]
+                    for c in node_containers.iter_engine(engine)]
+
+        # pack fills occupied nodes first. spread prefers the most
+        # available slots. lru prefers nodes that haven't been used.
+        self.assertEqual(order("engine1"), ["n1", "n2", "n3"])
+        self.assertEqual(order("engine2"), ["n2", "n1", "n3"])
+        self.assertEqual(order("engine3"), ["n2", "n3", "n1"])
+        self.assertEqual(len(node_containers), 9)
+
+        for engine in ("engine1", "engine2", "engine3"):
+            p = ProcessRecord.new(None, "p" + engine, get_process_definition(),
+                ProcessState.REQUESTED, constraints={"engine": engine})
+            self.store.add_process(p)
+            self.store.enqueue_process(*p.key)
+        self.mm._get_queued_processes()
+        self.mm.matchmake()
+
+        self.assertEqual(self.mm.assignments[(None, "pengine1", 0)], "engine1n1r")
+        self.assertEqual(self.mm.assignments[(None, "pengine2", 0)], "engine2n2r")
+        self.assertEqual(self.mm.assignments[(None, "pengine3", 0)], "engine3n2r")
+
+        self.assertEqual(order("engine2"), ["n1", "n2", "n3"])
+        self.assertEqual(order("engine3"), ["n3", "n1", "n2"])
+
+    def test_heartbeat_resource_change(self):
+        self.mm.initialize()
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
+        self.store.add_resource(r1)
+        self.mm._get_resource_set()
+        self.mm.needs_matchmaking = False
+
+        # a heartbeat alone doesn't warrant matchmaking, but the fresh
+        # record is kept
+        r1.last_heartbeat = "2013-01-01T00:00:00"
+        self.store.update_resource(r1)
+        self.mm._get_resources()
+        self.assertFalse(self.mm.needs_matchmaking)
+        self.assertRecordVersions(self.mm.resources["r1"], r1)
+        self.assertEqual(self.mm.stats.counters['ignored_resource_changes'], 1)
+
+        r1.slot_count = 2
+        self.store.update_resource(r1)
+        self.mm._get_resources()
+        self.assertTrue(self.mm.needs_matchmaking)
+
+    def test_batch_window(self):
+        self.mm.batch_window = 0.5
+        self._run_in_thread()
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
+        self.store.add_resource(r1)
+        time.sleep(0.05)
+
+        # a burst of changes is folded into the next cycle
+        cycles = self.mm.stats.phase_counts['cycle']
+        for i in range(10):
+            r1.slot_count = i + 2
+            self.store.update_resource(r1)
+            time.sleep(0.01)
+
+        self.wait_resource("r1", lambda r: r.slot_count == 11)
+        time.sleep(0.6)
+        self.assertEqual(self.mm.resources["r1"].slot_count, 11)
+        self.assertTrue(self.mm.stats.phase_counts['cycle'] - cycles <= 2)
+
     def test_wait_resource(self):
         props = {"engine": "engine1"}
         r1 = ResourceRecord.new("r1", "n1", 1, properties=props)
@@ -652,6 +1021,102 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
             except AssertionError:
                 time.sleep(0.01)
 
+    def test_process_queue(self):
+        queue = ProcessQueue()
+
+        # u1 queues a pile of processes before u2 and u3 show up
+        for i in range(4):
+            queue.add(("u1", "a%d" % i, 0))
+        queue.add(("u2", "b0", 0))
+        queue.add(("u2", "b1", 0))
+        queue.add(("u3", "c0", 0), priority=1)
+
+        order = []
+        entry = queue.pop()
+        while entry:
+            order.append(entry[1])
+            entry = queue.pop()
+
+        # higher priority first, then owners take turns
+        self.assertEqual(order, ["c0", "a0", "b0", "a1", "b1", "a2", "a3"])
+        self.assertEqual(len(queue), 7)
+
+        # popped entries go back in their original place
+        queue.push(("u1", "a3", 0))
+        queue.push(("u1", "a1", 0))
+        queue.push(("u1", "a1", 0))
+        queue.remove(("u1", "a3", 0))
+        self.assertEqual(queue.pop(), ("u1", "a1", 0))
+        self.assertIsNone(queue.pop())
+        self.assertNotIn(("u1", "a3", 0), queue)
+
+    def test_match_priority(self):
+        self.mm.initialize()
+
+        for i, (upid, priority) in enumerate([("p1", 0), ("p2", 0), ("p3", 10)]):
+            p = ProcessRecord.new(None, upid, get_process_definition(),
+                ProcessState.REQUESTED, priority=priority)
+            self.store.add_process(p)
+            self.store.enqueue_process(*p.key)
+
+        props = {"engine": "engine1"}
+        for i in range(2):
+            r = ResourceRecord.new("r%d" % i, "n%d" % i, 1, properties=props)
+            self.store.add_resource(r)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resource_set()
+        self.mm.matchmake()
+
+        self.assertEqual([l[1] for l in self.resource_client.launches],
+            ["p3", "p1"])
+        self.assertEqual(self.store.get_process(None, "p2").state,
+            ProcessState.WAITING)
+
+    def test_throttling(self):
+        self.mm.minimum_time_between_starts = 0.2
+        self.mm.initialize()
+
+        props = {"engine": "engine1"}
+        r1 = ResourceRecord.new("r1", "n1", 2, properties=props)
+        self.store.add_resource(r1)
+
+        # p1 was just restarted, p2 uses its own longer interval
+        now = time.time()
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+            ProcessState.REQUESTED)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+            ProcessState.REQUESTED,
+            configuration={'process': {'minimum_time_between_starts': 60}})
+        for p in (p1, p2):
+            p.dispatch_times = [now - 10, now]
+            self.store.add_process(p)
+            self.store.enqueue_process(*p.key)
+
+        self.mm._get_queued_processes()
+        self.mm._get_resource_set()
+        self.mm.matchmake()
+
+        self.assertEqual(self.resource_client.launch_count, 0)
+        self.assertEqual(set(self.mm.throttled_processes), set([p1.key, p2.key]))
+        self.assertEqual(self.store.get_process(None, "p1").state,
+            ProcessState.WAITING)
+        until = self.mm._time_until_throttling_ends()
+        self.assertTrue(0 < until <= 0.2)
+
+        # nothing to do until the first throttle ends
+        self.mm._check_throttled_processes()
+        self.assertFalse(self.mm.needs_matchmaking)
+
+        time.sleep(until)
+        self.mm._check_throttled_processes()
+        self.assertTrue(self.mm.needs_matchmaking)
+        self.assertEqual(self.mm.throttled_processes.keys(), [p2.key])
+
+        self.mm.matchmake()
+        self.assertEqual([l[1] for l in self.resource_client.launches], ["p1"])
+        self.assertTrue(self.mm._time_until_throttling_ends() > 50)
+
     def assert_one_reconfigure(self, domain_id=None, preserve_n=None, retirees=None):
         if domain_id is not None:
             reconfigures = self.epum_client.reconfigures[domain_id]
@@ -678,7 +1143,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
             pkeys.append(pkey)
             self.store.add_process(p)
             self.store.enqueue_process(*pkey)
-            self.mm.queued_processes.append(pkey)
+        self.mm._get_queued_processes()
         return pkeys
 
     def create_n_pending_processes(self, n_processes, engine_id):
@@ -706,8 +1171,8 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                 process.state = ProcessState.REQUESTED
                 self.store.update_process(process)
                 self.store.enqueue_process(*pkey)
-                self.mm.queued_processes.append(pkey)
                 pkeys.append(pkey)
+        self.mm._get_queued_processes()
         return pkeys
 
     def create_engine_resources(self, engine_id, node_count=1, assignments=None):
@@ -722,8 +1187,6 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                 res = ResourceRecord.new(uuid.uuid4().hex, node_id,
                     engine_spec.slots, properties=props)
                 records.append(res)
-                res.metadata['version'] = 0
-                self.mm.resources[res.resource_id] = res
 
                 # use fake process ids in the assigned list, til it matters
                 if len(assignments) <= engine_spec.slots:
@@ -733,9 +1196,20 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                     res.assigned = assignments[:engine_spec.slots]
                     assignments[:] = assignments[engine_spec.slots:]
 
+                self.store.add_resource(res)
                 print "added resource: %s" % res
+        self.mm._get_resource_set()
         return records
 
+    def update_resources(self, resources):
+        for resource in resources:
+            self.store.update_resource(resource)
+        self.mm._get_resources()
+
+    def clear_queued_processes(self):
+        self.store.clear_queued_processes()
+        self.mm._get_queued_processes()
+
     def test_engine_config(self):
         self.mm.cancel()
         maximum_vms = 10
@@ -836,7 +1310,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine4_resources = self.create_engine_resources("engine4",
             node_count=11, assignments=engine4_procs)
         self.assertEqual(len(engine4_resources), 11)
-        self.mm.queued_processes = []
+        self.clear_queued_processes()
 
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
@@ -870,6 +1344,8 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
             if len(engine4_retirees) >= 2:
                 break
 
+        self.update_resources(engine1_resources + engine2_resources +
+            engine3_resources + engine4_resources)
         self.mm.register_needs()
         self.assert_one_reconfigure(engine1_domain_id, 8,
             engine1_retirees)
@@ -1008,7 +1484,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine2_resources = self.create_engine_resources("engine2",
             node_count=10, assignments=engine2_procs)
         self.assertEqual(len(engine2_resources), 10)
-        self.mm.queued_processes = []
+        self.clear_queued_processes()
 
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
@@ -1025,6 +1501,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
             engine2_retirees.add(resource.node_id)
             resource.assigned = []
 
+        self.update_resources(engine1_resources + engine2_resources)
         self.mm.register_needs()
 
         # we should see for the queued and pending procs
@@ -1071,7 +1548,7 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         engine1_resources = self.create_engine_resources("engine1",
             node_count=10, assignments=engine1_procs)
         self.assertEqual(len(engine1_resources), 10)
-        self.mm.queued_processes = []
+        self.clear_queued_processes()
 
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
@@ -1080,7 +1557,8 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
         # the requue can happen before the resource update so we
         # simulate this to ensure that the process isn't counted twice
 
-        self.mm.queued_processes = [(owner, upid, rround + 1)]
+        self.store.enqueue_process(owner, upid, rround + 1)
+        self.mm._get_queued_processes()
         self.mm.register_needs()
         self.assertFalse(self.epum_client.reconfigures)
 
@@ -1121,6 +1599,110 @@ class PDMatchmakerTests(unittest.TestCase, StoreTestMixin):
                           lambda p: p.assigned == r2.resource_id and
                                     p.state == ProcessState.PENDING)
 
+    def test_sharded_matchmaking(self):
+        matchmakers = []
+        for shard, engine_ids in (("shard1", ["engine1"]),
+                                  ("shard2", ["engine2", "engine3"])):
+            mm = PDMatchmaker(self.core, self.store, self.resource_client,
+                self.registry, self.epum_client, self.notifier,
+                self.service_name, self.definition_id,
+                self.base_domain_config, self.run_type,
+                self.restart_throttling_config, shard=shard,
+                engine_ids=engine_ids)
+            mm.initialize()
+            matchmakers.append(mm)
+        mm1, mm2 = matchmakers
+
+        r1 = ResourceRecord.new("r1", "n1", 1, properties={"engine": "engine1"})
+        r2 = ResourceRecord.new("r2", "n2", 1, properties={"engine": "engine2"})
+        self.store.add_resource(r1)
+        self.store.add_resource(r2)
+
+        # p1 runs on the default engine
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+            ProcessState.REQUESTED)
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+            ProcessState.REQUESTED, constraints={"engine": "engine2"})
+        p3 = ProcessRecord.new(None, "p3", get_process_definition(),
+            ProcessState.REQUESTED, constraints={"engine": "engine3"})
+        for p in (p1, p2, p3):
+            self.store.add_process(p)
+            self.store.enqueue_process(*p.key)
+
+        for mm in matchmakers:
+            mm._get_queued_processes()
+            mm._get_resource_set()
+
+        # each shard only sees its own engines
+        self.assertEqual(mm1.queued_processes, [p1.key])
+        self.assertEqual(mm2.queued_processes, [p2.key, p3.key])
+        self.assertEqual(mm1.resources.keys(), ["r1"])
+        self.assertEqual(mm2.resources.keys(), ["r2"])
+        self.assertEqual(mm1.foreign_resources, set(["r2"]))
+
+        for mm in matchmakers:
+            mm.matchmake()
+            mm.register_needs()
+
+        self.wait_resource("r1", lambda r: r.assigned == [list(p1.key)])
+        self.wait_resource("r2", lambda r: r.assigned == [list(p2.key)])
+        self.assertEqual(mm1.queued_processes, [])
+        self.assertEqual(mm2.queued_processes, [p3.key])
+
+        self.assertEqual(set(mm1.registered_needs), set(["engine1"]))
+        self.assertEqual(set(mm2.registered_needs), set(["engine2", "engine3"]))
+        self.assertEqual(mm2.registered_needs["engine3"], 1)
+
+        # changes to another shard's resources are ignored
+        mm1._get_resources()
+        r2 = self.store.get_resource("r2")
+        r2.slot_count = 2
+        self.store.update_resource(r2)
+        mm1.needs_matchmaking = False
+        mm1._get_resources()
+        self.assertFalse(mm1.needs_matchmaking)
+        self.assertEqual(mm1.resources.keys(), ["r1"])
+
+    def test_sharded_engine_constraint_forms(self):
+        matchmakers = []
+        for shard, engine_ids in (("shard1", ["engine1"]),
+                                  ("shard2", ["engine2", "engine3"])):
+            mm = PDMatchmaker(self.core, self.store, self.resource_client,
+                self.registry, self.epum_client, self.notifier,
+                self.service_name, self.definition_id,
+                self.base_domain_config, self.run_type,
+                self.restart_throttling_config, shard=shard,
+                engine_ids=engine_ids)
+            mm.initialize()
+            matchmakers.append(mm)
+        mm1, mm2 = matchmakers
+
+        # a list of engines is in every shard of one of them. an engine of
+        # None falls back to the default engine
+        p1 = ProcessRecord.new(None, "p1", get_process_definition(),
+            ProcessState.REQUESTED, constraints={"engine": ["engine2", "engine3"]})
+        p2 = ProcessRecord.new(None, "p2", get_process_definition(),
+            ProcessState.REQUESTED, constraints={"engine": ["engine1", "engine2"]})
+        p3 = ProcessRecord.new(None, "p3", get_process_definition(),
+            ProcessState.REQUESTED, constraints={"engine": None})
+        for p in (p1, p2, p3):
+            self.store.add_process(p)
+            self.store.enqueue_process(*p.key)
+
+        for mm in matchmakers:
+            mm._get_queued_processes()
+
+        self.assertEqual(mm1.queued_processes, [p2.key, p3.key])
+        self.assertEqual(mm2.queued_processes, [p1.key, p2.key])
+
+        r1 = ResourceRecord.new("r1", "n1", 1,
+            properties={"engine": ["engine1", "engine3"]})
+        r2 = ResourceRecord.new("r2", "n2", 1, properties={"engine": None})
+        self.assertTrue(mm1._resource_in_shard(r1))
+        self.assertTrue(mm2._resource_in_shard(r1))
+        self.assertTrue(mm1._resource_in_shard(r2))
+        self.assertFalse(mm2._resource_in_shard(r2))
+
     @attr('INT')
     def test_default_engine_types(self):
         self._run_in_thread()
@@ -1369,6 +1369,17 @@ class ProcessDispatcherServiceTests(unittest.TestCase):
         proc2 = self.client.describe_process("proc2")
         self.assertEqual(proc2['upid'], "proc2")
 
+        # pages are in the order of the store
+        page1 = self.client.describe_processes(limit=1, fields=["upid"])
+        page2 = self.client.describe_processes(limit=1, fields=["upid"],
+            cursor=page1['cursor'])
+        self.assertEqual(sorted(page1['processes'] + page2['processes']),
+            [dict(upid="proc1"), dict(upid="proc2")])
+        self.assertIsNone(page2['cursor'])
+
+        self.assertEqual(sorted(p['upid'] for p in self.client.iter_processes(
+            fields=["upid"], page_size=1)), ["proc1", "proc2"])
+
     def test_process_exited(self):
         node = "node1"
         domain_id = domain_id_from_engine('engine1')
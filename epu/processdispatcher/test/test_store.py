@@ -6,11 +6,17 @@ import random
 import logging
 import os
 
+import simplejson as json
+
 from kazoo.exceptions import ConnectionLoss
 
 from epu.exceptions import NotFoundError, WriteConflictError
 from epu.processdispatcher.store import ResourceRecord, ProcessDispatcherStore,\
-    ProcessDispatcherZooKeeperStore, ProcessDefinitionRecord
+    ProcessDispatcherZooKeeperStore, ProcessDefinitionRecord, ProcessRecord, \
+    NodeRecord, CachedProcessDispatcherZooKeeperStore, encode_process, \
+    decode_process, encode_definition, PROCESS_SCHEMA_VERSION, \
+    PROCESS_TIME_HISTORY, COMPRESS_CONFIGURATION_SIZE, BUCKETS, get_bucket
+from epu.states import ProcessState, ExecutionResourceState
 from epu.test import ZooKeeperTestMixin, MockLeader, SocatProxyRestartWrapper
 
 log = logging.getLogger(__name__)
@@ -50,6 +56,28 @@ class ProcessDispatcherStoreTests(unittest.TestCase, StoreTestMixin):
     def setUp(self):
         self.store = ProcessDispatcherStore()
 
+    def test_sharded_matchmaker_elections(self):
+        leaders = dict((shard, MockLeader()) for shard in (None, "shard1", "shard2"))
+        for shard, leader in leaders.iteritems():
+            self.store.contend_matchmaker(leader, shard=shard)
+
+        # each shard holds its own election, so all of them lead at once
+        for leader in leaders.itervalues():
+            leader.wait_running()
+
+        self.store.shutdown()
+        for leader in leaders.itervalues():
+            leader.wait_cancelled()
+
+    def test_enqueue_processes(self):
+        source = [("u1", "proc1", 0), ("u1", "proc2", 1), (None, "proc3", 0)]
+        self.store.enqueue_process("u2", "proc0", 0)
+        self.store.enqueue_processes(source)
+        self.store.enqueue_processes([])
+
+        self.assertEqual(self.store.get_queued_processes(),
+            [("u2", "proc0", 0)] + source)
+
     def test_queued_processes(self):
 
         source = [("u1", "proc1", 0), ("u1", "proc2", 1), ("u2", "proc1", 0),
@@ -67,12 +95,247 @@ class ProcessDispatcherStoreTests(unittest.TestCase, StoreTestMixin):
         queued = self.store.get_queued_processes()
         self.assertEqual(source, queued)
 
+        self.assertRaises(NotFoundError, self.store.remove_queued_process,
+            *toremove)
+
+    def test_process_watcher(self):
+        calls = []
+        event = threading.Event()
+
+        def watcher(*args):
+            calls.append(args)
+            event.set()
+
+        for owner in (None, "u1"):
+            process = ProcessRecord.new(owner, "proc1", {}, ProcessState.REQUESTED)
+            self.store.add_process(process)
+
+            self.store.get_process(owner, "proc1", watcher=watcher)
+            process.state = ProcessState.WAITING
+            self.store.update_process(process)
+            self.assertTrue(event.wait(5))
+            self.assertEqual(calls.pop(), (owner, "proc1"))
+            event.clear()
+
+            self.store.get_process(owner, "proc1", watcher=watcher)
+            self.store.remove_process(owner, "proc1")
+            self.assertTrue(event.wait(5))
+            self.assertEqual(calls.pop(), (owner, "proc1"))
+            event.clear()
+
     def assertProcessDefinitionsEqual(self, d1, d2):
         attrs = ('definition_id', 'definition_type', 'executable',
                              'name', 'description', 'version')
         for attr in attrs:
             self.assertEqual(getattr(d1, attr), getattr(d2, attr))
 
+    def test_process_owners(self):
+        for owner, upid in ((None, "p1"), ("u1", "p2"), ("u1", "p3"),
+                            ("u2", "p3")):
+            self.store.add_process(ProcessRecord.new(owner, upid, {},
+                ProcessState.REQUESTED))
+        self.assertRaises(WriteConflictError, self.store.add_process,
+            ProcessRecord.new("u1", "p2", {}, ProcessState.REQUESTED))
+
+        self.assertEqual(self.store.get_process_owners(["p1", "p2", "p3", "p4"]),
+            {"p1": [None], "p2": ["u1"], "p3": ["u1", "u2"]})
+
+        self.store.remove_process(None, "p1")
+        self.store.remove_process("u1", "p3")
+        self.assertRaises(NotFoundError, self.store.remove_process, "u2", "p2")
+        self.assertEqual(self.store.get_process_owners(["p1", "p2", "p3"]),
+            {"p2": ["u1"], "p3": ["u2"]})
+
+    def test_process_indexes(self):
+        self.store.add_process(ProcessRecord.new(None, "p1", {},
+            ProcessState.REQUESTED))
+        self.store.add_process(ProcessRecord.new("u1", "p2", {},
+            ProcessState.REQUESTED, constraints={"engine": "engine2"}))
+        self.store.add_process(ProcessRecord.new("u1", "p3", {},
+            ProcessState.RUNNING, assigned="r1"))
+
+        self.assertEqual(sorted(self.store.list_process_index_values("state")),
+            [ProcessState.REQUESTED, ProcessState.RUNNING])
+        self.assertEqual(sorted(self.store.get_indexed_process_ids("state",
+            [ProcessState.REQUESTED])), [(None, "p1"), ("u1", "p2")])
+        self.assertEqual(sorted(self.store.get_indexed_process_ids("engine",
+            [None])), [(None, "p1"), ("u1", "p3")])
+        self.assertEqual(self.store.get_indexed_process_ids("engine",
+            ["engine2"]), [("u1", "p2")])
+        self.assertEqual(self.store.get_indexed_process_ids("assigned",
+            ["r1", "r2"]), [("u1", "p3")])
+
+        # processes assigned to no resource have no entry
+        self.assertEqual(self.store.get_indexed_process_ids("assigned",
+            [None]), [])
+
+        # updates move processes between index values
+        process = self.store.get_process("u1", "p2")
+        process.state = ProcessState.RUNNING
+        process.assigned = "r2"
+        self.store.update_process(process)
+
+        process = self.store.get_process(None, "p1")
+        process.state = ProcessState.TERMINATED
+        transaction = self.store.transaction()
+        transaction.update_process(process)
+        transaction.commit()
+
+        self.store.remove_process("u1", "p3")
+
+        self.assertEqual(self.store.get_indexed_process_ids("state",
+            [ProcessState.REQUESTED]), [])
+        self.assertEqual(self.store.get_indexed_process_ids("state",
+            [ProcessState.RUNNING]), [("u1", "p2")])
+        self.assertEqual(self.store.get_indexed_process_ids("state",
+            [ProcessState.TERMINATED]), [(None, "p1")])
+        self.assertEqual(self.store.get_indexed_process_ids("assigned",
+            ["r1", "r2"]), [("u1", "p2")])
+
+        self.assertRaises(ValueError, self.store.get_indexed_process_ids,
+            "hostname", ["host1"])
+
+    def test_process_engine_list_index(self):
+        # a process constrained to several engines is indexed under each
+        self.store.add_process(ProcessRecord.new("u1", "p1", {},
+            ProcessState.REQUESTED, constraints={"engine": ["engine1",
+                                                            "engine2"]}))
+        for engine in ("engine1", "engine2"):
+            self.assertEqual(self.store.get_indexed_process_ids("engine",
+                [engine]), [("u1", "p1")])
+        self.assertEqual(self.store.find_process_ids(
+            {"engine": ["engine1", "engine2"]}), [("u1", "p1")])
+
+        process = self.store.get_process("u1", "p1")
+        process.constraints = {"engine": ["engine2", "engine3"]}
+        self.store.update_process(process)
+        self.assertEqual(self.store.get_indexed_process_ids("engine",
+            ["engine1"]), [])
+        self.assertEqual(self.store.get_indexed_process_ids("engine",
+            ["engine3"]), [("u1", "p1")])
+
+        self.store.remove_process("u1", "p1")
+        self.assertEqual(self.store.get_indexed_process_ids("engine",
+            ["engine2", "engine3"]), [])
+
+    def test_find_process_ids(self):
+        for i in range(20):
+            if i % 3:
+                state, assigned = ProcessState.RUNNING, "r%d" % (i % 4)
+            else:
+                state, assigned = ProcessState.REQUESTED, None
+            self.store.add_process(ProcessRecord.new("u%d" % (i % 2),
+                "proc%d" % i, {}, state, assigned=assigned))
+
+        process_ids = self.store.find_process_ids()
+        self.assertEqual(sorted(process_ids),
+            sorted(self.store.get_process_ids()))
+
+        # pages resume after the last process of the previous one
+        paged = []
+        page = self.store.find_process_ids(limit=3)
+        while page:
+            paged.extend(page)
+            page = self.store.find_process_ids(after=page[-1], limit=3)
+        self.assertEqual(paged, process_ids)
+
+        running = self.store.find_process_ids(
+            {"state": [ProcessState.RUNNING]}, owner="u1")
+        self.assertEqual(sorted(running), sorted(("u1", "proc%d" % i)
+            for i in range(20) if i % 2 and i % 3))
+        self.assertEqual(self.store.find_process_ids(
+            {"state": [ProcessState.RUNNING]}, owner="u1", after=running[0],
+            limit=2), running[1:3])
+
+        self.assertEqual(sorted(self.store.find_process_ids(
+            {"assigned": ["r1"], "state": [ProcessState.RUNNING]})),
+            sorted(("u1", "proc%d" % i) for i in (1, 5, 13, 17)))
+        self.assertEqual(self.store.find_process_ids({"assigned": ["r9"]}),
+            [])
+
+        self.assertRaises(ValueError, self.store.find_process_ids,
+            {"hostname": ["host1"]})
+
+    def test_bulk_reads(self):
+        for i in range(5):
+            owner = "u1" if i % 2 else None
+            self.store.add_process(ProcessRecord.new(owner, "proc%d" % i, {},
+                ProcessState.REQUESTED))
+            self.store.add_node(NodeRecord.new("node%d" % i, "domain1"))
+            self.store.add_resource(ResourceRecord.new("r%d" % i, "node%d" % i, 1))
+
+        processes = self.store.get_processes()
+        self.assertEqual(sorted(p.upid for p in processes),
+            ["proc%d" % i for i in range(5)])
+        for process in processes:
+            self.assertRecordVersions(process,
+                self.store.get_process(process.owner, process.upid))
+
+        # requested order is kept, missing records are skipped
+        processes = self.store.get_processes([("u1", "proc3"), (None, "proc9"),
+            (None, "proc0")])
+        self.assertEqual([p.upid for p in processes], ["proc3", "proc0"])
+
+        self.assertEqual(sorted(n.node_id for n in self.store.get_nodes()),
+            ["node%d" % i for i in range(5)])
+        self.assertEqual([n.node_id for n in self.store.get_nodes(["node2", "nodeX"])],
+            ["node2"])
+
+        self.assertEqual(sorted(r.resource_id for r in self.store.get_resources()),
+            ["r%d" % i for i in range(5)])
+        self.assertEqual([r.resource_id for r in self.store.get_resources(["r4", "r1"])],
+            ["r4", "r1"])
+        self.assertEqual(self.store.get_resources([]), [])
+
+    def test_transaction(self):
+        process = ProcessRecord.new(None, "proc1", {}, ProcessState.REQUESTED)
+        self.store.add_process(process)
+        resource = ResourceRecord.new("r1", "n1", 1)
+        self.store.add_resource(resource)
+        node = NodeRecord.new("n1", "domain1")
+        self.store.add_node(node)
+
+        process.state = ProcessState.PENDING
+        resource.assigned.append(process.key)
+        node.node_exclusive.append("x")
+        transaction = self.store.transaction()
+        transaction.update_process(process)
+        transaction.update_resource(resource)
+        transaction.update_node(node)
+        transaction.commit()
+
+        self.assertEqual(self.store.get_process(None, "proc1").state,
+            ProcessState.PENDING)
+        self.assertRecordVersions(process, self.store.get_process(None, "proc1"))
+        self.assertEqual(self.store.get_resource("r1").assigned, [list(process.key)])
+        self.assertRecordVersions(resource, self.store.get_resource("r1"))
+        self.assertEqual(self.store.get_node("n1").node_exclusive, ["x"])
+        self.assertRecordVersions(node, self.store.get_node("n1"))
+
+        # a conflict on any record means nothing is written
+        stale_process = self.store.get_process(None, "proc1")
+        process.state = ProcessState.RUNNING
+        self.store.update_process(process)
+
+        stale_process.state = ProcessState.TERMINATED
+        resource.assigned = []
+        transaction = self.store.transaction()
+        transaction.update_resource(resource)
+        transaction.update_process(stale_process)
+        self.assertRaises(WriteConflictError, transaction.commit)
+
+        self.assertEqual(self.store.get_process(None, "proc1").state,
+            ProcessState.RUNNING)
+        self.assertEqual(self.store.get_resource("r1").assigned, [list(process.key)])
+        self.assertRecordVersions(resource, self.store.get_resource("r1"))
+
+        self.store.remove_node("n1")
+        transaction = self.store.transaction()
+        transaction.update_resource(resource)
+        transaction.update_node(node)
+        self.assertRaises(NotFoundError, transaction.commit)
+        self.assertEqual(self.store.get_resource("r1").assigned, [list(process.key)])
+
     def test_add_update_remove_definition(self):
 
         d1 = ProcessDefinitionRecord.new("d1", "t1", "notepad.exe", "proc1")
@@ -132,6 +395,224 @@ class ProcessDispatcherZooKeeperStoreTests(ProcessDispatcherStoreTests, ZooKeepe
         self.store.shutdown()
         self.teardown_zookeeper()
 
+    def test_remove_queued_process_uncached(self):
+        source = [("u1", "proc1", 0), ("u1", "proc2", 1), (None, "proc3", 0)]
+        self.store.enqueue_processes(source)
+
+        # entries missing from the queue cache are found by listing their
+        # bucket
+        with self.store._queued_lock:
+            self.store._queued_paths.clear()
+        self.store.remove_queued_process("u1", "proc1", 0)
+
+        # stale entries too
+        with self.store._queued_lock:
+            self.store._queued_paths[(None, "proc3", 0)] = \
+                self.store._make_requested_path(upid="proc3", round=0,
+                    seq="9999999999")
+        self.store.remove_queued_process(None, "proc3", 0)
+
+        self.assertEqual(self.store.get_queued_processes(), [("u1", "proc2", 1)])
+        self.assertRaises(NotFoundError, self.store.remove_queued_process,
+            "u1", "proc1", 0)
+
+    def test_enqueue_order_across_stores(self):
+        other = ProcessDispatcherZooKeeperStore(self.zk_hosts,
+            self.zk_base_path, use_gevent=self.use_gevent)
+        other.initialize()
+        try:
+            # each store has a stale view of the queue counter at some point,
+            # but entries are still stamped in the order they are queued
+            source = [("u1", "proc1", 0), ("u2", "proc2", 0),
+                ("u3", "proc3", 0), ("u4", "proc4", 0), ("u5", "proc5", 0)]
+            for i, key in enumerate(source):
+                store = other if i % 2 else self.store
+                store.enqueue_process(*key)
+
+            # the queue as stored, rather than as cached by either store
+            queued = []
+            for bucket_path, names in self.store._list_buckets(
+                    self.store.QUEUED_PROCESSES_PATH):
+                queued.extend(self.store._parse_queued_process(name)
+                    for name in names)
+            self.assertEqual([key for seq, key in sorted(queued)], source)
+        finally:
+            other.shutdown()
+
+    def test_migrate_layout(self):
+        kazoo = self.store.kazoo
+
+        # records and queue entries as stored by earlier releases
+        for owner, upid in (("u1", "proc1"), (None, "proc2")):
+            process = ProcessRecord.new(owner, upid, {}, ProcessState.REQUESTED)
+            path = self.store.PROCESSES_PATH + "/"
+            if owner is not None:
+                path += "owner=" + owner + "&"
+            kazoo.create(path + "upid=" + upid, json.dumps(process))
+        kazoo.create(self.store.QUEUED_PROCESSES_PATH +
+            "/upid=proc2&round=0+", "", sequence=True)
+        kazoo.create(self.store.QUEUED_PROCESSES_PATH +
+            "/owner=u1&upid=proc1&round=0+", "", sequence=True)
+        self.store.enqueue_process("u3", "proc3", 0)
+
+        self.store.migrate_layout()
+
+        self.assertEqual(sorted(kazoo.get_children(self.store.PROCESSES_PATH)),
+            sorted(BUCKETS))
+        self.assertEqual(
+            sorted(kazoo.get_children(self.store.QUEUED_PROCESSES_PATH)),
+            sorted(BUCKETS))
+        self.assertEqual(sorted(self.store.get_process_ids()),
+            [(None, "proc2"), ("u1", "proc1")])
+        self.assertEqual(self.store.get_process("u1", "proc1").state,
+            ProcessState.REQUESTED)
+        self.assertEqual(sorted(self.store.get_indexed_process_ids("state",
+            [ProcessState.REQUESTED])), [(None, "proc2"), ("u1", "proc1")])
+
+        # migrated entries keep their order, ahead of newer entries
+        self.assertEqual(self.store.get_queued_processes(),
+            [(None, "proc2", 0), ("u1", "proc1", 0), ("u3", "proc3", 0)])
+        self.store.remove_queued_process("u1", "proc1", 0)
+
+        # nothing is left to migrate
+        self.store.migrate_layout()
+        self.assertEqual(self.store.get_queued_processes(),
+            [(None, "proc2", 0), ("u3", "proc3", 0)])
+
+    def test_assigned_process_index_layout(self):
+        kazoo = self.store.kazoo
+        assigned_path = self.store.PROCESS_INDEX_PATH + "/assigned"
+        for i in range(10):
+            self.store.add_process(ProcessRecord.new("u1", "proc%d" % i, {},
+                ProcessState.RUNNING, assigned="r%d" % i))
+        self.assertEqual(self.store.get_indexed_process_ids("assigned",
+            ["r3"]), [("u1", "proc3")])
+        self.assertEqual(sorted(self.store.list_process_index_values(
+            "assigned")), sorted("r%d" % i for i in range(10)))
+
+        for i in range(10):
+            self.store.remove_process("u1", "proc%d" % i)
+
+        # the index has entries only, nothing is left behind for resources
+        # that are gone
+        self.assertEqual(sorted(kazoo.get_children(assigned_path)),
+            sorted(BUCKETS))
+        for bucket in BUCKETS:
+            self.assertEqual(kazoo.get_children(assigned_path + "/" + bucket),
+                [])
+
+    def test_find_process_ids_from_cursor(self):
+        for i in range(20):
+            self.store.add_process(ProcessRecord.new("u1", "proc%d" % i, {},
+                ProcessState.RUNNING))
+        process_ids = self.store.find_process_ids()
+
+        listed = []
+        get_children_async = self.store.kazoo.get_children_async
+
+        def counting_get_children_async(path, *args, **kwargs):
+            listed.append(path)
+            return get_children_async(path, *args, **kwargs)
+        self.store.kazoo.get_children_async = counting_get_children_async
+
+        # a page lists buckets from the cursor only until it is full
+        def get_bucket_index(process_id):
+            return BUCKETS.index(get_bucket(self.store._make_process_name(
+                owner=process_id[0], upid=process_id[1])))
+
+        for index in (1, 10, 18):
+            del listed[:]
+            self.assertEqual(self.store.find_process_ids(
+                {"state": [ProcessState.RUNNING]},
+                after=process_ids[index - 1], limit=1), [process_ids[index]])
+            self.assertTrue(len(listed) <= self.store.FIND_BUCKETS +
+                get_bucket_index(process_ids[index]) -
+                get_bucket_index(process_ids[index - 1]))
+
+    def test_stale_process_index(self):
+        kazoo = self.store.kazoo
+        self.store.add_process(ProcessRecord.new("u1", "proc1", {},
+            ProcessState.REQUESTED))
+        name = self.store._make_process_name(owner="u1", upid="proc1")
+
+        # writes go through when index entries are missing or left behind
+        kazoo.delete(self.store._make_process_index_path("state",
+            ProcessState.REQUESTED, name))
+        path = self.store._make_process_index_path("state",
+            ProcessState.RUNNING, name)
+        kazoo.ensure_path(path)
+
+        process = self.store.get_process("u1", "proc1")
+        process.state = ProcessState.RUNNING
+        self.store.update_process(process)
+        self.assertEqual(self.store.get_indexed_process_ids("state",
+            [ProcessState.RUNNING]), [("u1", "proc1")])
+
+        kazoo.delete(path)
+        self.store.remove_process("u1", "proc1")
+        self.assertEqual(self.store.get_indexed_process_ids("engine", [None]),
+            [])
+
+
+class CachedProcessDispatcherZooKeeperStoreTests(ProcessDispatcherStoreTests, ZooKeeperTestMixin):
+
+    def setUp(self):
+        self.setup_zookeeper("/processdispatcher_store_tests_")
+        self.store = CachedProcessDispatcherZooKeeperStore(self.zk_hosts,
+            self.zk_base_path, use_gevent=self.use_gevent)
+        self.store.initialize()
+
+        # writes made by another worker
+        self.other_store = ProcessDispatcherZooKeeperStore(self.zk_hosts,
+            self.zk_base_path, use_gevent=self.use_gevent)
+        self.other_store.initialize()
+
+    def tearDown(self):
+        self.store.shutdown()
+        self.other_store.shutdown()
+        self.teardown_zookeeper()
+
+    def wait_cached_resource(self, resource_id, pred, timeout=5):
+        # reads with a watcher bypass the cache, so poll
+        start = time.time()
+        while not pred(self.store.get_resource(resource_id)):
+            if time.time() - start >= timeout:
+                raise Exception("timeout")
+            time.sleep(0.01)
+
+    def test_cached_reads(self):
+        resource = ResourceRecord.new("r1", "n1", 1)
+        self.other_store.add_resource(resource)
+
+        # the cache picks up new records and changes from other workers
+        path = self.store.RESOURCES_PATH + "/r1"
+        self.wait_cached_resource("r1", lambda r: r is not None)
+        self.assertIsNotNone(self.store._get_cache(path).get(path))
+
+        resource.state = ExecutionResourceState.DISABLED
+        self.other_store.update_resource(resource)
+        self.wait_cached_resource("r1",
+            lambda r: r.state == ExecutionResourceState.DISABLED)
+        self.assertRecordVersions(resource, self.store.get_resource("r1"))
+
+        # stale writes still conflict
+        stale = self.store.get_resource("r1")
+        resource.state = ExecutionResourceState.OK
+        self.other_store.update_resource(resource)
+        self.assertRaises(WriteConflictError, self.store.update_resource, stale)
+        self.wait_cached_resource("r1",
+            lambda r: r.metadata['version'] == resource.metadata['version'])
+
+        # our own writes are visible right away
+        fresh = self.store.get_resource("r1")
+        fresh.assigned.append("p1")
+        self.store.update_resource(fresh)
+        self.assertEqual(self.store.get_resource("r1").assigned, ["p1"])
+        self.assertRecordVersions(fresh, self.store.get_resource("r1"))
+
+        self.other_store.remove_resource("r1")
+        self.wait_cached_resource("r1", lambda r: r is None)
+
 
 class ProcessDispatcherZooKeeperStoreProxyTests(ProcessDispatcherStoreTests, ZooKeeperTestMixin):
 
@@ -256,3 +737,39 @@ class RecordTests(unittest.TestCase):
         self.assertEqual(r2.metadata['version'], 1)
         self.assertNotIn('metadata', r1_dict_copy)
         self.assertNotIn('metadata', r2_dict_copy)
+
+    def test_process_encoding(self):
+        definition = ProcessDefinitionRecord.new("def1", "supd",
+            {"exec": "/bin/true"}, version="1")
+        configuration = {"big": "x" * (COMPRESS_CONFIGURATION_SIZE + 1)}
+        process = ProcessRecord.new("u1", "proc1", definition,
+            ProcessState.REQUESTED, configuration=configuration)
+        for _ in range(PROCESS_TIME_HISTORY + 5):
+            process.increment_dispatches()
+        self.assertEqual(process.dispatches, PROCESS_TIME_HISTORY + 5)
+        self.assertEqual(len(process.dispatch_times), PROCESS_TIME_HISTORY)
+
+        data, snapshot = encode_process(process)
+        digest, definition_data = snapshot
+        self.assertEqual(encode_definition(process.definition), snapshot)
+
+        # the definition is referenced and the configuration compressed
+        encoded = json.loads(data)
+        self.assertEqual(encoded['schema'], PROCESS_SCHEMA_VERSION)
+        self.assertNotIn('definition', encoded)
+        self.assertEqual(encoded['definition_ref'],
+            dict(definition_id="def1", version="1", digest=digest))
+        self.assertNotIn('configuration', encoded)
+        self.assertLess(len(data), len(json.dumps(process)))
+
+        decoded = decode_process(data, {digest: definition_data}.__getitem__)
+        self.assertEqual(decoded, process)
+
+        # records without a schema are plain JSON
+        process.configuration = {}
+        self.assertEqual(decode_process(json.dumps(process), None), process)
+
+        process.definition = None
+        data, snapshot = encode_process(process)
+        self.assertIsNone(snapshot)
+        self.assertEqual(decode_process(data, None), process)
@@ -1,3 +1,6 @@
+import hashlib
+
+
 def get_process_state_message(process):
     """Get a string suitable for logging a process state
     """
@@ -20,3 +23,25 @@ def get_process_state_message(process):
 
     return "Process %s%s -> %s round=%s%s" % (process.upid, name,
         process.state, process.round, location)
+
+
+def get_heartbeat_state(procstate):
+    """Get the state of a process reported in an EEAgent heartbeat
+    """
+    state = procstate['state']
+
+    # TODO hack to handle how states are formatted in EEAgent heartbeat
+    if isinstance(state, (list, tuple)):
+        state = "-".join(str(s) for s in state)
+    return state
+
+
+def get_heartbeat_digest(processes):
+    """Get the digest of the processes reported in an EEAgent heartbeat
+
+    Delta heartbeats carry the digest of the full list of processes the
+    EEAgent has, for the PD to check its view of them against.
+    """
+    entries = sorted("%s %s %s" % (procstate['upid'], int(procstate['round']),
+        get_heartbeat_state(procstate)) for procstate in processes)
+    return hashlib.sha1("\n".join(entries)).hexdigest()
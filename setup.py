@@ -65,6 +65,7 @@ setupdict['entry_points'] = {
             'epu-zktool=epu.zkcli:main',
             'epu-high-availability-service=epu.dashiproc.highavailability:main',
             'epu-dtrs=epu.dashiproc.dtrs:main',
+            'epu-pd-benchmark=epu.processdispatcher.benchmark:main',
             ]
         }
 setupdict['scripts'] = ["scripts/epu-process"]